@@ -0,0 +1,92 @@
+"""Event loop latency under concurrent signups, with inline bcrypt vs. the hashing executor.
+
+A ticker coroutine sleeps for a fixed interval and records how late it wakes up. While it runs,
+a batch of concurrent "signups" hash a password and then await a simulated database round trip.
+With inline hashing the loop is blocked for the whole bcrypt call and the ticker lag grows with
+the number of signups; with the executor the lag stays close to zero.
+
+Usage:
+    python -m benchmarks.bench_hashing --signups 32 --concurrency 8
+"""
+
+import argparse
+import asyncio
+import statistics
+import time
+
+import bcrypt
+
+from melody.identity.hashing import HashingExecutor
+
+TICK_INTERVAL = 0.005
+
+
+async def _ticker(lags: list, stop: asyncio.Event):
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        expected = loop.time() + TICK_INTERVAL
+        await asyncio.sleep(TICK_INTERVAL)
+        lags.append(max(0.0, loop.time() - expected))
+
+
+async def _signup_inline(password: str):
+    bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt()).decode("utf-8")
+    await asyncio.sleep(0.001)
+
+
+async def _signup_executor(executor: HashingExecutor, password: str):
+    await executor.hash_password(password)
+    await asyncio.sleep(0.001)
+
+
+async def _run(name: str, make_signup, signups: int, concurrency: int) -> dict:
+    lags, stop = [], asyncio.Event()
+    ticker = asyncio.create_task(_ticker(lags, stop))
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def _one(i: int):
+        async with semaphore:
+            await make_signup(f"password-{i}")
+
+    start = time.perf_counter()
+    await asyncio.gather(*[_one(i) for i in range(signups)])
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await ticker
+
+    lags_ms = sorted(x * 1000 for x in lags) or [0.0]
+    return {
+        "name": name,
+        "elapsed_s": round(elapsed, 3),
+        "signups_per_s": round(signups / elapsed, 1),
+        "lag_p50_ms": round(statistics.median(lags_ms), 2),
+        "lag_p99_ms": round(lags_ms[min(len(lags_ms) - 1, int(len(lags_ms) * 0.99))], 2),
+        "lag_max_ms": round(lags_ms[-1], 2),
+    }
+
+
+async def main(signups: int, concurrency: int, workers: int | None):
+    results = [await _run("inline", _signup_inline, signups, concurrency)]
+    for use_processes in (False, True):
+        executor = HashingExecutor(max_workers=workers, use_processes=use_processes)
+        # warm up the pool so that worker start-up is not counted
+        await executor.hash_password("warmup")
+        name = "process-pool" if use_processes else "thread-pool"
+        results.append(await _run(name, lambda p: _signup_executor(executor, p), signups, concurrency))
+        executor.shutdown()
+
+    print(f"{'mode':<14}{'elapsed_s':>10}{'signups/s':>11}{'lag_p50_ms':>12}{'lag_p99_ms':>12}{'lag_max_ms':>12}")
+    for r in results:
+        print(
+            f"{r['name']:<14}{r['elapsed_s']:>10}{r['signups_per_s']:>11}"
+            f"{r['lag_p50_ms']:>12}{r['lag_p99_ms']:>12}{r['lag_max_ms']:>12}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--signups", type=int, default=32)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+    asyncio.run(main(args.signups, args.concurrency, args.workers))
@@ -0,0 +1,139 @@
+"""OAuth2 callbacks against a local mock provider, with a client per callback vs. pooled provider clients.
+
+Each simulated callback exchanges a code for a token (POST) and fetches the user info (GET), like
+UserService.login_with_oauth_callback. The mock provider serves HTTP/1.1 with keep-alive on localhost,
+counts the connections it accepts, and delays the first response of every connection by --handshake-ms
+to stand in for the TCP and TLS handshakes of a real provider. A client per callback opens a connection
+per callback, pooled clients open at most --concurrency connections in total.
+
+Usage:
+    python -m benchmarks.bench_provider_http --callbacks 200 --concurrency 8 --handshake-ms 30
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import statistics
+import time
+
+import httpx
+
+from melody_users.http_clients import ProviderHTTPClients
+
+
+class MockProvider:
+    """A minimal HTTP/1.1 server answering every request with a token / user info JSON body."""
+
+    def __init__(self, handshake_ms: float) -> None:
+        self.handshake_ms = handshake_ms
+        self.connections = 0
+        self.requests = 0
+        self._server: asyncio.AbstractServer | None = None
+
+    async def start(self) -> str:
+        self._server = await asyncio.start_server(self._serve, "127.0.0.1", 0)
+        host, port = self._server.sockets[0].getsockname()[:2]
+        return f"http://{host}:{port}"
+
+    async def stop(self) -> None:
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.connections += 1
+        first = True
+        try:
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                request_line, *lines = head.decode("latin-1").split("\r\n")
+                headers = dict(line.split(": ", 1) for line in lines if line)
+                length = int(headers.get("content-length", headers.get("Content-Length", 0)))
+                if length:
+                    await reader.readexactly(length)
+                if first:
+                    await asyncio.sleep(self.handshake_ms / 1000)
+                    first = False
+                self.requests += 1
+                if request_line.startswith("POST"):
+                    body = {"access_token": "token", "token_type": "bearer", "expires_in": 3600, "scope": "user"}
+                else:
+                    body = {"id": 1, "login": "melody", "email": "melody@example.com"}
+                payload = json.dumps(body).encode()
+                writer.write(
+                    b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+                    + f"Content-Length: {len(payload)}\r\n\r\n".encode()
+                    + payload
+                )
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionResetError):
+            pass
+        finally:
+            writer.close()
+
+
+async def _callback(client: httpx.AsyncClient, base_url: str) -> None:
+    token = await client.post(f"{base_url}/token", data={"grant_type": "authorization_code", "code": "code"})
+    access_token = token.json()["access_token"]
+    await client.get(f"{base_url}/user", headers={"Authorization": f"Bearer {access_token}"})
+
+
+async def _client_per_callback(base_url: str) -> None:
+    async with httpx.AsyncClient(headers={"Accept": "application/json"}) as client:
+        await _callback(client, base_url)
+
+
+async def _run(name: str, callback, callbacks: int, concurrency: int, handshake_ms: float, clients=None) -> dict:
+    provider = MockProvider(handshake_ms)
+    base_url = await provider.start()
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def _one():
+        async with semaphore:
+            started = time.perf_counter()
+            await callback(base_url)
+            latencies.append((time.perf_counter() - started) * 1000)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[_one() for _ in range(callbacks)])
+    elapsed = time.perf_counter() - start
+    if clients is not None:
+        await clients.aclose()
+    await provider.stop()
+
+    latencies.sort()
+    return {
+        "name": name,
+        "elapsed_s": round(elapsed, 3),
+        "callbacks_per_s": round(callbacks / elapsed, 1),
+        "p50_ms": round(statistics.median(latencies), 2),
+        "p99_ms": round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))], 2),
+        "connections": provider.connections,
+    }
+
+
+async def main(callbacks: int, concurrency: int, handshake_ms: float):
+    results = [await _run("per-callback", _client_per_callback, callbacks, concurrency, handshake_ms)]
+    clients = ProviderHTTPClients(http2=False, max_keepalive_connections=concurrency)
+    pooled = lambda base_url: _callback(clients.client("mock"), base_url)  # noqa: E731
+    results.append(await _run("pooled", pooled, callbacks, concurrency, handshake_ms, clients=clients))
+
+    print(f"{'mode':<14}{'elapsed_s':>10}{'callbacks/s':>13}{'p50_ms':>9}{'p99_ms':>9}{'connections':>13}")
+    for r in results:
+        print(
+            f"{r['name']:<14}{r['elapsed_s']:>10}{r['callbacks_per_s']:>13}"
+            f"{r['p50_ms']:>9}{r['p99_ms']:>9}{r['connections']:>13}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--callbacks", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--handshake-ms", type=float, default=30.0)
+    args = parser.parse_args()
+    # melody_users logs at DEBUG, keep the per-request logs of httpx out of the results
+    for name in ("httpx", "httpcore"):
+        logging.getLogger(name).setLevel(logging.WARNING)
+    asyncio.run(main(args.callbacks, args.concurrency, args.handshake_ms))
@@ -0,0 +1,173 @@
+"""Scaling curves: latency of lookups, listings and writes as the number of users grows.
+
+The database is grown with benchmarks.datagen to each of --sizes users, with the tenant skew of --tenants and
+--skew, then every operation runs --queries times sequentially, with the user and identity caches disabled so
+every call reaches the database, in sessions scoped to the tenant as in requests. Lookups pick users from a uniform sample of the loaded users, listings read the
+first and a later page of the largest tenant and of the median one. Sessions are looked up by token if the
+sessions table of melody_users exists in the database.
+
+The curves are printed as p50/p95 per size, with the growth of p95 from the smallest to the largest size, and
+written as json with --save. Reuse --uri to grow an existing database further, loading is incremental.
+
+Usage:
+    python -m benchmarks.bench_scaling --sizes 10000,100000,1000000 --queries 200 --save /tmp/scaling.json
+    python -m benchmarks.bench_scaling --uri postgresql+asyncpg://localhost/melody_bench --sizes 1000000,10000000,50000000
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import random
+import time
+import uuid
+from typing import Awaitable, Callable, Dict, List
+
+from sqlalchemy import select, text
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from benchmarks.datagen import DataGenerator, tenant_name
+from melody.config import cache_settings
+from melody.identity import crud as identity_crud
+from melody.user import crud as user_crud
+from melody.tenancy import scope_session
+from melody.user.models import UserCreateRequest, UserPatchRequest
+from melody_users.sessions import SessionValidator
+
+
+def _percentile(latencies: list, q: float) -> float:
+    return latencies[min(len(latencies) - 1, int(len(latencies) * q))]
+
+
+async def _measure(operation: Callable[[int], Awaitable], queries: int) -> dict:
+    latencies = []
+    for i in range(queries):
+        started = time.perf_counter()
+        await operation(i)
+        latencies.append((time.perf_counter() - started) * 1000)
+    latencies.sort()
+    return {
+        "p50_ms": round(_percentile(latencies, 0.50), 3),
+        "p95_ms": round(_percentile(latencies, 0.95), 3),
+        "p99_ms": round(_percentile(latencies, 0.99), 3),
+    }
+
+
+def _operations(engine: AsyncEngine, generator: DataGenerator, tokens: List[str], tenants: int) -> Dict[str, Callable]:
+    rand = random.Random(11)
+    samples = generator.samples
+    largest, median = tenant_name(0), tenant_name(tenants // 2)
+
+    def scoped(tenant_id: str) -> AsyncSession:
+        # sessions of requests are scoped to their tenant, see melody.deps
+        session = AsyncSession(engine)
+        scope_session(session, tenant_id)
+        return session
+
+    async def user_by_id(i):
+        tenant_id, user_id, _ = rand.choice(samples)
+        async with scoped(tenant_id) as session:
+            await user_crud.retrieve_user(session, id=user_id)
+
+    async def identity_by_email(i):
+        tenant_id, _, email = rand.choice(samples)
+        async with scoped(tenant_id) as session:
+            await identity_crud.retrieve_email_identity(session, tenant_id=tenant_id, email=email)
+
+    async def identities_by_user(i):
+        tenant_id, user_id, _ = rand.choice(samples)
+        async with scoped(tenant_id) as session:
+            await identity_crud.retrieve_identities_by_user_id(session, user_id=user_id)
+
+    def list_users(tenant_id: str, pages: int):
+        async def _list(i):
+            async with scoped(tenant_id) as session:
+                cursor = None
+                for _ in range(pages):
+                    page = await user_crud.list_users(session, tenant_id=tenant_id, cursor=cursor, limit=50)
+                    cursor = page.next_cursor
+                    if cursor is None:
+                        break
+
+        return _list
+
+    async def create_user(i):
+        tenant_id = rand.choice(samples)[0]
+        async with scoped(tenant_id) as session:
+            await user_crud.create_users(
+                session, requests=[UserCreateRequest(tenant_id=tenant_id, username=f"bench-{uuid.uuid4().hex}")]
+            )
+            await session.commit()
+
+    async def patch_user(i):
+        tenant_id, user_id, _ = rand.choice(samples)
+        async with scoped(tenant_id) as session:
+            await user_crud.patch_user(session, id=user_id, request=UserPatchRequest(nickname=f"n{i}"))
+            await session.commit()
+
+    operations = {
+        "user by id": user_by_id,
+        "identity by email": identity_by_email,
+        "identities by user": identities_by_user,
+        "list largest tenant": list_users(largest, 1),
+        "list largest, page 10": list_users(largest, 10),
+        "list median tenant": list_users(median, 1),
+        "create user": create_user,
+        "patch user": patch_user,
+    }
+    if tokens:
+        validator = SessionValidator(engine, generator.tables["sessions"], cache_enabled=False)
+
+        async def session_by_token(i):
+            await validator.validate(rand.choice(tokens))
+
+        operations["session by token"] = session_by_token
+    return operations
+
+
+async def main(uri: str, sizes: List[int], tenants: int, skew: float, queries: int, save: str | None):
+    # every call reaches the database, and no debug log is timed with it
+    cache_settings.cache_enabled = False
+    logging.getLogger().setLevel(logging.WARNING)
+    engine = create_async_engine(uri)
+    generator = DataGenerator(engine, tenants=tenants, skew=skew)
+    await generator.prepare()
+    curves: Dict[str, List[dict]] = {}
+    for size in sizes:
+        stats = await generator.load(size)
+        async with engine.begin() as conn:
+            await conn.execute(text("ANALYZE"))
+        tokens = []
+        if "sessions" in generator.tables:
+            async with engine.connect() as conn:
+                sessions = generator.tables["sessions"]
+                tokens = list((await conn.execute(select(sessions.c.auth_token).limit(1000))).scalars())
+        print(f"{size} users, {stats.users} added in {stats.elapsed_s}s")
+        for name, operation in _operations(engine, generator, tokens, tenants).items():
+            curves.setdefault(name, []).append({"users": size, **await _measure(operation, queries)})
+    await engine.dispose()
+
+    print(f"\n{'operation':<24}" + "".join(f"{size:>18}" for size in sizes) + f"{'p95 growth':>12}")
+    print(f"{'':<24}" + "".join(f"{'p50/p95 ms':>18}" for _ in sizes))
+    for name, points in curves.items():
+        cells = "".join(f"{point['p50_ms']:>9.2f}/{point['p95_ms']:<8.2f}" for point in points)
+        growth = points[-1]["p95_ms"] / max(points[0]["p95_ms"], 1e-9)
+        print(f"{name:<24}{cells}{growth:>11.1f}x")
+    if save:
+        with open(save, "w") as f:
+            json.dump({"tenants": tenants, "skew": skew, "queries": queries, "curves": curves}, f, indent=2)
+        print(f"\nsaved to {save}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--uri", default="sqlite+aiosqlite:////tmp/melody_scaling.db")
+    parser.add_argument("--sizes", default="10000,100000,1000000", help="comma separated numbers of users")
+    parser.add_argument("--tenants", type=int, default=1000)
+    parser.add_argument("--skew", type=float, default=1.1)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--save", default=None, help="write the curves to this json file")
+    args = parser.parse_args()
+    sizes = sorted(int(size) for size in args.sizes.split(","))
+    asyncio.run(main(args.uri, sizes, args.tenants, args.skew, args.queries, args.save))
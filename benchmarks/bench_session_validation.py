@@ -0,0 +1,125 @@
+"""Session token validation latency at a fixed arrival rate: without and with the validated session cache, and
+signed tokens verified locally against a revocation list.
+
+Validations arrive open loop at --rate per second for --seconds, tokens drawn from --sessions sessions with
+a Zipf-like skew (a few active users call the api most). Latency is measured from the scheduled arrival,
+so a validator that falls behind shows its queueing delay instead of silently lowering the rate.
+The cache is warmed with every session first, as in a running service.
+
+The sessions table is melody_users.tables.Session, in sqlite.
+
+Usage:
+    python -m benchmarks.bench_session_validation --rate 10000 --seconds 3 --sessions 10000
+"""
+
+import argparse
+import asyncio
+import random
+import statistics
+import uuid
+from datetime import datetime, timedelta
+
+from sqlalchemy import insert
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from melody_users.sessions import SessionValidator
+from melody_users.signed_sessions import RevocationList, SignedSessionTokens, SigningKeyring
+from melody_users.tables import Session
+
+sessions = Session.__table__
+
+TICK = 0.001
+
+
+async def _populate(engine, count: int) -> list:
+    expires_at = datetime.utcnow() + timedelta(days=1)
+    tokens = [uuid.uuid4().hex for _ in range(count)]
+    async with engine.begin() as conn:
+        await conn.run_sync(sessions.drop, checkfirst=True)
+        await conn.run_sync(sessions.create)
+        await conn.execute(
+            insert(sessions),
+            [{"user_id": uuid.uuid4(), "iden_id": uuid.uuid4(), "auth_token": t, "expires_at": expires_at} for t in tokens],
+        )
+    return tokens
+
+
+async def _run(name: str, validator, tokens: list, rate: int, seconds: float) -> dict:
+    rand = random.Random(7)
+    weights = [1 / (rank + 1) for rank in range(len(tokens))]
+    total = int(rate * seconds)
+    draws = rand.choices(tokens, weights=weights, k=total)
+    latencies, tasks = [], []
+    loop = asyncio.get_running_loop()
+
+    async def _validate(token: str, scheduled: float):
+        assert await validator.validate(token) is not None
+        latencies.append((loop.time() - scheduled) * 1000)
+
+    start = loop.time()
+    sent = 0
+    while sent < total:
+        now = loop.time()
+        due = min(total, int((now - start) * rate) + 1)
+        for i in range(sent, due):
+            tasks.append(asyncio.ensure_future(_validate(draws[i], start + i / rate)))
+        sent = due
+        await asyncio.sleep(TICK)
+    await asyncio.gather(*tasks)
+    elapsed = loop.time() - start
+
+    latencies.sort()
+    return {
+        "name": name,
+        "validations_per_s": round(total / elapsed),
+        "p50_ms": round(statistics.median(latencies), 3),
+        "p99_ms": round(latencies[int(len(latencies) * 0.99)], 3),
+        "p999_ms": round(latencies[int(len(latencies) * 0.999)], 3),
+        "db_loads": {"cache": lambda: validator.cache.stats.loads - len(tokens), "signed": lambda: 0}.get(
+            name, lambda: total
+        )(),
+    }
+
+
+async def main(rate: int, seconds: float, count: int, path: str):
+    engine = create_async_engine(f"sqlite+aiosqlite:///{path}")
+    tokens = await _populate(engine, count)
+    results = []
+    for name, cache_enabled in (("no-cache", False), ("cache", True)):
+        validator = SessionValidator(engine, sessions, cache_enabled=cache_enabled, max_size=count)
+        if cache_enabled:
+            # steady state of a running service, every session was validated once
+            for token in tokens:
+                await validator.validate(token)
+        results.append(await _run(name, validator, tokens, rate, seconds))
+    keyring = SigningKeyring({"k1": b"bench secret"}, active="k1")
+    revocations = RevocationList()
+    for i in range(count):
+        # revoked sessions of other users, looked up on every verification
+        revocations.add(f"revoked{i}", expires_at=float("inf"))
+    signed = SignedSessionTokens(keyring, revocations)
+    expires_at = datetime.utcnow() + timedelta(days=1)
+    signed_tokens = [
+        signed.issue(sid=t, user_id=uuid.uuid4(), iden_id=uuid.uuid4(), tenant_id=None, expires_at=expires_at)
+        for t in tokens
+    ]
+    results.append(await _run("signed", signed, signed_tokens, rate, seconds))
+    await engine.dispose()
+
+    print(f"target: {rate} validations/s for {seconds}s over {count} sessions")
+    print(f"{'mode':<10}{'achieved/s':>12}{'p50_ms':>10}{'p99_ms':>10}{'p999_ms':>10}{'db_loads':>10}")
+    for r in results:
+        print(
+            f"{r['name']:<10}{r['validations_per_s']:>12}{r['p50_ms']:>10}"
+            f"{r['p99_ms']:>10}{r['p999_ms']:>10}{r['db_loads']:>10}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rate", type=int, default=10000)
+    parser.add_argument("--seconds", type=float, default=3.0)
+    parser.add_argument("--sessions", type=int, default=10000)
+    parser.add_argument("--db", default="/tmp/melody_bench_sessions.db")
+    args = parser.parse_args()
+    asyncio.run(main(args.rate, args.seconds, args.sessions, args.db))
@@ -0,0 +1,252 @@
+"""Bulk-loads synthetic multi-tenant users, identities, sessions and oauth2 tokens, at any scale and skew.
+
+Users are spread over --tenants tenants by a Zipf law of exponent --skew: with the default 1.1 and 1000 tenants,
+the largest tenant holds about 18% of the users, the 10 largest about half, and the median tenant 0.02%.
+Every user has an EMAIL identity, some an OAUTH_GITHUB one, sessions (some expired) and oauth2 tokens.
+Loading is incremental, running again with more --users adds the missing ones with the same distribution.
+
+The user and identities tables are created if missing. sessions and oauth2_tokens, from melody_users, are
+filled only if they exist in the database, their columns are reflected.
+
+Usage:
+    python -m benchmarks.datagen --uri sqlite+aiosqlite:////tmp/melody_data.db --users 1000000 --tenants 1000
+    python -m benchmarks.datagen --uri postgresql+asyncpg://localhost/melody_bench --users 10000000 --skew 1.2
+"""
+
+import argparse
+import asyncio
+import bisect
+import itertools
+import random
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import Dict, List
+
+from pydantic import BaseModel
+from sqlalchemy import MetaData, Table, Uuid, func, insert, inspect, select
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+from sqlmodel import SQLModel
+
+from melody import utils
+from melody.identity.hashing import hash_password
+from melody.identity.tables import Identity
+from melody.user.tables import User
+
+# the password of every generated email identity
+PASSWORD = "datagen-password"
+# tenants of melody_users tables are uuids
+TENANT_NAMESPACE = uuid.UUID("6f1d6c2e-8a59-4a7c-9b1e-3d4c5b6a7f80")
+SAMPLES = 1000
+
+
+def tenant_name(index: int) -> str:
+    return f"tenant-{index:05d}"
+
+
+def tenant_weights(tenants: int, skew: float) -> List[float]:
+    """Zipf weights of the tenants, tenant 0 is the largest."""
+    return [1 / (rank + 1) ** skew for rank in range(tenants)]
+
+
+class LoadStats(BaseModel):
+    users: int = 0
+    identities: int = 0
+    sessions: int = 0
+    oauth2_tokens: int = 0
+    elapsed_s: float = 0.0
+
+
+class DataGenerator:
+    """Generates and bulk-loads the rows of `users` users, in chunks of `chunk_size` users per transaction.
+
+    The same `seed`, `tenants` and `skew` generate the same tenants of the users. `samples` keeps a uniform
+    sample of the loaded users, as (tenant_id, user_id, email), for lookups of benchmarks.
+
+    Examples
+    --------
+    >>> generator = DataGenerator(engine, tenants=1000, skew=1.1)
+    >>> await generator.prepare()
+    >>> await generator.load(1_000_000)
+    >>> tenant_id, user_id, email = random.choice(generator.samples)
+    """
+
+    def __init__(
+        self,
+        engine: AsyncEngine,
+        *,
+        tenants: int = 1000,
+        skew: float = 1.1,
+        seed: int = 7,
+        chunk_size: int = 5000,
+        oauth2_ratio: float = 0.3,
+        sessions_per_user: float = 1.5,
+        expired_ratio: float = 0.2,
+        tokens_per_user: float = 0.3,
+    ) -> None:
+        self._engine = engine
+        self._tenants = tenants
+        self._cum_weights = list(itertools.accumulate(tenant_weights(tenants, skew)))
+        self._seed = seed
+        self._chunk_size = chunk_size
+        self._oauth2_ratio = oauth2_ratio
+        self._sessions_per_user = sessions_per_user
+        self._expired_ratio = expired_ratio
+        self._tokens_per_user = tokens_per_user
+        self.tables: Dict[str, Table] = {}
+        self._credential = ""
+        self.loaded = 0
+        self.samples: List[tuple] = []
+        self._sampler = random.Random(seed)
+
+    async def prepare(self) -> None:
+        """Create the missing user and identities tables, and reflect sessions and oauth2_tokens."""
+        async with self._engine.begin() as conn:
+            await conn.run_sync(SQLModel.metadata.create_all, tables=[User.__table__, Identity.__table__])
+            names = await conn.run_sync(lambda sync_conn: inspect(sync_conn).get_table_names())
+            metadata = MetaData()
+            for name in ("sessions", "oauth2_tokens"):
+                if name in names:
+                    self.tables[name] = await conn.run_sync(lambda sync_conn: Table(name, metadata, autoload_with=sync_conn))
+            self.loaded = (await conn.execute(select(func.count()).select_from(User))).scalar()
+            if self.loaded:
+                # users loaded by a previous run, a full scan but only once
+                sql = select(User.tenant_id, User.id, User.email).order_by(func.random()).limit(SAMPLES)
+                self.samples = [tuple(row) for row in await conn.execute(sql)]
+        # hashed once, hashing every identity would take hours at scale
+        self._credential = await hash_password(PASSWORD)
+
+    def tenant_of(self, rand: random.Random) -> int:
+        return bisect.bisect(self._cum_weights, rand.random() * self._cum_weights[-1])
+
+    def _chunk(self, start: int, end: int, now: datetime) -> Dict[str, list]:
+        # a generator per chunk, the rows of user k do not depend on how the load was split
+        rand = random.Random(f"{self._seed}:{start}")
+        rows: Dict[str, list] = {"users": [], "identities": [], "sessions": [], "oauth2_tokens": []}
+        for k in range(start, end):
+            tenant = self.tenant_of(rand)
+            tenant_id = tenant_name(tenant)
+            user_id = uuid.UUID(int=rand.getrandbits(128), version=4)
+            email = f"user{k}@{tenant_id}.example.com"
+            created_at = now - timedelta(seconds=rand.uniform(0, 365 * 86400))
+            last_signin_at = created_at + (now - created_at) * rand.random()
+            rows["users"].append(
+                dict(
+                    id=user_id,
+                    tenant_id=tenant_id,
+                    username=f"user{k}",
+                    nickname=f"User {k}",
+                    email=email,
+                    phone="",
+                    status="ACTIVE",
+                    created_at=created_at,
+                    updated_at=created_at,
+                    last_signin_at=last_signin_at,
+                )
+            )
+            iden_id = uuid.UUID(int=rand.getrandbits(128), version=4)
+            identity = dict(
+                tenant_id=tenant_id,
+                user_id=user_id,
+                status="ACTIVE",
+                created_at=created_at,
+                updated_at=created_at,
+                last_signin_at=last_signin_at,
+            )
+            rows["identities"].append(
+                dict(identity, id=iden_id, iden_type="EMAIL", iden_value=email, credential=self._credential)
+            )
+            if rand.random() < self._oauth2_ratio:
+                rows["identities"].append(
+                    dict(identity, id=uuid.UUID(int=rand.getrandbits(128), version=4), iden_type="OAUTH_GITHUB", iden_value=str(k), credential=None)
+                )
+            # reservoir sampling, with its own generator
+            if len(self.samples) < SAMPLES:
+                self.samples.append((tenant_id, user_id, email))
+            elif self._sampler.random() < SAMPLES / (k + 1):
+                self.samples[self._sampler.randrange(SAMPLES)] = (tenant_id, user_id, email)
+
+            # melody_users tables, naive utc timestamps
+            owner = dict(tenant_id=uuid.uuid5(TENANT_NAMESPACE, tenant_id), user_id=user_id, created_at=now.replace(tzinfo=None))
+            sessions = int(self._sessions_per_user) + (rand.random() < self._sessions_per_user % 1)
+            for _ in range(sessions if "sessions" in self.tables else 0):
+                expired = rand.random() < self._expired_ratio
+                expires_at = now + timedelta(days=rand.uniform(-30, 0) if expired else rand.uniform(0, 30))
+                rows["sessions"].append(
+                    dict(
+                        owner,
+                        id=uuid.UUID(int=rand.getrandbits(128), version=4),
+                        iden_id=iden_id,
+                        auth_token=uuid.UUID(int=rand.getrandbits(128), version=4).hex,
+                        sid=uuid.UUID(int=rand.getrandbits(128), version=4).hex,
+                        expires_at=expires_at.replace(tzinfo=None),
+                        user_agent="datagen",
+                        ip_address=f"10.{k % 256}.{rand.randrange(256)}.{rand.randrange(256)}",
+                    )
+                )
+            if "oauth2_tokens" in self.tables and rand.random() < self._tokens_per_user:
+                rows["oauth2_tokens"].append(
+                    dict(
+                        owner,
+                        id=uuid.UUID(int=rand.getrandbits(128), version=4),
+                        provider="github",
+                        client_id="datagen",
+                        access_token=uuid.UUID(int=rand.getrandbits(128), version=4).hex,
+                        refresh_token=uuid.UUID(int=rand.getrandbits(128), version=4).hex,
+                        expires_at=(now + timedelta(hours=rand.uniform(-24, 24))).replace(tzinfo=None),
+                        scope="read:user",
+                    )
+                )
+        return rows
+
+    def _filter(self, table: Table, rows: list) -> list:
+        # reflected tables may lack some of the generated columns, and uuids are stored as hex without a Uuid type
+        columns = {key for key in rows[0] if key in table.c}
+        as_hex = {key for key in columns if not isinstance(table.c[key].type, Uuid)}
+        return [
+            {key: value.hex if key in as_hex and isinstance(value, uuid.UUID) else value for key, value in row.items() if key in columns}
+            for row in rows
+        ]
+
+    async def load(self, users: int) -> LoadStats:
+        """Load users until `users` are in the database, returns the rows added."""
+        stats = LoadStats()
+        started = time.perf_counter()
+        now = utils.utc_now()
+        tables = {"users": User.__table__, "identities": Identity.__table__, **self.tables}
+        for start in range(self.loaded, users, self._chunk_size):
+            end = min(users, start + self._chunk_size)
+            rows = self._chunk(start, end, now)
+            async with self._engine.begin() as conn:
+                for name, table in tables.items():
+                    if rows[name]:
+                        values = self._filter(table, rows[name]) if name in self.tables else rows[name]
+                        await conn.execute(insert(table), values)
+                        setattr(stats, name, getattr(stats, name) + len(values))
+            self.loaded = end
+        stats.elapsed_s = round(time.perf_counter() - started, 3)
+        return stats
+
+
+async def main(uri: str, users: int, tenants: int, skew: float, chunk_size: int):
+    engine = create_async_engine(uri)
+    generator = DataGenerator(engine, tenants=tenants, skew=skew, chunk_size=chunk_size)
+    await generator.prepare()
+    print(f"{generator.loaded} users loaded, loading up to {users} over {tenants} tenants, skew {skew}")
+    stats = await generator.load(users)
+    await engine.dispose()
+    print(
+        f"added {stats.users} users, {stats.identities} identities, {stats.sessions} sessions, "
+        f"{stats.oauth2_tokens} oauth2 tokens in {stats.elapsed_s}s ({stats.users / max(stats.elapsed_s, 1e-9):.0f} users/s)"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--uri", default="sqlite+aiosqlite:////tmp/melody_data.db")
+    parser.add_argument("--users", type=int, default=100000)
+    parser.add_argument("--tenants", type=int, default=1000)
+    parser.add_argument("--skew", type=float, default=1.1)
+    parser.add_argument("--chunk-size", type=int, default=5000)
+    args = parser.parse_args()
+    asyncio.run(main(args.uri, args.users, args.tenants, args.skew, args.chunk_size))
@@ -0,0 +1,171 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Tuple
+
+from pydantic import BaseModel
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+logger = logging.getLogger("melody.cache")
+
+MISSING = object()
+
+_PENDING_INVALIDATIONS = "melody.cache.pending_invalidations"
+
+
+class CacheStats(BaseModel):
+    """Counters of a cache, `coalesced` counts lookups that waited on another caller's load."""
+
+    hits: int = 0
+    misses: int = 0
+    loads: int = 0
+    coalesced: int = 0
+    evictions: int = 0
+    expirations: int = 0
+    invalidations: int = 0
+
+
+class TTLCache:
+    """A bounded in-process LRU cache whose entries expire after a TTL.
+
+    `get_or_load()` is a read-through lookup with single-flight protection: concurrent misses of one key
+    share a single load. A key invalidated while its load is in flight does not store the (possibly stale)
+    loaded value. None is a cacheable value, so lookups of missing records are cached too, for `negative_ttl`
+    seconds if given.
+
+    The cache is local to the process, other workers may serve stale entries for up to `ttl` seconds.
+
+    Examples
+    --------
+    >>> cache = TTLCache(max_size=10000, ttl=60)
+    >>> user = await cache.get_or_load(user_id, lambda: load_user(user_id))
+    >>> cache.invalidate(user_id)
+    """
+
+    def __init__(
+        self,
+        max_size: int,
+        ttl: float,
+        negative_ttl: float | None = None,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        if max_size <= 0:
+            raise ValueError(f"max_size must be positive, got {max_size}")
+        self._max_size = max_size
+        self._ttl = ttl
+        self._negative_ttl = ttl if negative_ttl is None else negative_ttl
+        self._clock = clock
+        self._entries: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+        self._inflight: Dict[Hashable, asyncio.Future] = {}
+        self.stats = CacheStats()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable) -> Any:
+        """Get a cached value, MISSING if the key is not cached or expired."""
+        entry = self._entries.get(key, None)
+        if entry is None:
+            self.stats.misses += 1
+            return MISSING
+        expires_at, value = entry
+        if expires_at <= self._clock():
+            del self._entries[key]
+            self.stats.expirations += 1
+            self.stats.misses += 1
+            return MISSING
+        self._entries.move_to_end(key)
+        self.stats.hits += 1
+        return value
+
+    def peek(self, key: Hashable) -> Any:
+        """Get a cached value without counting it or refreshing its LRU position, MISSING if not cached."""
+        entry = self._entries.get(key, None)
+        if entry is None or entry[0] <= self._clock():
+            return MISSING
+        return entry[1]
+
+    def set(self, key: Hashable, value: Any, ttl: float | None = None) -> None:
+        if ttl is None:
+            ttl = self._negative_ttl if value is None else self._ttl
+        self._entries[key] = (self._clock() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
+            self.stats.evictions += 1
+
+    def invalidate(self, key: Hashable) -> None:
+        """Drop a key, and make an in-flight load of the key not store its result."""
+        self._inflight.pop(key, None)
+        if self._entries.pop(key, None) is not None:
+            self.stats.invalidations += 1
+
+    def clear(self) -> None:
+        self._inflight.clear()
+        self._entries.clear()
+
+    async def get_or_load(
+        self, key: Hashable, loader: Callable[[], Awaitable[Any]], ttl: float | None = None, store: bool = True
+    ) -> Any:
+        """Get a cached value, or load and cache it. Concurrent misses of the same key share one load.
+
+        With store=False, a miss is loaded by the caller and not cached, e.g. if the loader may read stale data.
+        """
+        value = self.get(key)
+        if value is not MISSING:
+            return value
+        if not store:
+            return await loader()
+        future = self._inflight.get(key, None)
+        if future is not None:
+            self.stats.coalesced += 1
+            # shield, so that a cancelled waiter does not cancel the load shared with others
+            return await asyncio.shield(future)
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            self.stats.loads += 1
+            value = await loader()
+        except BaseException as e:
+            if self._inflight.get(key, None) is future:
+                del self._inflight[key]
+            if isinstance(e, asyncio.CancelledError):
+                future.cancel()
+            else:
+                future.set_exception(e)
+                # mark the exception retrieved, there may be no waiter
+                future.exception()
+            raise
+        if self._inflight.get(key, None) is future:
+            del self._inflight[key]
+            self.set(key, value, ttl=ttl)
+        future.set_result(value)
+        return value
+
+
+def snapshot(record):
+    """A detached copy of a table record, safe to share between sessions through a cache."""
+    if record is None:
+        return None
+    return type(record).model_validate(record.model_dump())
+
+
+def invalidate_after_commit(session, cache: TTLCache, key: Hashable) -> None:
+    """Invalidate the key now, and again when the session's transaction ends.
+
+    Between the write and the commit, other sessions still read (and may cache) the old row,
+    the second invalidation drops such entries once the write is visible.
+    """
+    cache.invalidate(key)
+    sync_session = getattr(session, "sync_session", session)
+    sync_session.info.setdefault(_PENDING_INVALIDATIONS, []).append((cache, key))
+
+
+@event.listens_for(Session, "after_commit")
+@event.listens_for(Session, "after_rollback")
+def _run_pending_invalidations(session: Session) -> None:
+    for cache, key in session.info.pop(_PENDING_INVALIDATIONS, []):
+        cache.invalidate(key)
@@ -1,11 +1,207 @@
+from typing import Dict, List
+
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 
 class DatabaseSettings(BaseSettings):
     model_config = SettingsConfigDict(env_file=".env", extra="ignore")
     database_uri: str = "sqlite://melody.db"
+    # connections kept open, up to conn_pool_max_size are opened under load
     conn_pool_min_size: int = 5
     conn_pool_max_size: int = 20
+    # max seconds to wait for a free connection
+    conn_pool_timeout: float = 30.0
+    # seconds after which a connection is replaced, -1 disables recycling
+    conn_pool_recycle: int = 1800
+    # test connections with a ping when they are checked out
+    conn_pool_pre_ping: bool = True
+    # read replicas, e.g. REPLICA_URIS='["postgresql+asyncpg://replica-1/melody"]', reads use the primary if empty
+    replica_uris: List[str] = []
+    # seconds between two health checks of the replicas
+    replica_health_check_interval: float = 5.0
+    # seconds a client is served from the primary after a write, should exceed the replication lag
+    read_your_writes_seconds: float = 5.0
 
 
 database_settings = DatabaseSettings()
+
+
+class HashingSettings(BaseSettings):
+    model_config = SettingsConfigDict(env_file=".env", extra="ignore")
+    # "process" runs bcrypt in a process pool, "thread" in a thread pool.
+    hashing_executor: str = "process"
+    # number of hashing workers, 0 means os.cpu_count()
+    hashing_pool_size: int = 0
+    # algorithm of new password hashes: bcrypt, scrypt or argon2
+    password_hasher: str = "bcrypt"
+    # bcrypt rounds, log2 of scrypt N or argon2 time cost, 0 means the algorithm default
+    password_hasher_cost: int = 0
+    # target verify latency in milliseconds for the startup calibration, 0 disables calibration
+    password_hasher_target_ms: float = 0
+    # max concurrent password verifications, 0 means the hashing pool size
+    verify_max_concurrency: int = 0
+    # max verifications waiting for a slot, further requests are rejected immediately
+    verify_max_queue: int = 64
+    # max seconds a verification may wait for a slot
+    verify_timeout: float = 2.0
+
+
+hashing_settings = HashingSettings()
+
+
+class CacheSettings(BaseSettings):
+    model_config = SettingsConfigDict(env_file=".env", extra="ignore")
+    # read-through cache of users and identities, local to each worker process
+    cache_enabled: bool = True
+    cache_max_size: int = 10000
+    # seconds, also the max staleness of other workers after a write
+    cache_ttl: float = 60.0
+    # oauth providers and clients rarely change, unknown ones are cached shortly
+    oauth2_cache_ttl: float = 300.0
+    oauth2_negative_cache_ttl: float = 30.0
+
+
+cache_settings = CacheSettings()
+
+
+class TracingSettings(BaseSettings):
+    model_config = SettingsConfigDict(env_file=".env", extra="ignore")
+    # record latency and row counts of every statement, grouped by fingerprint
+    query_tracing_enabled: bool = True
+    # statements slower than this (milliseconds) are logged to "melody.sql.slow", 0 disables the log
+    slow_query_ms: float = 200
+    # capture the plan of slow SELECT statements with EXPLAIN
+    slow_query_explain: bool = False
+    # min seconds between two EXPLAINs of the same fingerprint
+    slow_query_explain_interval: float = 60
+    # max distinct fingerprints tracked, further statements are grouped under "other"
+    query_tracing_max_fingerprints: int = 1000
+
+
+tracing_settings = TracingSettings()
+
+
+class ShardSettings(BaseSettings):
+    model_config = SettingsConfigDict(env_file=".env", extra="ignore")
+    # shards besides the default one (database_uri), e.g. SHARD_URIS='{"eu-1": "postgresql+asyncpg://eu-1/melody"}'
+    shard_uris: Dict[str, str] = {}
+    # static tenant assignments, e.g. TENANT_SHARDS='{"acme": "eu-1"}', other tenants live in the default shard
+    tenant_shards: Dict[str, str] = {}
+    # look tenants up in the tenant_shards table of the default shard first, required to move tenants online
+    shard_directory_enabled: bool = False
+    # seconds a directory lookup is cached, also how long a tenant move waits for every process to see a change
+    shard_directory_ttl: float = 30.0
+
+
+shard_settings = ShardSettings()
+
+
+class SweeperSettings(BaseSettings):
+    model_config = SettingsConfigDict(env_file=".env", extra="ignore")
+    # delete expired oauth2 states, sessions and oauth2 tokens in the background
+    sweeper_enabled: bool = True
+    # seconds between two runs of the sweeper
+    sweeper_interval: float = 60.0
+    # seconds expired rows are kept, e.g. SWEEPER_RETENTIONS='{"sessions": 86400}' overrides it per table
+    sweeper_retention: float = 0.0
+    sweeper_retentions: Dict[str, float] = {}
+    # rows deleted per statement, seconds to sleep between statements, and max statements per run
+    sweeper_batch_size: int = 500
+    sweeper_batch_pause: float = 0.1
+    sweeper_max_batches: int = 100
+
+
+sweeper_settings = SweeperSettings()
+
+
+class WriteBehindSettings(BaseSettings):
+    model_config = SettingsConfigDict(env_file=".env", extra="ignore")
+    # write last_signin_at and Session.refreshed_at in batches in the background, instead of on every login.
+    # The buffers must be started and stopped: melody.deps.lifespan, or UserService.start_write_behind() and aclose()
+    write_behind_enabled: bool = False
+    # seconds between two flushes, and pending keys flushed at once
+    write_behind_flush_interval: float = 1.0
+    write_behind_flush_size: int = 1000
+    # pending keys kept at most, and rows updated per statement
+    write_behind_max_pending: int = 100000
+    write_behind_batch_size: int = 500
+
+
+write_behind_settings = WriteBehindSettings()
+
+
+class StateStoreSettings(BaseSettings):
+    model_config = SettingsConfigDict(env_file=".env", extra="ignore")
+    # where oauth2 states live until their callback: database or redis (shared by processes), memory or local
+    # (per process, only for a single process, callbacks must reach the process of the authorization)
+    state_store_backend: str = "database"
+    # url of the redis backend, e.g. redis://localhost:6379/0
+    state_store_url: str = ""
+    # max states held by the memory and local backends, the oldest are evicted beyond it
+    state_store_max_size: int = 100000
+    # seconds a user has to complete an oauth2 authorization
+    oauth2_state_ttl: float = 60.0
+
+
+state_store_settings = StateStoreSettings()
+
+
+class ProviderHTTPSettings(BaseSettings):
+    model_config = SettingsConfigDict(env_file=".env", extra="ignore")
+    # seconds, of a whole request and of connecting to an oauth2 provider
+    provider_http_timeout: float = 10.0
+    provider_http_connect_timeout: float = 5.0
+    # connections per provider, and idle connections kept alive for keepalive_expiry seconds
+    provider_http_max_connections: int = 100
+    provider_http_max_keepalive_connections: int = 20
+    provider_http_keepalive_expiry: float = 60.0
+    # requires the h2 package
+    provider_http2: bool = True
+    # seconds, of a provider call including retries, and of each attempt
+    provider_http_deadline: float = 10.0
+    provider_http_attempt_timeout: float = 5.0
+    # attempts per call, with full jitter backoff between base and max seconds
+    provider_http_max_attempts: int = 3
+    provider_http_backoff_base: float = 0.05
+    provider_http_backoff_max: float = 1.0
+    # retries and hedges may add this ratio of the calls, plus a few per second
+    provider_http_retry_ratio: float = 0.2
+    provider_http_min_retries_per_second: float = 1.0
+    # seconds before a second userinfo request is sent, raised to the p95 latency once known, 0 disables hedging
+    provider_http_hedge_delay: float = 0.0
+    # consecutive failures opening the circuit of a provider, and seconds before a probe call is let through
+    provider_breaker_failure_threshold: int = 5
+    provider_breaker_recovery_timeout: float = 30.0
+
+
+provider_http_settings = ProviderHTTPSettings()
+
+
+class SessionSettings(BaseSettings):
+    model_config = SettingsConfigDict(env_file=".env", extra="ignore")
+    # validated sessions cached in each process, never served past their expires_at
+    session_cache_enabled: bool = True
+    session_cache_max_size: int = 100000
+    # seconds, also how long other processes may accept a revoked session
+    session_cache_ttl: float = 30.0
+    # seconds unknown tokens are cached
+    session_negative_cache_ttl: float = 5.0
+    # "stateful": random tokens validated against the sessions table
+    # "signed": HMAC-signed tokens verified locally, revocations synced from the sessions table
+    session_mode: str = "stateful"
+    # seconds a new session is valid
+    session_ttl: float = 7 * 86400
+    # key id to secret of the signing keys, e.g. {"2024-01": "..."}, the active one signs new tokens
+    session_signing_keys: Dict[str, str] = {}
+    session_signing_key_id: str = ""
+    # key id to unix time, tokens signed by a retired key are rejected from then on
+    session_retired_keys: Dict[str, float] = {}
+    # seconds the previous key keeps verifying after a rotation at runtime
+    session_key_grace: float = 86400.0
+    # seconds between syncs of the revoked sessions, how long other processes may accept a revoked token
+    session_revocation_sync_interval: float = 5.0
+    # revoked sessions not expired yet the bloom filter is sized for, it grows past it
+    session_revocation_capacity: int = 100000
+
+
+session_settings = SessionSettings()
@@ -1,9 +1,32 @@
 import uuid
-from datetime import datetime, timezone
+from contextlib import asynccontextmanager
+from datetime import datetime
+from typing import Any, AsyncIterator, List, Mapping
 
 import sqlalchemy as sa
+from pydantic import SecretStr
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine
 from sqlmodel import Field, SQLModel
 
+from melody import utils
+
+
+class SecretString(sa.types.TypeDecorator):
+    """Store a SecretStr as plain string, and load it back as SecretStr."""
+
+    impl = sa.String
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if isinstance(value, SecretStr):
+            return value.get_secret_value()
+        return value
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return SecretStr(value)
+
 
 class BaseModel(SQLModel):
 
@@ -21,14 +44,14 @@ class BaseModel(SQLModel):
 
     created_at: datetime = Field(
         nullable=False,
-        default=datetime.now(timezone.utc),
+        default_factory=utils.utc_now,
         title="created_at",
         description="Timestamp of record creation",
     )
 
     updated_at: datetime = Field(
         nullable=False,
-        default=datetime.now(timezone.utc),
+        default_factory=utils.utc_now,
         title="updated_at",
         description="Timestamp of record update",
     )
@@ -54,3 +77,51 @@ class BaseModel(SQLModel):
         if self.deleted_at <= 0:
             return False
         return True
+
+
+class Database:
+    """Raw query access through the engine's pool, in the style of the `databases` package.
+
+    Queries are text or SQLAlchemy core statements, values are bound parameters. Each call outside of
+    `transaction()` runs in its own transaction on a pooled connection.
+
+    Examples
+    --------
+    >>> database = Database(engine)
+    >>> rows = await database.fetch_all("SELECT id FROM user WHERE tenant_id = :tenant_id", {"tenant_id": "t1"})
+    >>> async with database.transaction() as conn:
+    ...     await conn.execute(sa.text("UPDATE user SET status = 'INACTIVE' WHERE id = :id"), {"id": id})
+    """
+
+    def __init__(self, engine: AsyncEngine) -> None:
+        self.engine = engine
+
+    @staticmethod
+    def _statement(query: str | sa.Executable) -> sa.Executable:
+        return sa.text(query) if isinstance(query, str) else query
+
+    @asynccontextmanager
+    async def transaction(self) -> AsyncIterator[AsyncConnection]:
+        async with self.engine.begin() as conn:
+            yield conn
+
+    async def fetch_all(self, query: str | sa.Executable, values: Mapping[str, Any] | None = None) -> List[sa.RowMapping]:
+        async with self.transaction() as conn:
+            return list((await conn.execute(self._statement(query), values)).mappings().all())
+
+    async def fetch_one(self, query: str | sa.Executable, values: Mapping[str, Any] | None = None) -> sa.RowMapping | None:
+        async with self.transaction() as conn:
+            return (await conn.execute(self._statement(query), values)).mappings().first()
+
+    async def fetch_val(self, query: str | sa.Executable, values: Mapping[str, Any] | None = None) -> Any:
+        async with self.transaction() as conn:
+            return (await conn.execute(self._statement(query), values)).scalar()
+
+    async def execute(self, query: str | sa.Executable, values: Mapping[str, Any] | None = None) -> int:
+        """Execute a statement, returns the number of affected rows."""
+        async with self.transaction() as conn:
+            return (await conn.execute(self._statement(query), values)).rowcount
+
+    async def disconnect(self) -> None:
+        """Close all pooled connections, e.g. at shutdown."""
+        await self.engine.dispose()
@@ -1,25 +1,181 @@
+import json
+import time
+from contextlib import asynccontextmanager
 from typing import Annotated, TypeAlias
 
-from databases import Database
-from fastapi import Depends
-from sqlalchemy.ext.asyncio import create_async_engine
+from fastapi import Depends, HTTPException, Request, Response, status
 from sqlmodel.ext.asyncio.session import AsyncSession
 
-from .config import database_settings
+from .config import database_settings, shard_settings, write_behind_settings
+from .db import Database
+from .identity.crud import register_signin_targets
+from .pool import create_engine
+from .replicas import READ_YOUR_WRITES_COOKIE, SAFE_METHODS, ReplicaRouter, mark_read_only, primary_until
+from .shard.router import DEFAULT_SHARD, ConfigShardLookup, DirectoryShardLookup, ShardMap, TenantReadOnlyError
+from .tenancy import scope_session, session_tenant
+from .tracing import install_query_tracer
+from .write_behind import WriteBehindBuffer
 
-engine = create_async_engine(database_settings.database_uri)
+# the tenant of a request, in this header or in a tenant_id param, picks its shard and scopes its session
+TENANT_HEADER = "X-Tenant-Id"
+# the tenant of requests without tenant, and the default tenant_id of records
+DEFAULT_TENANT = ""
 
+# the only connection pool of the process, sized by DatabaseSettings, see melody.pool.pool_stats()
+engine = create_engine(database_settings)
+# per-statement latency histograms and slow-query log, None if disabled
+query_tracer = install_query_tracer(engine)
 
-async def database_session():
-    async with AsyncSession(engine) as session:
+replica_router = ReplicaRouter(
+    engine,
+    [create_engine(database_settings.model_copy(update={"database_uri": uri})) for uri in database_settings.replica_uris],
+    health_check_interval=database_settings.replica_health_check_interval,
+)
+
+shard_lookup = ConfigShardLookup(shard_settings.tenant_shards)
+if shard_settings.shard_directory_enabled:
+    shard_lookup = DirectoryShardLookup(engine, ttl=shard_settings.shard_directory_ttl, fallback=shard_lookup)
+shard_map = ShardMap(
+    {
+        DEFAULT_SHARD: engine,
+        **{
+            name: create_engine(database_settings.model_copy(update={"database_uri": uri}))
+            for name, uri in shard_settings.shard_uris.items()
+        },
+    },
+    lookup=shard_lookup,
+)
+
+if query_tracer is not None:
+    for other_engine in replica_router.replicas + [e for e in shard_map.engines.values() if e is not engine]:
+        query_tracer.install(other_engine)
+
+
+def request_tenant(request: Request) -> str | None:
+    return request.headers.get(TENANT_HEADER, None) or request.query_params.get("tenant_id", None) or None
+
+
+def scoped_tenant(tenant_id: str | None) -> str:
+    """The tenant a session is scoped to: a request without tenant is of the default tenant "", the default
+    tenant_id of records and requests, never of every tenant.
+    """
+    return tenant_id or DEFAULT_TENANT
+
+
+async def _body_tenant(request: Request) -> str | None:
+    """tenant_id of a json object body, None if there is none. The body is read once, and cached by the request."""
+    if not request.headers.get("content-type", "").startswith("application/json"):
+        return None
+    try:
+        body = json.loads(await request.body())
+    except ValueError:
+        return None
+    tenant_id = body.get("tenant_id", None) if isinstance(body, dict) else None
+    return tenant_id if isinstance(tenant_id, str) else None
+
+
+async def write_tenant(request: Request) -> str | None:
+    """The tenant of a write: of the request, or of the body creating records, which must not contradict each other."""
+    tenant_id, body_tenant = request_tenant(request), await _body_tenant(request)
+    if tenant_id is not None and body_tenant is not None and body_tenant != tenant_id:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"tenant_id {body_tenant} of the body is not the tenant {tenant_id} of the request",
+        )
+    return tenant_id if tenant_id is not None else body_tenant or None
+
+
+async def database_session(request: Request, response: Response):
+    write = request.method not in SAFE_METHODS
+    tenant_id = scoped_tenant(await write_tenant(request) if write else request_tenant(request))
+    session_engine = engine
+    if shard_map.sharded:
+        try:
+            session_engine = await shard_map.engine_for(tenant_id, write=write)
+        except TenantReadOnlyError as e:
+            raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=e.message, headers={"Retry-After": "5"})
+    if write and replica_router.replicas:
+        # serve the reads of this client from the primary until the replicas caught up with its writes
+        window = database_settings.read_your_writes_seconds
+        response.set_cookie(
+            READ_YOUR_WRITES_COOKIE, f"{time.time() + window:.3f}", max_age=int(window) + 1, httponly=True, samesite="lax"
+        )
+    async with AsyncSession(session_engine) as session:
+        scope_session(session, tenant_id)
         yield session
 
 
 DatabaseSession: TypeAlias = Annotated[AsyncSession, Depends(database_session)]
 
 
-database = Database(
-    database_settings.database_uri,
-    min_size=database_settings.conn_pool_min_size,
-    max_size=database_settings.conn_pool_max_size,
-)
+def check_tenant(session: AsyncSession, tenant_id: str) -> None:
+    """Reject with 422 a record of `tenant_id` written in a session of another tenant, it would land in its shard."""
+    scoped = session_tenant(session)
+    if scoped is not None and tenant_id != scoped:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"tenant_id {tenant_id} of the body is not the tenant {scoped} of the request",
+        )
+
+
+async def read_engine(tenant_id: str | None, primary: bool = False):
+    """The engine of reads of a tenant: its shard, or a replica of the default shard unless primary is True."""
+    if shard_map.sharded:
+        shard_engine = await shard_map.engine_for(tenant_id)
+        if shard_engine is not engine:
+            return shard_engine
+    return replica_router.engine_for_read(primary=primary)
+
+
+async def read_only_database_session(request: Request):
+    """A read-only session, bound to a replica unless the client wrote within the read-your-writes window."""
+    tenant_id = scoped_tenant(request_tenant(request))
+    recent_write = primary_until(request.cookies) > time.time()
+    session_engine = await read_engine(tenant_id, primary=recent_write)
+    async with AsyncSession(session_engine) as session:
+        mark_read_only(session, replica=session_engine in replica_router.replicas)
+        scope_session(session, tenant_id)
+        yield session
+
+
+ReadOnlyDatabaseSession: TypeAlias = Annotated[AsyncSession, Depends(read_only_database_session)]
+
+
+# raw queries share the pool of the engine
+database = Database(engine)
+
+
+def _signin_buffer() -> WriteBehindBuffer | None:
+    if not write_behind_settings.write_behind_enabled:
+        return None
+    buffer = WriteBehindBuffer(
+        # values are written to the shard of their tenant as of the flush, and wait while the tenant is moved
+        shard_map if shard_map.sharded else engine,
+        max_pending=write_behind_settings.write_behind_max_pending,
+        flush_size=write_behind_settings.write_behind_flush_size,
+        flush_interval=write_behind_settings.write_behind_flush_interval,
+        batch_size=write_behind_settings.write_behind_batch_size,
+    )
+    return register_signin_targets(buffer)
+
+
+# last_signin_at written in batches, None if disabled, started and stopped by lifespan()
+signin_buffer = _signin_buffer()
+
+
+@asynccontextmanager
+async def lifespan(app):
+    """Start the background work of the routers at startup, and stop it at shutdown: the write-behind of
+    last_signin_at, whose pending values are flushed before the application exits.
+
+    Examples
+    --------
+    >>> app = FastAPI(lifespan=deps.lifespan)
+    """
+    if signin_buffer is not None:
+        signin_buffer.start()
+    try:
+        yield
+    finally:
+        if signin_buffer is not None:
+            await signin_buffer.stop()
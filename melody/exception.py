@@ -0,0 +1,11 @@
+class MelodyException(Exception):
+    """Base exception class"""
+
+    def __init__(self, code: str, message: str, **kwargs) -> None:
+        super().__init__(message)
+        self.code = code
+        self.message = message
+        self.kwargs = kwargs
+
+    def __str__(self) -> str:
+        return f"{self.code}: {self.message}"
@@ -0,0 +1,84 @@
+import csv
+import io
+import json
+import uuid
+from datetime import date, datetime
+from enum import Enum
+from typing import Any, AsyncIterator, List, Mapping, Sequence
+
+from pydantic import SecretStr
+from sqlalchemy import Select, Table
+
+
+class ExportFormat(str, Enum):
+    NDJSON = "ndjson"
+    CSV = "csv"
+
+    @property
+    def media_type(self) -> str:
+        if self is ExportFormat.CSV:
+            return "text/csv"
+        return "application/x-ndjson"
+
+
+def exported_columns(table: Table, exclude: Sequence[str] = ()) -> list:
+    """Columns of the table to export, without the excluded (e.g. secret) ones."""
+    return [c for c in table.columns if c.name not in exclude]
+
+
+async def stream_rows(session, sql: Select, batch_size: int) -> AsyncIterator[List[Mapping[str, Any]]]:
+    """Stream the rows of a core select in batches of at most batch_size rows.
+
+    Rows are fetched from a server-side cursor, so only one batch is held in memory at a time.
+    Select columns rather than entities, so that rows do not pile up in the session's identity map.
+    """
+    result = await session.stream(sql.execution_options(yield_per=batch_size))
+    async for rows in result.mappings().partitions(batch_size):
+        yield rows
+
+
+def _to_json(value: Any) -> Any:
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, uuid.UUID):
+        return str(value)
+    if isinstance(value, SecretStr):
+        raise TypeError("secrets must not be exported")
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def _to_cell(value: Any) -> Any:
+    if value is None:
+        return ""
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, default=_to_json, ensure_ascii=False)
+    if isinstance(value, (datetime, date, uuid.UUID, SecretStr)):
+        return _to_json(value)
+    return value
+
+
+async def encode_ndjson(batches: AsyncIterator[List[Mapping[str, Any]]]) -> AsyncIterator[str]:
+    async for rows in batches:
+        if rows:
+            yield "".join(json.dumps(dict(row), default=_to_json, ensure_ascii=False) + "\n" for row in rows)
+
+
+async def encode_csv(batches: AsyncIterator[List[Mapping[str, Any]]]) -> AsyncIterator[str]:
+    header = None
+    async for rows in batches:
+        if not rows:
+            continue
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        if header is None:
+            header = list(rows[0].keys())
+            writer.writerow(header)
+        writer.writerows([_to_cell(row[name]) for name in header] for row in rows)
+        yield buffer.getvalue()
+
+
+def encode(batches: AsyncIterator[List[Mapping[str, Any]]], format: ExportFormat) -> AsyncIterator[str]:
+    """Encode batches of rows incrementally, one chunk of text per batch."""
+    if format is ExportFormat.CSV:
+        return encode_csv(batches)
+    return encode_ndjson(batches)
@@ -1,19 +1,33 @@
 import logging
 import uuid
-from typing import List
+from typing import Any, AsyncIterator, List, Mapping
 
-import bcrypt
 from sqlalchemy import delete, insert, select, update
+from sqlalchemy.exc import IntegrityError
 from sqlmodel.ext.asyncio.session import AsyncSession
 
 from melody import utils
+from melody.cache import MISSING, TTLCache, invalidate_after_commit, snapshot
+from melody.config import cache_settings
+from melody.export import exported_columns, stream_rows
+from melody.pagination import Page, make_page, paginate
+from melody.replicas import is_replica_session
+from melody.tenancy import is_visible, unscoped
+from melody.user.crud import create_users, user_cache
+from melody.user.models import UserCreateRequest
+from melody.user.tables import User
+from melody.write_behind import WriteBehindBuffer
 
+from .exception import IdentityError, IdentityException
+from .hashing import hash_password, needs_rehash, verify_dummy_password, verify_limiter, verify_password
 from .models import (
     EmailIdentityCreateRequest,
+    EmailIdentityLoginRequest,
     EmailIdentityPatchRequest,
     EmailIdentityResetPasswordRequest,
     EmailIdentityUpdateRequest,
     OAuth2IdentityCreateRequest,
+    OAuth2IdentityLoginRequest,
     OAuth2IdentityPatchRequest,
     OAuth2IdentityUpdateRequest,
 )
@@ -21,28 +35,149 @@ from .tables import Identity
 
 logger = logging.getLogger("melody.identity")
 
+# write-behind targets of last_signin_at, see register_signin_targets()
+IDENTITY_SIGNIN = "identities.last_signin_at"
+USER_SIGNIN = "user.last_signin_at"
+
+# read-through cache of identities, keyed by ("id", id) and ("iden", tenant_id, iden_type, iden_value)
+identity_cache = TTLCache(max_size=cache_settings.cache_max_size, ttl=cache_settings.cache_ttl)
+
+
+def _invalidate_identity(session: AsyncSession, *, id: uuid.UUID | None = None, identity: Identity | None = None) -> None:
+    """Invalidate the cached identity by id, and its (iden_type, iden_value) lookups before and after the write."""
+    keys = set()
+    if identity is not None:
+        id = identity.id
+        keys.add(("iden", identity.tenant_id, identity.iden_type, identity.iden_value))
+    if id is not None:
+        keys.add(("id", id))
+        cached = identity_cache.peek(("id", id))
+        if cached is not MISSING and cached is not None:
+            keys.add(("iden", cached.tenant_id, cached.iden_type, cached.iden_value))
+    for key in keys:
+        invalidate_after_commit(session, identity_cache, key)
+
+
+async def _cached_identity(session: AsyncSession, key: tuple, sql, cached: bool = True) -> Identity | None:
+    async def _load(sql) -> Identity | None:
+        identity = (await session.exec(sql)).scalars().first()
+        logger.debug("retrieved identity: %s", identity)
+        return snapshot(identity)
+
+    if not cached or not cache_settings.cache_enabled:
+        return await _load(sql)
+    # the cache is shared by all tenants, identities are loaded across tenants: a miss of a scoped session
+    # must not hide the identity from its tenant. Identities read from a replica may lag behind an invalidation,
+    # they are not cached
+    store = not is_replica_session(session)
+    identity = await identity_cache.get_or_load(key, lambda: _load(unscoped(sql)), store=store)
+    return identity if is_visible(session, identity) else None
+
 
 async def retrieve_identity(session: AsyncSession, *, id: uuid.UUID) -> Identity | None:
+    """Retrieve an identity by id, through `identity_cache` if caching is enabled. Cached identities are detached snapshots."""
+
     sql = select(Identity).where(Identity.id == id)
-    logger.debug(f"retrieving identity sql: {sql}")
-    identity = await session.exec(sql).first()
-    logger.debug(f"retrieved identity: {identity}")
-    return identity
+    logger.debug("retrieving identity sql: %s", sql)
+    return await _cached_identity(session, ("id", id), sql)
+
+
+async def retrieve_email_identity(
+    session: AsyncSession, *, tenant_id: str = "", email: str, cached: bool = True
+) -> Identity | None:
+    """Retrieve an EMAIL identity, through `identity_cache` if caching is enabled and cached is True.
+
+    Cached identities are detached snapshots, and may be stale for up to the cache ttl after a write by another
+    process: checks of credentials or status must pass cached=False.
+    """
+
+    sql = select(Identity).where(
+        Identity.tenant_id == tenant_id, Identity.iden_type == "EMAIL", Identity.iden_value == email
+    )
+    logger.debug("retrieving email identity sql: %s", sql)
+    return await _cached_identity(session, ("iden", tenant_id, "EMAIL", email), sql, cached=cached)
+
+
+async def retrieve_oauth2_identity(
+    session: AsyncSession, *, tenant_id: str = "", provider_id: str, provider_uid: str, cached: bool = True
+) -> Identity | None:
+    """Retrieve an OAUTH_<PROVIDER> identity, through `identity_cache` if caching is enabled and cached is True.
+
+    As in retrieve_email_identity(), checks of status must pass cached=False.
+    """
+    iden_type = "OAUTH_" + provider_id.upper()
+
+    sql = select(Identity).where(
+        Identity.tenant_id == tenant_id, Identity.iden_type == iden_type, Identity.iden_value == provider_uid
+    )
+    logger.debug("retrieving oauth identity sql: %s", sql)
+    return await _cached_identity(session, ("iden", tenant_id, iden_type, provider_uid), sql, cached=cached)
 
 
-async def retrieve_identities_by_user_id(session: AsyncSession, *, user_id: uuid.UUID) -> List[Identity] | None:
+async def retrieve_identities_by_user_id(
+    session: AsyncSession, *, user_id: uuid.UUID, tenant_id: str | None = None
+) -> List[Identity] | None:
+    """Identities of a user, of the tenant if given, else of the tenant of a scoped session, else of any tenant."""
     sql = select(Identity).where(Identity.user_id == user_id)
-    logger.debug(f"retrieving identity sql: {sql}")
-    identities = await session.exec(sql).all()
-    logger.debug(f"retrieved identity: {identities}")
+    if tenant_id is not None:
+        sql = sql.where(Identity.tenant_id == tenant_id)
+    logger.debug("retrieving identity sql: %s", sql)
+    identities = list((await session.exec(sql)).scalars().all())
+    logger.debug("retrieved identity: %s", identities)
     return identities
 
 
+async def list_identities(
+    session: AsyncSession,
+    *,
+    tenant_id: str,
+    iden_type: str | None = None,
+    status: str | None = None,
+    deleted: bool = False,
+    cursor: str | None = None,
+    limit: int = 50,
+) -> Page[Identity]:
+    """List identities of a tenant ordered by (created_at, id), with keyset pagination.
+
+    If deleted is True, only soft deleted identities are listed, otherwise only identities not deleted.
+    Raises ValueError if the cursor is malformed.
+    """
+    sql = select(Identity).where(Identity.tenant_id == tenant_id)
+    if iden_type:
+        sql = sql.where(Identity.iden_type == iden_type)
+    if status:
+        sql = sql.where(Identity.status == status)
+    sql = sql.where(Identity.deleted_at.is_not(None) if deleted else Identity.deleted_at.is_(None))
+    sql = paginate(sql, Identity, cursor=cursor, limit=limit)
+    logger.debug("listing identities sql: %s", sql)
+    page = make_page((await session.exec(sql)).scalars().all(), limit)
+    logger.debug("listed %s identities, next cursor: %s", len(page.items), page.next_cursor)
+    return page
+
+
+async def stream_identities(
+    session: AsyncSession, *, tenant_id: str, batch_size: int = 1000
+) -> AsyncIterator[List[Mapping[str, Any]]]:
+    """Stream all identities of a tenant as row mappings, in batches from a server-side cursor.
+
+    The credential column is never selected.
+    """
+    sql = (
+        select(*exported_columns(Identity.__table__, exclude=("credential",)))
+        .where(Identity.tenant_id == tenant_id)
+        .order_by(Identity.created_at, Identity.id)
+    )
+    logger.debug("streaming identities sql: %s", sql)
+    async for rows in stream_rows(session, sql, batch_size):
+        yield rows
+
+
 async def create_oauth2_identity(session: AsyncSession, *, request: OAuth2IdentityCreateRequest) -> Identity:
     sql = (
         insert(Identity)
         .values(
-            user_id=request,
+            tenant_id=request.tenant_id,
+            user_id=request.user_id,
             iden_type="OAUTH_" + request.provider_id.upper(),
             iden_value=request.provider_uid,
             credential=None,
@@ -52,9 +187,10 @@ async def create_oauth2_identity(session: AsyncSession, *, request: OAuth2Identi
         )
         .returning(Identity)
     )
-    logger.debug(f"created oauth identity sql: {sql}")
-    identity = await session.exec(sql).one()
-    logger.debug(f"created oauth identity: {identity}")
+    logger.debug("created oauth identity sql: %s", sql)
+    identity = (await session.exec(sql)).scalars().one()
+    _invalidate_identity(session, identity=identity)
+    logger.debug("created oauth identity: %s", identity)
     return identity
 
 
@@ -63,9 +199,10 @@ async def update_oauth2_identity(
 ) -> Identity | None:
     values = request.model_dump()
     sql = update(Identity).where(Identity.id == id).values(**values, updated_at=utils.utc_now()).returning(Identity)
-    logger.debug(f"updated oauth identity sql: {sql}")
-    identity = await session.exec(sql).one()
-    logger.debug(f"updated oauth identity: {identity}")
+    logger.debug("updated oauth identity sql: %s", sql)
+    identity = (await session.exec(sql)).scalars().first()
+    _invalidate_identity(session, id=id, identity=identity)
+    logger.debug("updated oauth identity: %s", identity)
     return identity
 
 
@@ -77,42 +214,46 @@ async def patch_oauth2_identity(
         logger.info(f"no data to patch, skipped.")
         return None
     sql = update(Identity).where(Identity.id == id).values(**values, updated_at=utils.utc_now()).returning(Identity)
-    logger.debug(f"patch oauth identity sql: {sql}")
-    identity = await session.exec(sql).one()
-    logger.debug(f"patch oauth identity: {identity}")
+    logger.debug("patch oauth identity sql: %s", sql)
+    identity = (await session.exec(sql)).scalars().first()
+    _invalidate_identity(session, id=id, identity=identity)
+    logger.debug("patch oauth identity: %s", identity)
     return identity
 
 
 async def delete_identity(session: AsyncSession, *, id: uuid.UUID, soft_delete: bool = False) -> Identity | None:
     if soft_delete:
-        sql = (
-            update(Identity).where(Identity.id == id).values(status="DELETED", deleted_at=utils.utc_now()).returning(Identity)
-        )
+        now = utils.utc_now()
+        sql = update(Identity).where(Identity.id == id).values(status="DELETED", deleted_at=now, updated_at=now).returning(Identity)
     else:
         sql = delete(Identity).where(Identity.id == id).returning(Identity)
-    logger.debug(f"delete identity sql: {sql}")
+    logger.debug("delete identity sql: %s", sql)
 
-    identity: Identity = await session.exec(sql).first()
-    logger.debug(f"deleted identity (soft={soft_delete}): {identity}")
+    identity: Identity = (await session.exec(sql)).scalars().first()
+    _invalidate_identity(session, id=id, identity=identity)
+    logger.debug("deleted identity (soft=%s): %s", soft_delete, identity)
     return identity
 
 
 async def create_email_identity(session: AsyncSession, *, request: EmailIdentityCreateRequest) -> Identity:
-    credential = bcrypt.hashpw(request.password.encode("utf-8"), bcrypt.gensalt()).decode("utf-8")
-    values = request.model_dump(exclude_none=True)
+    credential = await hash_password(request.password)
+    values = request.model_dump(exclude_none=True, exclude={"email", "password"})
     sql = (
         insert(Identity)
         .values(
             **values,
+            iden_type="EMAIL",
+            iden_value=request.email,
             credential=credential,
             status="ACTIVE",
             last_signin_at=None,
         )
         .returning(Identity)
     )
-    logger.debug(f"created email identity sql: {sql}")
-    identity: Identity = await session.exec(sql).one()
-    logger.debug(f"created email identity: {identity}")
+    logger.debug("created email identity sql: %s", sql)
+    identity: Identity = (await session.exec(sql)).scalars().one()
+    _invalidate_identity(session, identity=identity)
+    logger.debug("created email identity: %s", identity)
     return identity
 
 
@@ -125,9 +266,10 @@ async def update_email_identity(
         logger.info(f"email identity {id} not changed, skipped to update.")
         return None
     sql = update(Identity).where(Identity.id == id).values(**values, updated_at=utils.utc_now()).returning(Identity)
-    logger.debug(f"update email identity sql: {sql}")
-    identity: Identity = await session.exec(sql).first()
-    logger.debug(f"updated email identity: {identity}")
+    logger.debug("update email identity sql: %s", sql)
+    identity: Identity = (await session.exec(sql)).scalars().first()
+    _invalidate_identity(session, id=id, identity=identity)
+    logger.debug("updated email identity: %s", identity)
     return identity
 
 
@@ -135,21 +277,151 @@ async def patch_email_identity(session: AsyncSession, *, id: uuid.UUID, request:
     """Patch email identity. All fields to patch are optional."""
     values = request.model_dump(exclude_unset=True)
     sql = update(Identity).where(Identity.id == id).values(**values, updated_at=utils.utc_now()).returning(Identity)
-    logger.debug(f"patch email identity sql: {sql}")
-    identity: Identity = await session.exec(sql).first()
-    logger.debug(f"patched email identity: {identity}")
+    logger.debug("patch email identity sql: %s", sql)
+    identity: Identity = (await session.exec(sql)).scalars().first()
+    _invalidate_identity(session, id=id, identity=identity)
+    logger.debug("patched email identity: %s", identity)
     return identity
 
 
 async def reset_email_password(session: AsyncSession, *, request: EmailIdentityResetPasswordRequest) -> Identity | None:
-    credential = bcrypt.hashpw(request.password.encode("utf-8"), bcrypt.gensalt()).decode("utf-8")
+    credential = await hash_password(request.password)
     sql = (
         update(Identity)
-        .where(Identity.iden_type == "EMAIL", Identity.iden_value == request.email)
+        .where(
+            Identity.tenant_id == request.tenant_id, Identity.iden_type == "EMAIL", Identity.iden_value == request.email
+        )
         .values(credential=credential, updated_at=utils.utc_now())
         .returning(Identity)
     )
-    logger.debug(f"reset email password sql: {sql}")
-    identity: Identity = await session.exec(sql).first()
-    logger.debug(f"upated email identity: {identity}")
+    logger.debug("reset email password sql: %s", sql)
+    identity: Identity = (await session.exec(sql)).scalars().first()
+    invalidate_after_commit(session, identity_cache, ("iden", request.tenant_id, "EMAIL", request.email))
+    _invalidate_identity(session, identity=identity)
+    logger.debug("upated email identity: %s", identity)
+    return identity
+
+
+def register_signin_targets(buffer: WriteBehindBuffer) -> WriteBehindBuffer:
+    """Register last_signin_at of identities and users in the buffer, to pass it to the logins as `last_seen`."""
+    # updated_at is bumped with it, tenant moves copy the rows changed since a pass by updated_at
+    buffer.register(IDENTITY_SIGNIN, Identity.__table__, key="id", column="last_signin_at", touch="updated_at")
+    buffer.register(USER_SIGNIN, User.__table__, key="id", column="last_signin_at", touch="updated_at")
+    return buffer
+
+
+async def _update_last_signin(
+    session: AsyncSession, identity: Identity, values: dict, last_seen: WriteBehindBuffer | None
+) -> Identity:
+    now = utils.utc_now()
+    if last_seen is not None:
+        # written later in a batch, the cached identity and user keep their previous last_signin_at until then
+        await last_seen.record(IDENTITY_SIGNIN, identity.id, now, tenant_id=identity.tenant_id)
+        await last_seen.record(USER_SIGNIN, identity.user_id, now, tenant_id=identity.tenant_id)
+        if not values:
+            # a copy, the cached identity is shared
+            identity = snapshot(identity)
+            identity.last_signin_at = now
+            return identity
+    else:
+        values["last_signin_at"] = now
+    values["updated_at"] = now
+    sql = update(Identity).where(Identity.id == identity.id).values(**values).returning(Identity)
+    logger.debug("login identity sql: %s", sql)
+    identity = (await session.exec(sql)).scalars().one()
+    if last_seen is None:
+        await session.exec(update(User).where(User.id == identity.user_id).values(last_signin_at=now, updated_at=now))
+        invalidate_after_commit(session, user_cache, identity.user_id)
+    _invalidate_identity(session, identity=identity)
+    return identity
+
+
+async def login_with_email(
+    session: AsyncSession, *, request: EmailIdentityLoginRequest, last_seen: WriteBehindBuffer | None = None
+) -> Identity:
+    """Verify email and password, and update last_signin_at of the identity and its user.
+
+    last_signin_at is updated in the transaction of the session, or by `last_seen` if given, a WriteBehindBuffer
+    with the targets of register_signin_targets(), sparing the writes to the rows of frequent users.
+
+    If the stored hash was written with other parameters than the default hasher, it is replaced with a new hash.
+
+    Password verification runs under `verify_limiter`, which raises LimiterSaturatedError or
+    LimiterTimeoutError when too many logins are in flight.
+    Raises IdentityException if the identity does not exist, is not active, or the password mismatches.
+    """
+    # from the database, a password reset or deactivation by another process applies at once
+    identity = await retrieve_email_identity(session, tenant_id=request.tenant_id, email=request.email, cached=False)
+    hashed = None
+    if identity is not None and identity.status == "ACTIVE" and identity.credential is not None:
+        hashed = identity.credential.get_secret_value()
+    values = {}
+    async with verify_limiter.acquire():
+        if hashed is None:
+            # as slow as a real verification, the response time does not tell whether the email is registered
+            verified = await verify_dummy_password(request.password)
+        else:
+            verified = await verify_password(request.password, hashed)
+        if verified and needs_rehash(hashed):
+            # upgrade hashes written with an old algorithm or cost, while we have the plain password
+            values["credential"] = await hash_password(request.password)
+    if not verified:
+        raise IdentityException.from_error(IdentityError.INVALID_CREDENTIALS)
+
+    identity = await _update_last_signin(session, identity, values, last_seen)
+    logger.debug("login email identity: %s", identity)
+    return identity
+
+
+async def _create_oauth2_login(session: AsyncSession, request: OAuth2IdentityLoginRequest) -> Identity:
+    user_request = UserCreateRequest(
+        tenant_id=request.tenant_id, username=request.username, nickname=request.nickname, email=request.email
+    )
+    (user,) = await create_users(session, requests=[user_request])
+    identity_request = OAuth2IdentityCreateRequest(
+        tenant_id=request.tenant_id,
+        user_id=user.id,
+        provider_id=request.provider_id,
+        provider_uid=request.provider_uid,
+        props=request.props,
+    )
+    return await create_oauth2_identity(session, request=identity_request)
+
+
+async def login_with_oauth2(
+    session: AsyncSession, *, request: OAuth2IdentityLoginRequest, last_seen: WriteBehindBuffer | None = None
+) -> Identity:
+    """Sign in with an oauth2 identity, creating its user and identity on first login, and update last_signin_at.
+
+    All writes happen in the transaction of the session, commit it to complete the login. last_signin_at is
+    written by `last_seen` if given, as in login_with_email().
+    Raises IdentityException if the identity is not active.
+    """
+
+    def _retrieve() -> Identity | None:
+        # the status is checked, read past the cache
+        return retrieve_oauth2_identity(
+            session,
+            tenant_id=request.tenant_id,
+            provider_id=request.provider_id,
+            provider_uid=request.provider_uid,
+            cached=False,
+        )
+
+    identity = await _retrieve()
+    if identity is None:
+        try:
+            # in a savepoint, a concurrent first login of the same identity may insert it first
+            async with session.begin_nested():
+                identity = await _create_oauth2_login(session, request)
+        except IntegrityError:
+            identity = await _retrieve()
+            if identity is None:
+                raise
+            logger.debug("oauth identity created by a concurrent login: %s", identity)
+    if identity.status != "ACTIVE":
+        raise IdentityException.from_error(IdentityError.INVALID_CREDENTIALS)
+
+    identity = await _update_last_signin(session, identity, {}, last_seen)
+    logger.debug("login oauth identity: %s", identity)
     return identity
@@ -6,6 +6,7 @@ from melody.exception import MelodyException
 class IdentityError(str, Enum):
     IDENTITY_NOT_FOUND = "error.identity.not_found:Identity not found."
     IDENTITY_ALREADY_EXISTS = "error.identity.already_exists:Identity already exists."
+    INVALID_CREDENTIALS = "error.identity.invalid_credentials:Invalid email or password."
 
 
 class IdentityException(MelodyException):
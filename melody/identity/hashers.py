@@ -0,0 +1,308 @@
+import abc
+import base64
+import hashlib
+import hmac
+import logging
+import os
+import statistics
+import time
+from typing import Dict, List
+
+import bcrypt
+
+logger = logging.getLogger("melody.identity")
+
+
+class PasswordHasher(abc.ABC):
+    """Abstract password hasher.
+
+    A hasher has a single tunable `cost`, the work factor that is raised by calibration.
+    Instances are plain picklable objects, so they can be shipped to the hashing process pool.
+    """
+
+    algorithm: str = ""
+    min_cost: int = 1
+    max_cost: int = 1
+    default_cost: int = 1
+
+    def __init__(self, cost: int | None = None) -> None:
+        cost = cost or self.default_cost
+        if not self.min_cost <= cost <= self.max_cost:
+            raise ValueError(f"{self.algorithm} cost must be in [{self.min_cost}, {self.max_cost}], got {cost}")
+        self.cost = cost
+
+    @abc.abstractmethod
+    def hash(self, password: str) -> str:
+        """Hash the password with the current parameters."""
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    def verify(self, password: str, hashed: str) -> bool:
+        """Verify the password against a hash produced by this algorithm, with any parameters."""
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    def identify(self, hashed: str) -> bool:
+        """Whether the hash was produced by this algorithm."""
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    def needs_rehash(self, hashed: str) -> bool:
+        """Whether the hash was produced with a lower cost, or other fixed parameters, than the current ones.
+
+        A higher cost is kept: processes calibrating to slightly different costs must not rehash back and forth.
+        """
+        raise NotImplementedError()
+
+    def with_cost(self, cost: int) -> "PasswordHasher":
+        """Return a hasher of the same algorithm with a different cost."""
+        return type(self)(cost=cost)
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}(cost={self.cost})"
+
+
+class BCryptHasher(PasswordHasher):
+    """bcrypt, cost is the log2 rounds."""
+
+    algorithm = "bcrypt"
+    min_cost = 4
+    max_cost = 31
+    default_cost = 12
+
+    def hash(self, password: str) -> str:
+        return bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt(rounds=self.cost)).decode("utf-8")
+
+    def verify(self, password: str, hashed: str) -> bool:
+        try:
+            return bcrypt.checkpw(password.encode("utf-8"), hashed.encode("utf-8"))
+        except ValueError:
+            # malformed hash, treat as a failed verification
+            return False
+
+    def identify(self, hashed: str) -> bool:
+        return hashed.startswith(("$2a$", "$2b$", "$2y$"))
+
+    def needs_rehash(self, hashed: str) -> bool:
+        try:
+            return int(hashed.split("$")[2]) < self.cost
+        except (IndexError, ValueError):
+            return True
+
+
+class ScryptHasher(PasswordHasher):
+    """scrypt from hashlib, cost is log2 of N. Hashes look like `$scrypt$ln=15,r=8,p=1$<salt>$<hash>`."""
+
+    algorithm = "scrypt"
+    min_cost = 10
+    max_cost = 22
+    default_cost = 15
+
+    block_size = 8
+    parallelism = 1
+    salt_size = 16
+    hash_size = 64
+
+    def _derive(self, password: str, salt: bytes, log_n: int, r: int, p: int) -> bytes:
+        n = 1 << log_n
+        return hashlib.scrypt(
+            password.encode("utf-8"),
+            salt=salt,
+            n=n,
+            r=r,
+            p=p,
+            maxmem=256 * n * r + 1024 * 1024,
+            dklen=self.hash_size,
+        )
+
+    def hash(self, password: str) -> str:
+        salt = os.urandom(self.salt_size)
+        digest = self._derive(password, salt, self.cost, self.block_size, self.parallelism)
+        return "$scrypt$ln={},r={},p={}${}${}".format(
+            self.cost, self.block_size, self.parallelism, _b64encode(salt), _b64encode(digest)
+        )
+
+    def _parse(self, hashed: str):
+        _, algorithm, params, salt, digest = hashed.split("$")
+        if algorithm != self.algorithm:
+            raise ValueError(f"not a scrypt hash: {algorithm}")
+        params = dict(x.split("=", 1) for x in params.split(","))
+        return int(params["ln"]), int(params["r"]), int(params["p"]), _b64decode(salt), _b64decode(digest)
+
+    def verify(self, password: str, hashed: str) -> bool:
+        try:
+            log_n, r, p, salt, digest = self._parse(hashed)
+        except (KeyError, ValueError):
+            return False
+        return hmac.compare_digest(self._derive(password, salt, log_n, r, p), digest)
+
+    def identify(self, hashed: str) -> bool:
+        return hashed.startswith("$scrypt$")
+
+    def needs_rehash(self, hashed: str) -> bool:
+        try:
+            log_n, r, p, _, _ = self._parse(hashed)
+        except (KeyError, ValueError):
+            return True
+        return log_n < self.cost or (r, p) != (self.block_size, self.parallelism)
+
+
+class Argon2Hasher(PasswordHasher):
+    """argon2id, cost is the time cost (iterations). Requires the optional `argon2-cffi` package."""
+
+    algorithm = "argon2"
+    min_cost = 1
+    max_cost = 32
+    default_cost = 3
+
+    memory_cost = 64 * 1024
+    parallelism = 4
+
+    def __init__(self, cost: int | None = None) -> None:
+        super().__init__(cost=cost)
+        try:
+            import argon2  # noqa: F401
+        except ImportError as e:
+            raise ImportError("argon2 hasher requires argon2-cffi, install it with `pip install argon2-cffi`") from e
+
+    def _hasher(self):
+        import argon2
+
+        return argon2.PasswordHasher(time_cost=self.cost, memory_cost=self.memory_cost, parallelism=self.parallelism)
+
+    def hash(self, password: str) -> str:
+        return self._hasher().hash(password)
+
+    def verify(self, password: str, hashed: str) -> bool:
+        import argon2
+
+        try:
+            return self._hasher().verify(hashed, password)
+        except (argon2.exceptions.VerificationError, argon2.exceptions.InvalidHashError):
+            return False
+
+    def identify(self, hashed: str) -> bool:
+        return hashed.startswith("$argon2")
+
+    def needs_rehash(self, hashed: str) -> bool:
+        import argon2
+
+        try:
+            params = argon2.extract_parameters(hashed)
+        except argon2.exceptions.InvalidHashError:
+            return True
+        return (
+            params.type != argon2.Type.ID
+            or params.time_cost < self.cost
+            or params.memory_cost < self.memory_cost
+            or params.parallelism != self.parallelism
+        )
+
+
+def _b64encode(data: bytes) -> str:
+    return base64.b64encode(data).decode("ascii").rstrip("=")
+
+
+def _b64decode(data: str) -> bytes:
+    return base64.b64decode(data + "=" * (-len(data) % 4))
+
+
+class PasswordHasherRegistry:
+    """Password hasher registry.
+
+    The default hasher is used for new hashes, while all registered hashers can verify existing ones,
+    so a deployment can switch algorithm or cost and upgrade old hashes on the next successful login.
+    """
+
+    def __init__(self) -> None:
+        self._hashers: Dict[str, PasswordHasher] = {}
+        self._default: str | None = None
+
+    def register(self, hasher: PasswordHasher, default: bool = False) -> None:
+        """Register a hasher, replacing any hasher of the same algorithm.
+
+        Parameters
+        ----------
+        hasher : PasswordHasher
+            The hasher to register.
+        default : bool
+            Whether to use this hasher for new hashes.
+
+        Examples
+        --------
+        >>> hasher_registry.register(BCryptHasher(cost=13), default=True)
+        """
+        if hasher.algorithm in self._hashers:
+            logger.info(f"password hasher {hasher.algorithm} is already registered, replaced by {hasher}.")
+        self._hashers[hasher.algorithm] = hasher
+        if default or self._default is None:
+            self._default = hasher.algorithm
+
+    def get(self, algorithm: str) -> PasswordHasher | None:
+        return self._hashers.get(algorithm, None)
+
+    @property
+    def default(self) -> PasswordHasher:
+        if self._default is None:
+            raise ValueError("no password hasher registered.")
+        return self._hashers[self._default]
+
+    def identify(self, hashed: str) -> PasswordHasher | None:
+        """Find the registered hasher that produced the hash, None if unknown."""
+        for hasher in self._hashers.values():
+            if hasher.identify(hashed):
+                return hasher
+        return None
+
+    def needs_rehash(self, hashed: str) -> bool:
+        """Whether the hash should be replaced by one from the default hasher."""
+        default = self.default
+        if not default.identify(hashed):
+            return True
+        return default.needs_rehash(hashed)
+
+
+hasher_classes: Dict[str, type] = {
+    BCryptHasher.algorithm: BCryptHasher,
+    ScryptHasher.algorithm: ScryptHasher,
+    Argon2Hasher.algorithm: Argon2Hasher,
+}
+
+
+def create_hasher(algorithm: str, cost: int | None = None) -> PasswordHasher:
+    """Create a hasher by algorithm name, e.g. `bcrypt`, `scrypt` or `argon2`."""
+    cls = hasher_classes.get(algorithm, None)
+    if cls is None:
+        raise ValueError(f"unknown password hasher: {algorithm}, available: {sorted(hasher_classes)}")
+    return cls(cost=cost or None)
+
+
+def measure_verify_latency(hasher: PasswordHasher, samples: int = 3) -> float:
+    """Median seconds of one verification with the hasher's current cost."""
+    hashed = hasher.hash("calibration-password")
+    timings: List[float] = []
+    for _ in range(samples):
+        start = time.perf_counter()
+        hasher.verify("calibration-password", hashed)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def calibrate(hasher: PasswordHasher, target_seconds: float, samples: int = 3) -> PasswordHasher:
+    """Find the highest cost whose verify latency stays within target_seconds on this machine.
+
+    Never goes below the algorithm's minimum cost, so the result may exceed the target on very slow hardware.
+    This is blocking and CPU bound, run it at startup, in the hashing pool.
+    """
+    best = hasher.with_cost(hasher.min_cost)
+    cost = hasher.min_cost
+    while cost <= hasher.max_cost:
+        candidate = hasher.with_cost(cost)
+        latency = measure_verify_latency(candidate, samples=samples)
+        logger.debug(f"calibrating {candidate}: {latency * 1000:.1f}ms")
+        if latency > target_seconds:
+            break
+        best = candidate
+        cost += 1
+    logger.info(f"calibrated password hasher: {best}, target {target_seconds * 1000:.1f}ms")
+    return best
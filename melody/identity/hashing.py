@@ -0,0 +1,172 @@
+import asyncio
+import logging
+import os
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict
+
+from melody.config import hashing_settings
+from melody.limiter import ConcurrencyLimiter
+
+from .hashers import PasswordHasher, PasswordHasherRegistry, calibrate, create_hasher
+
+logger = logging.getLogger("melody.identity")
+
+
+def _hash_password(hasher: PasswordHasher, password: str) -> str:
+    return hasher.hash(password)
+
+
+def _verify_password(hasher: PasswordHasher, password: str, hashed: str) -> bool:
+    return hasher.verify(password, hashed)
+
+
+class HashingExecutor:
+    """Run CPU-bound password hashing off the event loop.
+
+    Hashing runs in a process pool by default, so that bcrypt does not compete with the event loop
+    for the GIL. If processes are not available (e.g. restricted sandboxes), or the pool breaks,
+    it falls back to a thread pool. bcrypt releases the GIL while hashing, so threads still keep
+    the event loop responsive, they just share the interpreter with it.
+
+    New hashes use the registry's default hasher, existing hashes are verified by the hasher that produced them.
+    Hashers are passed to the workers with every call, so workers always use the current (calibrated) parameters.
+    """
+
+    def __init__(
+        self,
+        max_workers: int | None = None,
+        use_processes: bool = True,
+        registry: PasswordHasherRegistry | None = None,
+    ) -> None:
+        self._max_workers = max_workers or os.cpu_count() or 1
+        self._use_processes = use_processes
+        self._executor: Executor | None = None
+        self.registry = registry or hasher_registry
+        # hashes of a throwaway password by hasher, see verify_dummy_password()
+        self._dummy_hashes: Dict[str, str] = {}
+
+    @property
+    def max_workers(self) -> int:
+        return self._max_workers
+
+    def _get_executor(self) -> Executor:
+        if self._executor is not None:
+            return self._executor
+        if self._use_processes:
+            try:
+                self._executor = ProcessPoolExecutor(max_workers=self._max_workers)
+                return self._executor
+            except (OSError, NotImplementedError, PermissionError) as e:
+                logger.warning(f"process pool is not available, fallback to thread pool: {e}")
+                self._use_processes = False
+        self._executor = ThreadPoolExecutor(max_workers=self._max_workers, thread_name_prefix="melody-hashing")
+        return self._executor
+
+    async def run(self, fn, *args):
+        """Run fn(*args) in the hashing pool and await the result."""
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(self._get_executor(), fn, *args)
+        except BrokenProcessPool:
+            logger.warning("hashing process pool is broken, fallback to thread pool.")
+            self.shutdown(wait=False)
+            self._use_processes = False
+            return await loop.run_in_executor(self._get_executor(), fn, *args)
+
+    async def hash_password(self, password: str) -> str:
+        """Hash the password with the default hasher."""
+        return await self.run(_hash_password, self.registry.default, password)
+
+    async def verify_password(self, password: str, hashed: str) -> bool:
+        """Verify the password against a hash of any registered algorithm."""
+        hasher = self.registry.identify(hashed)
+        if hasher is None:
+            logger.warning("unrecognized password hash, verification failed.")
+            return False
+        return await self.run(_verify_password, hasher, password, hashed)
+
+    async def verify_dummy_password(self, password: str) -> bool:
+        """Verify the password against a throwaway hash of the default hasher, always False.
+
+        Costs as much as a real verification, for logins of unknown identities: their response time
+        must not tell whether the identity exists. The hash is computed once per hasher parameters.
+        """
+        hasher = self.registry.default
+        key = repr(hasher)
+        hashed = self._dummy_hashes.get(key, None)
+        if hashed is None:
+            hashed = self._dummy_hashes[key] = await self.run(_hash_password, hasher, os.urandom(16).hex())
+        await self.run(_verify_password, hasher, password, hashed)
+        return False
+
+    def needs_rehash(self, hashed: str) -> bool:
+        """Whether the hash was produced by another algorithm, or a lower cost, than the default hasher."""
+        return self.registry.needs_rehash(hashed)
+
+    async def calibrate(self, target_seconds: float) -> PasswordHasher:
+        """Calibrate the cost of the default hasher in the pool, and register the result as default."""
+        hasher = await self.run(calibrate, self.registry.default, target_seconds)
+        self.registry.register(hasher, default=True)
+        return hasher
+
+    def shutdown(self, wait: bool = True) -> None:
+        """Shutdown the underlying pool. It will be re-created lazily on next use."""
+        executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait)
+
+
+hasher_registry = PasswordHasherRegistry()
+# keep bcrypt registered to verify existing hashes, even if another algorithm is the default
+if hashing_settings.password_hasher != "bcrypt":
+    hasher_registry.register(create_hasher("bcrypt"))
+hasher_registry.register(
+    create_hasher(hashing_settings.password_hasher, cost=hashing_settings.password_hasher_cost or None),
+    default=True,
+)
+
+hashing_executor = HashingExecutor(
+    max_workers=hashing_settings.hashing_pool_size or None,
+    use_processes=hashing_settings.hashing_executor == "process",
+)
+
+# gate for login verifications, so that a burst of logins fails fast instead of queueing on the pool
+verify_limiter = ConcurrencyLimiter(
+    max_concurrency=hashing_settings.verify_max_concurrency or hashing_executor.max_workers,
+    max_queue=hashing_settings.verify_max_queue,
+    timeout=hashing_settings.verify_timeout,
+)
+
+
+async def hash_password(password: str) -> str:
+    return await hashing_executor.hash_password(password)
+
+
+async def verify_password(password: str, hashed: str) -> bool:
+    return await hashing_executor.verify_password(password, hashed)
+
+
+async def verify_dummy_password(password: str) -> bool:
+    return await hashing_executor.verify_dummy_password(password)
+
+
+def needs_rehash(hashed: str) -> bool:
+    return hashing_executor.needs_rehash(hashed)
+
+
+async def calibrate_password_hasher(target_ms: float | None = None) -> PasswordHasher:
+    """Calibrate the default hasher to the target verify latency, call it once at application startup.
+
+    Examples
+    --------
+    >>> @asynccontextmanager
+    ... async def lifespan(app: FastAPI):
+    ...     await calibrate_password_hasher()
+    ...     yield
+    ...     hashing_executor.shutdown()
+    """
+    target_ms = target_ms or hashing_settings.password_hasher_target_ms
+    if not target_ms:
+        return hasher_registry.default
+    return await hashing_executor.calibrate(target_ms / 1000.0)
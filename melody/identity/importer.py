@@ -0,0 +1,272 @@
+import asyncio
+import csv
+import json
+import logging
+import os
+from pathlib import Path
+from typing import Any, AsyncIterable, AsyncIterator, Dict, Iterable, List, Tuple
+
+from pydantic import BaseModel, ValidationError
+from sqlalchemy import select
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from melody import utils
+from melody.shard.router import ShardMap
+
+from .hashing import HashingExecutor, hashing_executor
+from .models import EmailIdentityImportRow
+from .tables import Identity
+
+logger = logging.getLogger("melody.identity")
+
+
+class ImportProgress(BaseModel):
+    """Counters of an identity import, `offset` is the number of input rows already handled."""
+
+    offset: int = 0
+    created: int = 0
+    updated: int = 0
+    skipped: int = 0
+    failed: int = 0
+    hashed: int = 0
+    prehashed: int = 0
+
+
+def read_ndjson(path: str | Path) -> Iterable[Dict[str, Any]]:
+    """Read rows from a NDJSON file line by line, blank lines are ignored."""
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def read_csv(path: str | Path) -> Iterable[Dict[str, Any]]:
+    """Read rows from a CSV file with a header line. Empty cells are treated as missing, props is a JSON object."""
+    with open(path, "r", encoding="utf-8", newline="") as f:
+        for row in csv.DictReader(f):
+            row = {k: v for k, v in row.items() if v not in ("", None)}
+            if "props" in row:
+                row["props"] = json.loads(row["props"])
+            yield row
+
+
+class EmailIdentityImporter:
+    """Streaming import of EMAIL identities, for migrations from legacy systems.
+
+    Rows are read incrementally and processed in chunks. Plain passwords of a chunk are hashed in parallel
+    in the hashing pool, while the previous chunk is being written, and existing bcrypt hashes are stored as is.
+    Each chunk is written with one executemany INSERT and committed, conflicts on `ix_identities_tenant_iden` either skip
+    the row (`on_conflict="skip"`, existing rows are filtered out before hashing) or update it (`on_conflict="update"`).
+
+    With a `checkpoint_path`, progress is saved after every committed chunk. Running the importer again with
+    the same input and checkpoint resumes after the last committed chunk.
+
+    With a ShardMap instead of an engine, every chunk is written to the shard of the tenant as of that chunk,
+    and TenantReadOnlyError is raised while the tenant is being moved: resume from the checkpoint after the move.
+
+    Examples
+    --------
+    >>> importer = EmailIdentityImporter(engine, chunk_size=1000, checkpoint_path="import.ckpt")
+    >>> progress = await importer.run(read_ndjson("identities.ndjson"))
+    """
+
+    def __init__(
+        self,
+        engine: AsyncEngine | ShardMap,
+        *,
+        chunk_size: int = 1000,
+        on_conflict: str = "skip",
+        tenant_id: str = "",
+        checkpoint_path: str | Path | None = None,
+        executor: HashingExecutor | None = None,
+    ) -> None:
+        if on_conflict not in ("skip", "update"):
+            raise ValueError(f"on_conflict must be skip or update, got {on_conflict}")
+        if chunk_size <= 0:
+            raise ValueError(f"chunk_size must be positive, got {chunk_size}")
+        self._engine = engine
+        self._chunk_size = chunk_size
+        self._on_conflict = on_conflict
+        self._tenant_id = tenant_id
+        self._checkpoint_path = Path(checkpoint_path) if checkpoint_path else None
+        self._executor = executor or hashing_executor
+        self.progress = ImportProgress()
+
+    def _load_checkpoint(self) -> ImportProgress:
+        if self._checkpoint_path is None or not self._checkpoint_path.exists():
+            return ImportProgress()
+        progress = ImportProgress.model_validate_json(self._checkpoint_path.read_text(encoding="utf-8"))
+        logger.info(f"resuming identity import from checkpoint: {progress}")
+        return progress
+
+    def _save_checkpoint(self) -> None:
+        if self._checkpoint_path is None:
+            return
+        tmp = self._checkpoint_path.with_name(self._checkpoint_path.name + ".tmp")
+        tmp.write_text(self.progress.model_dump_json(), encoding="utf-8")
+        os.replace(tmp, self._checkpoint_path)
+
+    async def _chunks(self, rows: Iterable[Any] | AsyncIterable[Any]) -> AsyncIterator[List[Tuple[int, Any]]]:
+        chunk, index = [], 0
+        if isinstance(rows, AsyncIterable):
+            iterator = rows
+        else:
+
+            async def _iterate():
+                for row in rows:
+                    yield row
+
+            iterator = _iterate()
+        async for row in iterator:
+            if index >= self.progress.offset:
+                chunk.append((index, row))
+            index += 1
+            if len(chunk) >= self._chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def _validate(self, chunk: List[Tuple[int, Any]], delta: ImportProgress) -> Dict[str, EmailIdentityImportRow]:
+        # keyed by email, so a duplicated email within a chunk keeps the last row
+        valid: Dict[str, EmailIdentityImportRow] = {}
+        for index, row in chunk:
+            try:
+                row = EmailIdentityImportRow.model_validate(row)
+            except ValidationError as e:
+                delta.failed += 1
+                logger.warning(f"skipped invalid identity row {index}: {e.errors()}")
+                continue
+            if row.password_hash is None and row.password is None:
+                delta.failed += 1
+                logger.warning(f"skipped identity row {index}: password or password_hash is required.")
+                continue
+            if row.password_hash is not None and self._executor.registry.identify(row.password_hash) is None:
+                delta.failed += 1
+                logger.warning(f"skipped identity row {index}: unrecognized password_hash.")
+                continue
+            valid[row.email] = row
+        return valid
+
+    async def _existing_emails(self, session: AsyncSession, emails: List[str]) -> set:
+        sql = select(Identity.iden_value).where(
+            Identity.tenant_id == self._tenant_id, Identity.iden_type == "EMAIL", Identity.iden_value.in_(emails)
+        )
+        return set((await session.exec(sql)).scalars().all())
+
+    async def _prepare(self, session: AsyncSession, chunk: List[Tuple[int, Any]]):
+        # counters of this chunk, merged into progress only after the chunk is committed
+        delta = ImportProgress(offset=chunk[-1][0] + 1)
+        rows = self._validate(chunk, delta)
+        existing = await self._existing_emails(session, list(rows)) if rows else set()
+        if self._on_conflict == "skip":
+            delta.skipped += len(existing)
+            rows = {email: row for email, row in rows.items() if email not in existing}
+
+        plain = [row for row in rows.values() if row.password_hash is None]
+        hashes = await asyncio.gather(*[self._executor.hash_password(row.password) for row in plain])
+        credentials = dict(zip([row.email for row in plain], hashes))
+        delta.hashed += len(plain)
+        delta.prehashed += len(rows) - len(plain)
+
+        now = utils.utc_now()
+        values = [
+            {
+                "tenant_id": self._tenant_id,
+                "user_id": row.user_id,
+                "iden_type": "EMAIL",
+                "iden_value": row.email,
+                "credential": credentials.get(row.email, row.password_hash),
+                "status": "ACTIVE",
+                "props": row.props or {},
+                "created_at": now,
+                "updated_at": now,
+            }
+            for row in rows.values()
+        ]
+        return values, existing, delta
+
+    def _insert_statement(self, dialect: str):
+        if dialect == "postgresql":
+            sql = postgresql.insert(Identity.__table__)
+        elif dialect == "sqlite":
+            sql = sqlite.insert(Identity.__table__)
+        else:
+            raise ValueError(f"identity import does not support dialect {dialect}")
+        index_elements = ["tenant_id", "iden_type", "iden_value"]
+        if self._on_conflict == "skip":
+            return sql.on_conflict_do_nothing(index_elements=index_elements)
+        return sql.on_conflict_do_update(
+            index_elements=index_elements,
+            set_={
+                "user_id": sql.excluded.user_id,
+                "credential": sql.excluded.credential,
+                "props": sql.excluded.props,
+                "updated_at": sql.excluded.updated_at,
+            },
+        )
+
+    async def _chunk_engine(self) -> AsyncEngine:
+        if isinstance(self._engine, ShardMap):
+            return await self._engine.engine_for(self._tenant_id, write=True)
+        return self._engine
+
+    async def _write(self, engine: AsyncEngine, values: List[dict], existing: set, delta: ImportProgress) -> None:
+        inserted = 0
+        async with AsyncSession(engine) as session:
+            if values:
+                sql = self._insert_statement(engine.dialect.name).returning(Identity.__table__.c.id)
+                inserted = len((await session.exec(sql, params=values)).all())
+            await session.commit()
+        if self._on_conflict == "update":
+            delta.updated += sum(1 for v in values if v["iden_value"] in existing)
+            delta.created += len(values) - delta.updated
+        else:
+            # rows inserted by someone else since _prepare() are skipped by the conflict clause
+            delta.created += inserted
+            delta.skipped += len(values) - inserted
+        for name, value in delta:
+            if name != "offset":
+                setattr(self.progress, name, getattr(self.progress, name) + value)
+        self.progress.offset = delta.offset
+        self._save_checkpoint()
+        logger.info(f"identity import progress: {self.progress}")
+
+    async def run(self, rows: Iterable[Any] | AsyncIterable[Any]) -> ImportProgress:
+        """Import the rows, each row is a mapping of EmailIdentityImportRow fields.
+
+        Returns the final progress. Rows before the checkpoint offset are skipped without being validated.
+        """
+        self.progress = self._load_checkpoint()
+        writing = None
+        try:
+            async for chunk in self._chunks(rows):
+                engine = await self._chunk_engine()
+                # hash this chunk while the previous one is being written
+                async with AsyncSession(engine) as read_session:
+                    values, existing, delta = await self._prepare(read_session, chunk)
+                if writing is not None:
+                    await writing
+                writing = asyncio.create_task(self._write(engine, values, existing, delta))
+            if writing is not None:
+                await writing
+        except BaseException:
+            if writing is not None and not writing.done():
+                writing.cancel()
+            raise
+        logger.info(f"identity import finished: {self.progress}")
+        return self.progress
+
+
+async def import_email_identities(engine: AsyncEngine | ShardMap, path: str | Path, **kwargs) -> ImportProgress:
+    """Import EMAIL identities from a .ndjson/.jsonl or .csv file, kwargs are passed to EmailIdentityImporter."""
+    suffix = Path(path).suffix.lower()
+    if suffix in (".ndjson", ".jsonl"):
+        rows = read_ndjson(path)
+    elif suffix == ".csv":
+        rows = read_csv(path)
+    else:
+        raise ValueError(f"unsupported import file: {path}, expected .ndjson, .jsonl or .csv")
+    return await EmailIdentityImporter(engine, **kwargs).run(rows)
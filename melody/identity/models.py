@@ -5,12 +5,23 @@ from sqlmodel import Field, SQLModel
 
 
 class OAuth2IdentityCreateRequest(SQLModel):
+    tenant_id: str = Field(default="", description="The tenant of the identity.")
     user_id: uuid.UUID = Field(nullable=False, description="The user id of this identity")
     provider_id: str = Field(nullable=False, description="Identity type, such as EMAIL, PHONE, OAUTH_GITHUB, OAUTH_GOOGLE")
     provider_uid: str = Field(nullable=False, description="Identity value, such as email address, phone number, or oauth uid.")
     props: dict | None = Field(nullable=True, description="Additional properties of the record")
 
 
+class OAuth2IdentityLoginRequest(SQLModel):
+    tenant_id: str = Field(default="", description="The tenant of the identity.")
+    provider_id: str = Field(nullable=False, description="The oauth2 provider, such as GITHUB, GOOGLE")
+    provider_uid: str = Field(nullable=False, description="The id of the user at the provider.")
+    username: str = Field(default="", description="The username of a user created on first login.")
+    nickname: str = Field(default="", description="The nickname of a user created on first login.")
+    email: str = Field(default="", description="The email of a user created on first login.")
+    props: dict | None = Field(default=None, nullable=True, description="Additional properties of the record")
+
+
 class OAuth2IdentityUpdateRequest(BaseModel):
     user_id: str = Field(nullable=False, description="The user id of this identity")
     provider_id: str = Field(nullable=False, description="Identity type, such as EMAIL, PHONE, OAUTH_GITHUB, OAUTH_GOOGLE")
@@ -32,6 +43,7 @@ class OAuth2IdentityPatchRequest(BaseModel):
 
 
 class EmailIdentityCreateRequest(SQLModel):
+    tenant_id: str = Field(default="", description="The tenant of the identity.")
     user_id: uuid.UUID = Field(nullable=False, description="The user id of this identity")
     email: str = Field(nullable=False, description="Identity value, such as email address, phone number, or oauth uid.")
     password: str = Field(nullable=False, description="Identity value, such as email address, phone number, or oauth uid.")
@@ -52,5 +64,22 @@ class EmailIdentityPatchRequest(SQLModel):
 
 
 class EmailIdentityResetPasswordRequest(SQLModel):
+    tenant_id: str = Field(default="", description="The tenant of the identity.")
     email: str = Field(nullable=False, description="Identity value, such as email address, phone number, or oauth uid.")
     password: str = Field(nullable=False, description="Identity value, such as email address, phone number, or oauth uid.")
+
+
+class EmailIdentityLoginRequest(SQLModel):
+    tenant_id: str = Field(default="", description="The tenant of the identity.")
+    email: str = Field(nullable=False, description="The email address of the identity.")
+    password: str = Field(nullable=False, description="The plain password to verify.")
+
+
+class EmailIdentityImportRow(SQLModel):
+    user_id: uuid.UUID = Field(nullable=False, description="The user id of this identity")
+    email: str = Field(nullable=False, description="The email address of the identity.")
+    password: str | None = Field(default=None, nullable=True, description="The plain password, hashed on import.")
+    password_hash: str | None = Field(
+        default=None, nullable=True, description="An existing password hash, such as bcrypt, stored as is."
+    )
+    props: dict | None = Field(default=None, nullable=True, description="Additional properties of the record")
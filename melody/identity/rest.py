@@ -1,18 +1,74 @@
 import uuid
 
-from fastapi import APIRouter
+from fastapi import APIRouter, HTTPException, Query, status
+from fastapi.responses import StreamingResponse
+from sqlmodel.ext.asyncio.session import AsyncSession
 
 from melody import deps
+from melody.export import ExportFormat, encode
+from melody.limiter import LimiterSaturatedError, LimiterTimeoutError
+from melody.pagination import Page
 
 from . import crud, models, tables
+from .exception import IdentityException
 
 router = APIRouter()
 
 
+@router.get("/identities:export")
+async def export_identities(
+    tenant_id: str,
+    format: ExportFormat = ExportFormat.NDJSON,
+    batch_size: int = Query(default=1000, ge=1, le=10000),
+) -> StreamingResponse:
+    """Export all identities of a tenant as NDJSON or CSV, streamed with flat memory regardless of the tenant size."""
+
+    export_engine = await deps.read_engine(tenant_id)
+
+    async def _content():
+        # the request scoped session is closed before the body is streamed, so the export owns its session
+        async with AsyncSession(export_engine) as session:
+            async for chunk in encode(crud.stream_identities(session, tenant_id=tenant_id, batch_size=batch_size), format):
+                yield chunk
+
+    filename = f"identities-{tenant_id or 'default'}.{format.value}"
+    return StreamingResponse(
+        _content(),
+        media_type=format.media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+
+@router.get("/identities")
+async def list_identities(
+    session: deps.ReadOnlyDatabaseSession,
+    tenant_id: str,
+    iden_type: str | None = None,
+    identity_status: str | None = Query(default=None, alias="status"),
+    deleted: bool = False,
+    cursor: str | None = None,
+    limit: int = Query(default=50, ge=1, le=500),
+) -> Page[tables.Identity]:
+    """List identities of a tenant with cursor pagination."""
+    try:
+        return await crud.list_identities(
+            session,
+            tenant_id=tenant_id,
+            iden_type=iden_type,
+            status=identity_status,
+            deleted=deleted,
+            cursor=cursor,
+            limit=limit,
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=str(e))
+
+
 @router.post("/identities/oauth2")
 async def create_oauth2_identity(
     session: deps.DatabaseSession, request: models.OAuth2IdentityCreateRequest
 ) -> tables.Identity:
+    deps.check_tenant(session, request.tenant_id)
     return await crud.create_oauth2_identity(session, request=request)
 
 
@@ -37,9 +93,27 @@ async def delete_oauth2_identity(session: deps.DatabaseSession, id: uuid.UUID) -
 
 @router.post("/identities/email")
 async def create_email_identity(session: deps.DatabaseSession, request: models.EmailIdentityCreateRequest) -> tables.Identity:
+    deps.check_tenant(session, request.tenant_id)
     return await crud.create_email_identity(session, request=request)
 
 
+@router.post("/identities/email/login")
+async def login_with_email(session: deps.DatabaseSession, request: models.EmailIdentityLoginRequest) -> tables.Identity:
+    deps.check_tenant(session, request.tenant_id)
+    try:
+        identity = await crud.login_with_email(session, request=request, last_seen=deps.signin_buffer)
+    except IdentityException as e:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail=e.message)
+    except LimiterSaturatedError as e:
+        raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS, detail=e.message, headers={"Retry-After": "1"})
+    except LimiterTimeoutError as e:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=e.message, headers={"Retry-After": "1"})
+    await session.commit()
+    if identity in session:
+        await session.refresh(identity)
+    return identity
+
+
 @router.post("/identities/email/{id}")
 async def update_email_identity(
     session: deps.DatabaseSession, id: uuid.UUID, request: models.EmailIdentityUpdateRequest
@@ -63,4 +137,5 @@ async def delete_email_identity(session: deps.DatabaseSession, id: uuid.UUID) ->
 async def reset_email_password(
     session: deps.DatabaseSession, request: models.EmailIdentityResetPasswordRequest
 ) -> tables.Identity | None:
+    deps.check_tenant(session, request.tenant_id)
     return await crud.reset_email_password(session, request=request)
@@ -4,25 +4,29 @@ from datetime import datetime
 from pydantic import SecretStr
 from sqlmodel import Field, Index
 
-from melody.db import BaseModel
+from melody.db import BaseModel, SecretString
 
 
-class Identity(BaseModel):
+class Identity(BaseModel, table=True):
     __tablename__ = "identities"
     __table_args__ = (
-        Index("ix_identities_iden", "iden_type", "iden_value", unique=True),
+        # identities are unique per tenant, every lookup is scoped to a tenant
+        Index("ix_identities_tenant_iden", "tenant_id", "iden_type", "iden_value", unique=True),
+        Index("ix_identities_tenant_user_id", "tenant_id", "user_id", unique=False),
+        # lookups of a user's identities outside of a tenant scope, e.g. by the user service
         Index("ix_identities_user_id", "user_id", unique=False),
+        # keyset pagination of a tenant's identities
+        Index("ix_identities_tenant_created_at", "tenant_id", "created_at", "id"),
     )
 
     id: uuid.UUID = Field(
-        default=uuid.uuid4(),
+        default_factory=uuid.uuid4,
         nullable=False,
         primary_key=True,
         description="The id of the identity",
     )
 
     user_id: uuid.UUID = Field(
-        index=True,
         nullable=False,
         description="The user id of this identity",
     )
@@ -40,6 +44,7 @@ class Identity(BaseModel):
     credential: SecretStr | None = Field(
         default=None,
         nullable=True,
+        sa_type=SecretString,
         description="Credential, such as a bcrypt password.",
     )
 
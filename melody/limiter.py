@@ -0,0 +1,84 @@
+import asyncio
+import contextlib
+from typing import AsyncIterator
+
+from .exception import MelodyException
+
+
+class LimiterSaturatedError(MelodyException):
+    """Raised when the limiter queue is full, the caller should back off (HTTP 429)."""
+
+    def __init__(self, message: str = "Too many concurrent requests, retry later.", **kwargs) -> None:
+        super().__init__(code="error.limiter.saturated", message=message, **kwargs)
+
+
+class LimiterTimeoutError(MelodyException):
+    """Raised when the caller waited longer than the deadline for a slot (HTTP 503)."""
+
+    def __init__(self, message: str = "Timed out waiting for an execution slot.", **kwargs) -> None:
+        super().__init__(code="error.limiter.timeout", message=message, **kwargs)
+
+
+class ConcurrencyLimiter:
+    """Bound the concurrency of expensive work, with a bounded wait queue and a deadline.
+
+    At most `max_concurrency` callers run at the same time, at most `max_queue` callers wait for a slot,
+    and a waiting caller gives up after `timeout` seconds. Rejecting early keeps CPU-bound work
+    (e.g. bcrypt) from piling up behind a saturated pool, where it would time out anyway.
+
+    Examples
+    --------
+    >>> limiter = ConcurrencyLimiter(max_concurrency=4, max_queue=16, timeout=1.0)
+    >>> async with limiter.acquire():
+    ...     await do_expensive_work()
+    """
+
+    def __init__(self, max_concurrency: int, max_queue: int = 0, timeout: float | None = None) -> None:
+        if max_concurrency <= 0:
+            raise ValueError(f"max_concurrency must be positive, got {max_concurrency}")
+        self._max_concurrency = max_concurrency
+        self._max_queue = max_queue
+        self._timeout = timeout
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._running = 0
+        self._waiting = 0
+
+    @property
+    def running(self) -> int:
+        return self._running
+
+    @property
+    def waiting(self) -> int:
+        return self._waiting
+
+    @contextlib.asynccontextmanager
+    async def acquire(self, timeout: float | None = None) -> AsyncIterator[None]:
+        """Acquire an execution slot.
+
+        Raises
+        ------
+        LimiterSaturatedError
+            If all slots are busy and the wait queue is full.
+        LimiterTimeoutError
+            If no slot is available before the deadline.
+        """
+        if not self._semaphore.locked():
+            # fast path, a slot is free so acquire() will not block
+            await self._semaphore.acquire()
+        elif self._waiting >= self._max_queue:
+            raise LimiterSaturatedError()
+        else:
+            timeout = self._timeout if timeout is None else timeout
+            self._waiting += 1
+            try:
+                await asyncio.wait_for(self._semaphore.acquire(), timeout=timeout)
+            except asyncio.TimeoutError:
+                raise LimiterTimeoutError() from None
+            finally:
+                self._waiting -= 1
+        self._running += 1
+        try:
+            yield
+        finally:
+            self._running -= 1
+            self._semaphore.release()
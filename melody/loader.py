@@ -0,0 +1,101 @@
+import asyncio
+from typing import Awaitable, Callable, Dict, Generic, Hashable, Iterable, List, Optional, Tuple, TypeVar
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+class DataLoader(Generic[K, V]):
+    """Coalesce loads of single keys into batched loads.
+
+    All `load()` calls made within one event loop tick are dispatched together to `batch_fn`, which receives
+    the distinct keys and returns a mapping of the keys it found. Keys missing from the mapping resolve to None.
+    Results are memoized for the lifetime of the loader, so create one loader per request (or per session),
+    failed loads are not. Callers share the load of a key, cancelling one of them does not cancel the others.
+    Batches never run concurrently, so `batch_fn` may use a single database session.
+
+    Examples
+    --------
+    >>> async def load_users(ids):
+    ...     return {user.id: user for user in await crud.retrieve_users(session, ids=ids)}
+    >>> loader = DataLoader(load_users)
+    >>> a, b = await asyncio.gather(loader.load(id_a), loader.load(id_b))  # one query
+    """
+
+    def __init__(self, batch_fn: Callable[[List[K]], Awaitable[Dict[K, V]]], max_batch_size: int = 1000) -> None:
+        if max_batch_size <= 0:
+            raise ValueError(f"max_batch_size must be positive, got {max_batch_size}")
+        self._batch_fn = batch_fn
+        self._max_batch_size = max_batch_size
+        self._futures: Dict[K, asyncio.Future] = {}
+        self._queue: List[Tuple[K, asyncio.Future]] = []
+        self._scheduled = False
+        self._lock = asyncio.Lock()
+        self._tasks = set()
+
+    def load(self, key: K) -> "asyncio.Future[Optional[V]]":
+        """Load a key, the returned future resolves after the batch of the current tick is loaded."""
+        future = self._futures.get(key, None)
+        if future is None or future.cancelled():
+            loop = asyncio.get_running_loop()
+            future = loop.create_future()
+            self._futures[key] = future
+            self._queue.append((key, future))
+            if not self._scheduled:
+                self._scheduled = True
+                loop.call_soon(self._dispatch)
+        # the future is shared by all callers of the key, one of them cancelling must not cancel it
+        return asyncio.shield(future)
+
+    async def load_many(self, keys: Iterable[K]) -> List[Optional[V]]:
+        """Load keys, values are returned in the order of keys."""
+        return list(await asyncio.gather(*[self.load(key) for key in keys]))
+
+    def clear(self, key: K) -> None:
+        """Forget the memoized value of a key, e.g. after it was updated.
+
+        A load of the key in flight is forgotten too: its callers still get its result, the next load of the key
+        starts a new batch.
+        """
+        self._futures.pop(key, None)
+
+    def clear_all(self) -> None:
+        self._futures.clear()
+
+    def _dispatch(self) -> None:
+        self._scheduled = False
+        queue, self._queue = self._queue, []
+        task = asyncio.ensure_future(self._load_batches(queue))
+        # keep a reference, the event loop only holds weak references to tasks
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _forget(self, key: K, future: asyncio.Future) -> None:
+        # unless the key was cleared and loaded again meanwhile
+        if self._futures.get(key, None) is future:
+            del self._futures[key]
+
+    async def _load_batches(self, queue: List[Tuple[K, asyncio.Future]]) -> None:
+        try:
+            async with self._lock:
+                for i in range(0, len(queue), self._max_batch_size):
+                    await self._load_batch(queue[i : i + self._max_batch_size])
+        finally:
+            # cancelled, or batch_fn raised a BaseException: no future is left pending, nor memoized
+            for key, future in queue:
+                if not future.done():
+                    self._forget(key, future)
+                    future.cancel()
+
+    async def _load_batch(self, batch: List[Tuple[K, asyncio.Future]]) -> None:
+        try:
+            values = await self._batch_fn(list(dict.fromkeys(key for key, _ in batch)))
+        except Exception as e:
+            for key, future in batch:
+                self._forget(key, future)
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for key, future in batch:
+            if not future.done():
+                future.set_result(values.get(key, None))
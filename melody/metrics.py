@@ -0,0 +1,78 @@
+import bisect
+import math
+import threading
+from typing import Dict, List, Sequence
+
+from pydantic import BaseModel
+
+# upper bounds of latency buckets in milliseconds, the last bucket is unbounded
+DEFAULT_LATENCY_BUCKETS_MS = (0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+
+class HistogramSnapshot(BaseModel):
+    """A point-in-time copy of a histogram, percentiles are upper bounds of the buckets they fall in."""
+
+    count: int = 0
+    sum: float = 0.0
+    max: float = 0.0
+    p50: float = 0.0
+    p95: float = 0.0
+    p99: float = 0.0
+    buckets: Dict[str, int] = {}
+
+
+class Histogram:
+    """A histogram with fixed buckets, cheap enough to observe on every query.
+
+    Examples
+    --------
+    >>> histogram = Histogram()
+    >>> histogram.observe(3.2)
+    >>> histogram.percentile(0.99)
+    5
+    """
+
+    def __init__(self, buckets: Sequence[float] = DEFAULT_LATENCY_BUCKETS_MS) -> None:
+        if list(buckets) != sorted(buckets):
+            raise ValueError("buckets must be sorted")
+        self._bounds = list(buckets)
+        self._counts = [0] * (len(self._bounds) + 1)
+        self._lock = threading.Lock()
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+        index = bisect.bisect_left(self._bounds, value)
+        with self._lock:
+            self._counts[index] += 1
+            self.count += 1
+            self.sum += value
+            if value > self.max:
+                self.max = value
+
+    def percentile(self, q: float) -> float:
+        """Estimate the q-th quantile (0 < q <= 1), the max observed value for the unbounded bucket."""
+        if self.count == 0:
+            return 0.0
+        rank = math.ceil(q * self.count)
+        seen = 0
+        for index, count in enumerate(self._counts):
+            seen += count
+            if seen >= rank:
+                return self._bounds[index] if index < len(self._bounds) else self.max
+        return self.max
+
+    def snapshot(self) -> HistogramSnapshot:
+        with self._lock:
+            counts: List[int] = list(self._counts)
+        labels = [f"le_{bound:g}" for bound in self._bounds] + ["le_inf"]
+        return HistogramSnapshot(
+            count=self.count,
+            sum=self.sum,
+            max=self.max,
+            p50=self.percentile(0.50),
+            p95=self.percentile(0.95),
+            p99=self.percentile(0.99),
+            buckets=dict(zip(labels, counts)),
+        )
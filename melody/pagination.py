@@ -0,0 +1,54 @@
+import base64
+import json
+import uuid
+from datetime import datetime
+from typing import Generic, List, Sequence, Tuple, TypeVar
+
+from pydantic import BaseModel
+from sqlalchemy import Select, tuple_
+
+T = TypeVar("T")
+
+
+class Page(BaseModel, Generic[T]):
+    """A page of records, pass next_cursor back to fetch the next page, None if this is the last page."""
+
+    items: List[T] = []
+    next_cursor: str | None = None
+
+
+def encode_cursor(created_at: datetime, id: uuid.UUID) -> str:
+    data = json.dumps([created_at.isoformat(), str(id)], separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(data).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, uuid.UUID]:
+    """Decode a cursor from encode_cursor(), raises ValueError if the cursor is malformed."""
+    try:
+        data = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        created_at, id = json.loads(data)
+        return datetime.fromisoformat(created_at), uuid.UUID(id)
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"invalid cursor: {cursor}") from e
+
+
+def paginate(sql: Select, model, *, cursor: str | None, limit: int) -> Select:
+    """Apply keyset pagination on (created_at, id) to the query.
+
+    Rows after the cursor are selected with a row value comparison, which is served by an index on
+    (..., created_at, id) so that every page costs the same as the first one, unlike OFFSET.
+    One extra row is fetched to know whether there is a next page, see `make_page()`.
+    """
+    if cursor:
+        created_at, id = decode_cursor(cursor)
+        sql = sql.where(tuple_(model.created_at, model.id) > tuple_(created_at, id))
+    return sql.order_by(model.created_at, model.id).limit(limit + 1)
+
+
+def make_page(rows: Sequence, limit: int) -> Page:
+    """Build a page from the rows of a paginate() query."""
+    rows = list(rows)
+    if len(rows) <= limit:
+        return Page(items=rows)
+    rows = rows[:limit]
+    return Page(items=rows, next_cursor=encode_cursor(rows[-1].created_at, rows[-1].id))
@@ -0,0 +1,116 @@
+import logging
+import threading
+import time
+from typing import Any, Dict
+
+from pydantic import BaseModel
+from sqlalchemy import exc
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+from .config import DatabaseSettings
+from .metrics import Histogram, HistogramSnapshot
+
+logger = logging.getLogger("melody.pool")
+
+
+class PoolStats(BaseModel):
+    """Live state of a connection pool.
+
+    `waiting` counts callers currently acquiring a connection, `acquire_ms` includes the pre-ping.
+    """
+
+    size: int = 0
+    checked_out: int = 0
+    overflow: int = 0
+    waiting: int = 0
+    acquires: int = 0
+    timeouts: int = 0
+    acquire_ms: HistogramSnapshot = HistogramSnapshot()
+
+
+class PoolMetrics:
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.waiting = 0
+        self.acquires = 0
+        self.timeouts = 0
+        self.acquire_ms = Histogram()
+
+
+class InstrumentedAsyncQueuePool(AsyncAdaptedQueuePool):
+    """An AsyncAdaptedQueuePool that records waiters, acquire latency and acquire timeouts."""
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.metrics = PoolMetrics()
+
+    def connect(self):
+        metrics = self.metrics
+        with metrics._lock:
+            metrics.waiting += 1
+        started = time.perf_counter()
+        try:
+            return super().connect()
+        except exc.TimeoutError:
+            with metrics._lock:
+                metrics.timeouts += 1
+            logger.warning(f"timed out acquiring a database connection: {self.status()}")
+            raise
+        finally:
+            with metrics._lock:
+                metrics.waiting -= 1
+                metrics.acquires += 1
+            metrics.acquire_ms.observe((time.perf_counter() - started) * 1000)
+
+    def recreate(self) -> "InstrumentedAsyncQueuePool":
+        pool = super().recreate()
+        # keep the metrics across engine.dispose()
+        pool.metrics = self.metrics
+        return pool
+
+    def stats(self) -> PoolStats:
+        metrics = self.metrics
+        return PoolStats(
+            size=self.size(),
+            checked_out=self.checkedout(),
+            overflow=max(self.overflow(), 0),
+            waiting=metrics.waiting,
+            acquires=metrics.acquires,
+            timeouts=metrics.timeouts,
+            acquire_ms=metrics.acquire_ms.snapshot(),
+        )
+
+
+def pool_options(settings: DatabaseSettings) -> Dict[str, Any]:
+    """Engine keyword arguments of the connection pool, empty for in-memory sqlite which uses a single connection."""
+    url = make_url(settings.database_uri)
+    if url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:"):
+        return {}
+    if settings.conn_pool_max_size < settings.conn_pool_min_size:
+        raise ValueError(
+            f"conn_pool_max_size {settings.conn_pool_max_size} is less than conn_pool_min_size {settings.conn_pool_min_size}"
+        )
+    return {
+        "poolclass": InstrumentedAsyncQueuePool,
+        # connections kept open, and extra connections opened under load
+        "pool_size": settings.conn_pool_min_size,
+        "max_overflow": settings.conn_pool_max_size - settings.conn_pool_min_size,
+        "pool_timeout": settings.conn_pool_timeout,
+        "pool_recycle": settings.conn_pool_recycle,
+        "pool_pre_ping": settings.conn_pool_pre_ping,
+    }
+
+
+def create_engine(settings: DatabaseSettings) -> AsyncEngine:
+    """Create the engine, the only owner of database connections in the process."""
+    return create_async_engine(settings.database_uri, **pool_options(settings))
+
+
+def pool_stats(engine: AsyncEngine) -> PoolStats | None:
+    """Stats of the engine's pool, None if the pool is not instrumented."""
+    pool = engine.sync_engine.pool
+    if not isinstance(pool, InstrumentedAsyncQueuePool):
+        return None
+    return pool.stats()
@@ -0,0 +1,161 @@
+import asyncio
+import itertools
+import logging
+import time
+from typing import Dict, List
+
+from sqlalchemy import event, text
+from sqlalchemy.engine import ExceptionContext
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlalchemy.orm import ORMExecuteState, Session
+from sqlalchemy.sql.elements import TextClause
+
+logger = logging.getLogger("melody.replicas")
+
+# set on responses to unsafe requests, reads of the client are served by the primary until the timestamp
+READ_YOUR_WRITES_COOKIE = "melody_primary_until"
+SAFE_METHODS = ("GET", "HEAD", "OPTIONS")
+
+_READ_ONLY = "melody.read_only"
+_REPLICA = "melody.replica"
+
+
+class ReadOnlySessionError(Exception):
+    """Raised when a statement other than SELECT is executed in a read-only session."""
+
+
+def mark_read_only(session, replica: bool) -> None:
+    """Reject writes in the session, and remember whether it is bound to a replica."""
+    sync_session = getattr(session, "sync_session", session)
+    sync_session.info[_READ_ONLY] = True
+    sync_session.info[_REPLICA] = replica
+
+
+def is_replica_session(session) -> bool:
+    """Whether the session reads from a replica, whose rows may lag behind the primary."""
+    sync_session = getattr(session, "sync_session", session)
+    return sync_session.info.get(_REPLICA, False)
+
+
+_READ_KEYWORDS = ("select", "with", "explain", "show")
+
+
+def _is_write(state: ORMExecuteState) -> bool:
+    if state.is_insert or state.is_update or state.is_delete:
+        return True
+    if isinstance(state.statement, TextClause):
+        return not state.statement.text.lstrip().lower().startswith(_READ_KEYWORDS)
+    return False
+
+
+@event.listens_for(Session, "do_orm_execute")
+def _reject_writes(state: ORMExecuteState) -> None:
+    if state.session.info.get(_READ_ONLY, False) and _is_write(state):
+        raise ReadOnlySessionError(f"cannot execute {state.statement} in a read-only session")
+
+
+@event.listens_for(Session, "before_flush")
+def _reject_flush(session: Session, flush_context, instances) -> None:
+    if session.info.get(_READ_ONLY, False) and (session.new or session.dirty or session.deleted):
+        raise ReadOnlySessionError("cannot flush changes in a read-only session")
+
+
+def primary_until(cookies: Dict[str, str]) -> float:
+    """The end of the read-your-writes window of a client, 0 if there is none."""
+    try:
+        return float(cookies.get(READ_YOUR_WRITES_COOKIE, 0))
+    except ValueError:
+        return 0
+
+
+class ReplicaRouter:
+    """Routes reads to healthy replicas in round robin, and everything else to the primary.
+
+    Replicas are health checked with `SELECT 1` at most every `health_check_interval` seconds, in the
+    background of the reads. A replica is also marked unhealthy as soon as one of its connections is
+    found disconnected. Reads fall back to the primary when no replica is healthy.
+
+    Examples
+    --------
+    >>> router = ReplicaRouter(primary, [replica_a, replica_b])
+    >>> async with AsyncSession(router.engine_for_read()) as session:
+    ...     users = await crud.list_users(session, tenant_id=tenant_id)
+    """
+
+    def __init__(
+        self,
+        primary: AsyncEngine,
+        replicas: List[AsyncEngine] | None = None,
+        health_check_interval: float = 5.0,
+        health_check_timeout: float = 1.0,
+    ) -> None:
+        self.primary = primary
+        self.replicas = list(replicas or [])
+        self.health_check_interval = health_check_interval
+        self.health_check_timeout = health_check_timeout
+        self._healthy: Dict[AsyncEngine, bool] = {replica: True for replica in self.replicas}
+        self._round_robin = itertools.cycle(self.replicas)
+        self._checked_at = time.monotonic()
+        self._checking: asyncio.Task | None = None
+        for replica in self.replicas:
+            event.listen(replica.sync_engine, "handle_error", self._on_error(replica))
+
+    def _on_error(self, replica: AsyncEngine):
+        def _handle_error(context: ExceptionContext) -> None:
+            if context.is_disconnect and self._healthy.get(replica, False):
+                logger.warning(f"replica {replica.url!r} disconnected, marked unhealthy.")
+                self._healthy[replica] = False
+
+        return _handle_error
+
+    @property
+    def healthy_replicas(self) -> List[AsyncEngine]:
+        return [replica for replica in self.replicas if self._healthy[replica]]
+
+    def engine_for_read(self, primary: bool = False) -> AsyncEngine:
+        """Pick the engine of a read, the primary if primary is True or no replica is healthy."""
+        if primary or not self.replicas:
+            return self.primary
+        self._schedule_health_check()
+        for _ in range(len(self.replicas)):
+            replica = next(self._round_robin)
+            if self._healthy[replica]:
+                return replica
+        return self.primary
+
+    def _schedule_health_check(self) -> None:
+        if self._checking is not None or time.monotonic() - self._checked_at < self.health_check_interval:
+            return
+        self._checking = asyncio.get_running_loop().create_task(self.check_health())
+        self._checking.add_done_callback(self._on_checked)
+
+    def _on_checked(self, task: asyncio.Task) -> None:
+        self._checking = None
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning(f"replica health check failed: {task.exception()}")
+
+    async def _check(self, replica: AsyncEngine) -> bool:
+        try:
+            async with asyncio.timeout(self.health_check_timeout):
+                async with replica.connect() as conn:
+                    await conn.execute(text("SELECT 1"))
+            return True
+        except Exception as e:
+            logger.warning(f"replica {replica.url!r} is unhealthy: {e}")
+            return False
+
+    async def check_health(self) -> Dict[str, bool]:
+        """Check all replicas now, returns the health by replica url."""
+        results = await asyncio.gather(*[self._check(replica) for replica in self.replicas])
+        for replica, healthy in zip(self.replicas, results):
+            if healthy and not self._healthy[replica]:
+                logger.info(f"replica {replica.url!r} is healthy again.")
+            self._healthy[replica] = healthy
+        self._checked_at = time.monotonic()
+        return {replica.url.render_as_string(): healthy for replica, healthy in zip(self.replicas, results)}
+
+    async def dispose(self) -> None:
+        if self._checking is not None:
+            self._checking.cancel()
+        for replica in self.replicas:
+            await replica.dispose()
@@ -0,0 +1,236 @@
+import argparse
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import Dict, List
+
+from pydantic import BaseModel
+from sqlalchemy import Table, delete, select, tuple_
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlmodel import SQLModel
+
+from melody import db, utils
+from melody.export import stream_rows
+
+from .router import DirectoryShardLookup, ShardMap
+from .tables import TenantShard
+
+logger = logging.getLogger("melody.shard")
+
+
+class TenantMoveProgress(BaseModel):
+    tenant_id: str
+    source: str
+    target: str
+    phase: str = "pending"
+    passes: int = 0
+    copied: Dict[str, int] = {}
+    deleted: Dict[str, int] = {}
+
+
+def sharded_tables() -> List[Table]:
+    """Tables holding records of tenants, parents before children.
+
+    Only the tables of melody.db.BaseModel records, the tables of melody_users are not sharded.
+    """
+    records = {mapper.local_table for mapper in SQLModel._sa_registry.mappers if issubclass(mapper.class_, db.BaseModel)}
+    return [
+        table
+        for table in SQLModel.metadata.sorted_tables
+        if table in records and "tenant_id" in table.c and table.name != TenantShard.__tablename__
+    ]
+
+
+def _upsert(table: Table, dialect: str):
+    if dialect == "postgresql":
+        sql = postgresql.insert(table)
+    elif dialect == "sqlite":
+        sql = sqlite.insert(table)
+    else:
+        raise ValueError(f"moving tenants does not support dialect {dialect}")
+    keys = [c.name for c in table.primary_key.columns]
+    return sql.on_conflict_do_update(
+        index_elements=keys,
+        set_={c.name: sql.excluded[c.name] for c in table.columns if c.name not in keys},
+    )
+
+
+class TenantMover:
+    """Moves the records of a tenant to another shard, while the tenant keeps being served.
+
+    1. copy: all records of the tenant are copied to the target in batches, upserted by primary key.
+    2. catch up: records updated since the previous pass are copied again, until a pass copies at most
+       `catch_up_threshold` records or `max_passes` is reached.
+    3. cutover: the tenant is marked READ_ONLY in the directory, writes are rejected with TenantReadOnlyError.
+       After the directory TTL, every process sees it, the last changes are copied, records deleted from the
+       source are deleted from the target, and the tenant is assigned to the target.
+    4. cleanup: after another directory TTL, no process reads the source anymore and its records are deleted.
+
+    Changes are found by `updated_at`, every write must bump it. Passes overlap by `overlap` seconds, to pick up
+    transactions that were in flight when a pass started. Writes are only rejected during the cutover.
+
+    Examples
+    --------
+    >>> mover = TenantMover(shard_map, directory)
+    >>> progress = await mover.move("acme", target="eu-1")
+    """
+
+    def __init__(
+        self,
+        shard_map: ShardMap,
+        directory: DirectoryShardLookup,
+        *,
+        batch_size: int = 1000,
+        max_passes: int = 5,
+        catch_up_threshold: int = 100,
+        overlap: float = 60.0,
+        cleanup: bool = True,
+    ) -> None:
+        self._shard_map = shard_map
+        self._directory = directory
+        self._batch_size = batch_size
+        self._max_passes = max_passes
+        self._catch_up_threshold = catch_up_threshold
+        self._overlap = timedelta(seconds=overlap)
+        self._cleanup = cleanup
+
+    async def _copy_table(
+        self, table: Table, tenant_id: str, source: AsyncEngine, target: AsyncEngine, since: datetime | None
+    ) -> int:
+        sql = select(*table.columns).where(table.c.tenant_id == tenant_id)
+        if since is not None and "updated_at" in table.c:
+            sql = sql.where(table.c.updated_at >= since)
+        sql = sql.order_by(*table.primary_key.columns)
+        upsert = _upsert(table, target.dialect.name)
+        copied = 0
+        async with source.connect() as conn:
+            async for rows in stream_rows(conn, sql, self._batch_size):
+                async with target.begin() as target_conn:
+                    await target_conn.execute(upsert, [dict(row) for row in rows])
+                copied += len(rows)
+        return copied
+
+    async def _copy(self, progress: TenantMoveProgress, source: AsyncEngine, target: AsyncEngine, since) -> int:
+        total = 0
+        for table in sharded_tables():
+            copied = await self._copy_table(table, progress.tenant_id, source, target, since)
+            progress.copied[table.name] = progress.copied.get(table.name, 0) + copied
+            total += copied
+        progress.passes += 1
+        logger.info(f"moving tenant {progress.tenant_id}, pass {progress.passes} copied {total} records.")
+        return total
+
+    async def _delete_missing(self, progress: TenantMoveProgress, source: AsyncEngine, target: AsyncEngine) -> None:
+        """Delete records of the tenant from the target that no longer exist in the source."""
+        for table in reversed(sharded_tables()):
+            keys = list(table.primary_key.columns)
+            deleted, last = 0, None
+            while True:
+                # keyset pages in short transactions, no cursor is kept open while deleting
+                sql = select(*keys).where(table.c.tenant_id == progress.tenant_id)
+                if last is not None:
+                    sql = sql.where(tuple_(*keys) > tuple_(*last))
+                async with target.connect() as conn:
+                    batch = [tuple(row) for row in await conn.execute(sql.order_by(*keys).limit(self._batch_size))]
+                if not batch:
+                    break
+                last = batch[-1]
+                async with source.connect() as conn:
+                    found = set(tuple(row) for row in await conn.execute(select(*keys).where(tuple_(*keys).in_(batch))))
+                missing = [key for key in batch if key not in found]
+                if missing:
+                    async with target.begin() as conn:
+                        await conn.execute(delete(table).where(tuple_(*keys).in_(missing)))
+                    deleted += len(missing)
+            progress.deleted[table.name] = deleted
+
+    async def _delete_tenant(self, tenant_id: str, engine: AsyncEngine) -> None:
+        for table in reversed(sharded_tables()):
+            keys = list(table.primary_key.columns)
+            while True:
+                batch = select(*keys).where(table.c.tenant_id == tenant_id).limit(self._batch_size)
+                async with engine.begin() as conn:
+                    rows = [tuple(row) for row in await conn.execute(batch)]
+                    if not rows:
+                        break
+                    await conn.execute(delete(table).where(tuple_(*keys).in_(rows)))
+
+    async def move(self, tenant_id: str, target: str) -> TenantMoveProgress:
+        route = await self._shard_map.route(tenant_id)
+        progress = TenantMoveProgress(tenant_id=tenant_id, source=route.shard, target=target)
+        if route.shard == target:
+            progress.phase = "done"
+            return progress
+        source_engine = self._shard_map.engine(route.shard)
+        target_engine = self._shard_map.engine(target)
+
+        progress.phase = "copy"
+        started = utils.utc_now()
+        await self._copy(progress, source_engine, target_engine, since=None)
+
+        progress.phase = "catch_up"
+        for _ in range(self._max_passes):
+            since, started = started - self._overlap, utils.utc_now()
+            if await self._copy(progress, source_engine, target_engine, since=since) <= self._catch_up_threshold:
+                break
+
+        progress.phase = "cutover"
+        await self._directory.assign(tenant_id, route.shard, status="READ_ONLY")
+        try:
+            # wait until every process has seen the tenant as read only
+            await asyncio.sleep(self._directory.ttl)
+            await self._copy(progress, source_engine, target_engine, since=started - self._overlap)
+            await self._delete_missing(progress, source_engine, target_engine)
+        except BaseException:
+            await self._directory.assign(tenant_id, route.shard, status="ACTIVE")
+            raise
+        await self._directory.assign(tenant_id, target, status="ACTIVE")
+
+        if self._cleanup:
+            progress.phase = "cleanup"
+            # wait until no process reads the tenant from the source anymore
+            await asyncio.sleep(self._directory.ttl)
+            await self._delete_tenant(tenant_id, source_engine)
+        progress.phase = "done"
+        logger.info(f"moved tenant {tenant_id} from {route.shard} to {target}: {progress}")
+        return progress
+
+
+async def move_tenant(tenant_id: str, target: str, **kwargs) -> TenantMoveProgress:
+    """Move a tenant between the shards configured in ShardSettings, kwargs are passed to TenantMover."""
+    from melody import deps
+
+    if not isinstance(deps.shard_lookup, DirectoryShardLookup):
+        raise ValueError("moving tenants requires the shard directory, set SHARD_DIRECTORY_ENABLED=true")
+    try:
+        return await TenantMover(deps.shard_map, deps.shard_lookup, **kwargs).move(tenant_id, target)
+    finally:
+        await deps.shard_map.dispose()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Move a tenant to another shard, online.")
+    parser.add_argument("tenant_id")
+    parser.add_argument("target", help="name of the target shard, a key of SHARD_URIS or default")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--max-passes", type=int, default=5)
+    parser.add_argument("--overlap", type=float, default=60.0, help="seconds of overlap between copy passes")
+    parser.add_argument("--no-cleanup", action="store_true", help="keep the records of the tenant in the source shard")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    progress = asyncio.run(
+        move_tenant(
+            args.tenant_id,
+            args.target,
+            batch_size=args.batch_size,
+            max_passes=args.max_passes,
+            overlap=args.overlap,
+            cleanup=not args.no_cleanup,
+        )
+    )
+    print(progress.model_dump_json(indent=2))
+
+
+if __name__ == "__main__":
+    main()
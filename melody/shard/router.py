@@ -0,0 +1,137 @@
+import abc
+import logging
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Mapping
+
+from pydantic import BaseModel
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from melody import utils
+from melody.cache import TTLCache
+from melody.exception import MelodyException
+
+from .tables import TenantShard
+
+logger = logging.getLogger("melody.shard")
+
+DEFAULT_SHARD = "default"
+
+
+class TenantReadOnlyError(MelodyException):
+    """Raised when writing to a tenant that is being moved between shards."""
+
+    def __init__(self, tenant_id: str) -> None:
+        super().__init__("error.shard.tenant_read_only", f"Tenant {tenant_id} is being moved, retry later.")
+        self.tenant_id = tenant_id
+
+
+class TenantRoute(BaseModel):
+    shard: str
+    read_only: bool = False
+
+
+class ShardLookup(abc.ABC):
+    """Finds the shard of a tenant."""
+
+    @abc.abstractmethod
+    async def route(self, tenant_id: str) -> TenantRoute | None:
+        """The route of the tenant, None if the tenant is not assigned to a shard."""
+        raise NotImplementedError()
+
+
+class ConfigShardLookup(ShardLookup):
+    """Static tenant to shard assignments, e.g. from `ShardSettings.tenant_shards`."""
+
+    def __init__(self, tenant_shards: Mapping[str, str]) -> None:
+        self._routes = {tenant_id: TenantRoute(shard=shard) for tenant_id, shard in tenant_shards.items()}
+
+    async def route(self, tenant_id: str) -> TenantRoute | None:
+        return self._routes.get(tenant_id, None)
+
+
+class DirectoryShardLookup(ShardLookup):
+    """Tenant to shard assignments in the `tenant_shards` directory table, cached for `ttl` seconds.
+
+    Tenants missing from the directory are looked up in `fallback`. Assignments changed by another process
+    are seen after at most `ttl` seconds, so tools changing assignments wait `ttl` seconds before relying on them.
+    """
+
+    def __init__(self, engine: AsyncEngine, ttl: float = 30.0, fallback: ShardLookup | None = None) -> None:
+        self._engine = engine
+        self._fallback = fallback
+        self.ttl = ttl
+        self.cache = TTLCache(max_size=100000, ttl=ttl)
+
+    async def _load(self, tenant_id: str) -> TenantRoute | None:
+        async with AsyncSession(self._engine) as session:
+            entry = (await session.exec(select(TenantShard).where(TenantShard.tenant_id == tenant_id))).first()
+        if entry is not None:
+            return TenantRoute(shard=entry.shard, read_only=entry.status == "READ_ONLY")
+        if self._fallback is not None:
+            return await self._fallback.route(tenant_id)
+        return None
+
+    async def route(self, tenant_id: str) -> TenantRoute | None:
+        return await self.cache.get_or_load(tenant_id, lambda: self._load(tenant_id))
+
+    async def assign(self, tenant_id: str, shard: str, status: str = "ACTIVE") -> None:
+        """Assign the tenant to a shard, or change its status."""
+        async with AsyncSession(self._engine) as session:
+            await session.merge(TenantShard(tenant_id=tenant_id, shard=shard, status=status, updated_at=utils.utc_now()))
+            await session.commit()
+        self.cache.invalidate(tenant_id)
+        logger.info(f"assigned tenant {tenant_id} to shard {shard}, status: {status}")
+
+
+class ShardMap:
+    """Maps tenants to the engines of their shards.
+
+    Tenants without a route live in the default shard, so a single database is a shard map of one shard.
+
+    Examples
+    --------
+    >>> shard_map = ShardMap({"default": engine, "eu-1": eu_engine}, lookup=ConfigShardLookup({"acme": "eu-1"}))
+    >>> async with shard_map.session("acme", write=True) as session:
+    ...     await crud.patch_user(session, id=id, request=request)
+    ...     await session.commit()
+    """
+
+    def __init__(self, engines: Dict[str, AsyncEngine], lookup: ShardLookup | None = None, default: str = DEFAULT_SHARD):
+        if default not in engines:
+            raise ValueError(f"default shard {default} has no engine")
+        self.engines = dict(engines)
+        self.lookup = lookup
+        self.default = default
+
+    @property
+    def sharded(self) -> bool:
+        return len(self.engines) > 1
+
+    def engine(self, shard: str) -> AsyncEngine:
+        engine = self.engines.get(shard, None)
+        if engine is None:
+            raise ValueError(f"unknown shard: {shard}")
+        return engine
+
+    async def route(self, tenant_id: str | None) -> TenantRoute:
+        if tenant_id is None or self.lookup is None:
+            return TenantRoute(shard=self.default)
+        return await self.lookup.route(tenant_id) or TenantRoute(shard=self.default)
+
+    async def engine_for(self, tenant_id: str | None, write: bool = False) -> AsyncEngine:
+        """The engine of the tenant's shard, raises TenantReadOnlyError for writes to a tenant being moved."""
+        route = await self.route(tenant_id)
+        if write and route.read_only:
+            raise TenantReadOnlyError(tenant_id)
+        return self.engine(route.shard)
+
+    @asynccontextmanager
+    async def session(self, tenant_id: str | None, write: bool = False) -> AsyncIterator[AsyncSession]:
+        async with AsyncSession(await self.engine_for(tenant_id, write=write)) as session:
+            yield session
+
+    async def dispose(self) -> None:
+        for engine in self.engines.values():
+            await engine.dispose()
@@ -0,0 +1,39 @@
+from datetime import datetime
+
+from sqlmodel import Field, SQLModel
+
+from melody import utils
+
+
+class TenantShard(SQLModel, table=True):
+    """Directory of the shard of each tenant, stored in the default shard."""
+
+    __tablename__ = "tenant_shards"
+
+    tenant_id: str = Field(
+        primary_key=True,
+        max_length=64,
+        title="tenant_id",
+        description="The tenant id",
+    )
+
+    shard: str = Field(
+        nullable=False,
+        max_length=64,
+        title="shard",
+        description="The name of the shard holding the tenant's records",
+    )
+
+    status: str = Field(
+        default="ACTIVE",
+        nullable=False,
+        title="status",
+        description="The status of the tenant on its shard, enum: ACTIVE, READ_ONLY (while it is being moved)",
+    )
+
+    updated_at: datetime = Field(
+        nullable=False,
+        default_factory=utils.utc_now,
+        title="updated_at",
+        description="Timestamp of the last change of the shard or status",
+    )
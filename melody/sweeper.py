@@ -0,0 +1,155 @@
+import asyncio
+import logging
+import random
+import time
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Mapping
+
+from pydantic import BaseModel
+from sqlalchemy import Table, delete, literal_column, select, tuple_
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from melody import utils
+from melody.metrics import Histogram, HistogramSnapshot
+
+logger = logging.getLogger("melody.sweeper")
+
+# locators of rows of tables without a primary key
+_ROW_LOCATORS = {"postgresql": "ctid", "sqlite": "rowid"}
+
+
+class SweepStats(BaseModel):
+    """The rows purged by one run of the sweeper, by table name."""
+
+    purged: Dict[str, int] = {}
+    batches: int = 0
+    elapsed_ms: float = 0.0
+    # True if the run stopped at max_batches, expired rows may be left
+    truncated: bool = False
+
+
+class SweeperSnapshot(BaseModel):
+    runs: int = 0
+    purged_total: Dict[str, int] = {}
+    last_run: SweepStats | None = None
+    run_ms: HistogramSnapshot = HistogramSnapshot()
+
+
+class ExpirySweeper:
+    """Deletes rows past their `expires_at` in small batches, in the background.
+
+    Every run deletes at most `batch_size` rows per statement and `max_batches` batches, sleeping `batch_pause`
+    seconds between batches so the sweeper never holds locks long or saturates the database. Rows are kept
+    `retention` seconds after they expired, tables in `retentions` override it. Tables need an index on
+    `expires_at`, batches are picked by primary key, or by the row locator of tables without one.
+
+    Examples
+    --------
+    >>> sweeper = ExpirySweeper(engine, [OAuth2State.__table__, Session.__table__], retentions={"sessions": 86400})
+    >>> sweeper.start(interval=60)
+    >>> ...
+    >>> await sweeper.stop()
+    """
+
+    def __init__(
+        self,
+        engine: AsyncEngine,
+        tables: List[Table],
+        *,
+        retention: float = 0.0,
+        retentions: Mapping[str, float] | None = None,
+        batch_size: int = 500,
+        batch_pause: float = 0.1,
+        max_batches: int = 100,
+        clock: Callable[[], datetime] = utils.utc_now,
+    ) -> None:
+        for table in tables:
+            if "expires_at" not in table.c:
+                raise ValueError(f"table {table.name} has no expires_at column")
+        self._engine = engine
+        self._tables = list(tables)
+        self._retention = retention
+        self._retentions = dict(retentions or {})
+        self._batch_size = batch_size
+        self._batch_pause = batch_pause
+        self._max_batches = max_batches
+        self._clock = clock
+        self._task: asyncio.Task | None = None
+        self._runs = 0
+        self._purged_total: Dict[str, int] = {table.name: 0 for table in self._tables}
+        self._last_run: SweepStats | None = None
+        self._run_ms = Histogram()
+
+    def _batch(self, table: Table, cutoff: datetime):
+        keys = list(table.primary_key.columns)
+        if not keys:
+            locator = _ROW_LOCATORS.get(self._engine.dialect.name, None)
+            if locator is None:
+                raise ValueError(f"cannot sweep table {table.name} without primary key on {self._engine.dialect.name}")
+            keys = [literal_column(locator)]
+        expired = select(*keys).select_from(table).where(table.c.expires_at < cutoff).limit(self._batch_size)
+        if len(keys) == 1:
+            return delete(table).where(keys[0].in_(expired))
+        return delete(table).where(tuple_(*keys).in_(expired))
+
+    async def _sweep_table(self, table: Table, stats: SweepStats) -> None:
+        cutoff = self._clock() - timedelta(seconds=self._retentions.get(table.name, self._retention))
+        sql = self._batch(table, cutoff)
+        purged = 0
+        while stats.batches < self._max_batches:
+            async with self._engine.begin() as conn:
+                deleted = (await conn.execute(sql)).rowcount
+            stats.batches += 1
+            purged += deleted
+            if deleted < self._batch_size:
+                break
+            await asyncio.sleep(self._batch_pause)
+        else:
+            stats.truncated = True
+        stats.purged[table.name] = purged
+        self._purged_total[table.name] += purged
+
+    async def run_once(self) -> SweepStats:
+        """Sweep every table once, returns the rows purged."""
+        started = time.perf_counter()
+        stats = SweepStats()
+        for table in self._tables:
+            await self._sweep_table(table, stats)
+        stats.elapsed_ms = (time.perf_counter() - started) * 1000
+        self._runs += 1
+        self._last_run = stats
+        self._run_ms.observe(stats.elapsed_ms)
+        logger.info("swept expired rows: %s", stats)
+        return stats
+
+    async def _run(self, interval: float) -> None:
+        while True:
+            # jitter, so that the sweepers of several processes do not run in lockstep
+            await asyncio.sleep(interval * random.uniform(0.9, 1.1))
+            try:
+                await self.run_once()
+            except Exception as e:
+                logger.warning(f"sweeping expired rows failed: {e}")
+
+    def start(self, interval: float = 60.0) -> None:
+        """Run the sweeper every `interval` seconds in a background task of the running loop."""
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run(interval))
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    def snapshot(self) -> SweeperSnapshot:
+        return SweeperSnapshot(
+            runs=self._runs,
+            purged_total=dict(self._purged_total),
+            last_run=self._last_run,
+            run_ms=self._run_ms.snapshot(),
+        )
@@ -0,0 +1,61 @@
+from typing import List
+
+from sqlalchemy import event
+from sqlalchemy.orm import ORMExecuteState, Session, with_loader_criteria
+from sqlmodel import SQLModel
+
+from .db import BaseModel
+
+_TENANT = "melody.tenant_id"
+# execution option to run a statement of a scoped session across tenants, e.g. for maintenance
+UNSCOPED = "melody_unscoped"
+
+
+def scope_session(session, tenant_id: str | None) -> None:
+    """Scope every ORM SELECT, UPDATE and DELETE of the session to a tenant, None removes the scope.
+
+    Records of other tenants are invisible in a scoped session: a criteria on `tenant_id` is added for every
+    table record (subclass of melody.db.BaseModel) in the statement, including joins and relationships.
+    Inserts are not scoped, they carry their tenant_id explicitly.
+    """
+    sync_session = getattr(session, "sync_session", session)
+    if tenant_id is None:
+        sync_session.info.pop(_TENANT, None)
+    else:
+        sync_session.info[_TENANT] = tenant_id
+
+
+def session_tenant(session) -> str | None:
+    """The tenant the session is scoped to, None if it is not scoped."""
+    sync_session = getattr(session, "sync_session", session)
+    return sync_session.info.get(_TENANT, None)
+
+
+def is_visible(session, record: BaseModel | None) -> bool:
+    """Whether a record obtained outside of the session, e.g. from a cache, is visible in the session."""
+    tenant_id = session_tenant(session)
+    return record is not None and (tenant_id is None or record.tenant_id == tenant_id)
+
+
+def unscoped(sql):
+    """The statement run across tenants in a scoped session, e.g. to load a record cached for all tenants."""
+    return sql.execution_options(**{UNSCOPED: True})
+
+
+def _tenant_classes() -> List[type]:
+    # table records, BaseModel itself is not mapped
+    return [mapper.class_ for mapper in SQLModel._sa_registry.mappers if issubclass(mapper.class_, BaseModel)]
+
+
+@event.listens_for(Session, "do_orm_execute")
+def _scope_to_tenant(state: ORMExecuteState) -> None:
+    tenant_id = state.session.info.get(_TENANT, None)
+    if tenant_id is None or state.execution_options.get(UNSCOPED, False):
+        return
+    if state.is_select or state.is_update or state.is_delete:
+        state.statement = state.statement.options(
+            *[
+                with_loader_criteria(cls, lambda cls: cls.tenant_id == tenant_id, include_aliases=True)
+                for cls in _tenant_classes()
+            ]
+        )
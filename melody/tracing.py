@@ -0,0 +1,214 @@
+import functools
+import logging
+import re
+import threading
+import time
+from typing import Any, Dict, List
+
+from pydantic import BaseModel
+from sqlalchemy import event
+from sqlalchemy.engine import Connection, Engine, ExceptionContext
+
+from .config import TracingSettings, tracing_settings
+from .metrics import Histogram, HistogramSnapshot
+
+logger = logging.getLogger("melody.sql")
+slow_logger = logging.getLogger("melody.sql.slow")
+
+OTHER_FINGERPRINT = "other"
+
+_PLACEHOLDER = re.compile(r"\$\d+(?:::[\w\[\]]+)?|%\(\w+\)s|%s|(?<![:\w]):\w+|\?")
+_PLACEHOLDER_GROUP = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)")
+_REPEATED_GROUPS = re.compile(r"\(\?\)(?:\s*,\s*\(\?\))+")
+_LITERAL = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_WHITESPACE = re.compile(r"\s+")
+
+
+@functools.lru_cache(maxsize=4096)
+def fingerprint(statement: str) -> str:
+    """Normalize a statement so that executions differing only in parameters share a fingerprint.
+
+    Placeholders and literals become `?`, and expanded IN lists and multi-row VALUES collapse to one `(?)`.
+
+    Examples
+    --------
+    >>> fingerprint("SELECT * FROM users WHERE id IN ($1::UUID, $2::UUID) LIMIT 10")
+    'SELECT * FROM users WHERE id IN (?) LIMIT ?'
+    """
+    statement = _WHITESPACE.sub(" ", statement).strip()
+    statement = _PLACEHOLDER.sub("?", statement)
+    statement = _LITERAL.sub("?", statement)
+    statement = _PLACEHOLDER_GROUP.sub("(?)", statement)
+    return _REPEATED_GROUPS.sub("(?)", statement)
+
+
+class QueryStatsSnapshot(BaseModel):
+    fingerprint: str
+    count: int = 0
+    errors: int = 0
+    # rows affected or returned as reported by the driver, drivers report -1 (not counted) for most SELECTs
+    rows: int = 0
+    slow: int = 0
+    latency_ms: HistogramSnapshot = HistogramSnapshot()
+
+
+class _QueryStats:
+    def __init__(self) -> None:
+        self.count = 0
+        self.errors = 0
+        self.rows = 0
+        self.slow = 0
+        self.latency_ms = Histogram()
+        self.explained_at = float("-inf")
+
+
+class QueryTracer:
+    """Records latency and row counts of every statement executed by an engine, grouped by fingerprint.
+
+    Hooks the cursor execution events of the engine, so statements are only rendered as text if the
+    "melody.sql" logger is enabled for DEBUG. Statements slower than `slow_query_ms` are logged to
+    "melody.sql.slow", with their query plan if `explain` is True. EXPLAIN runs on the same connection,
+    at most once per fingerprint every `explain_interval` seconds, and never for streamed results.
+
+    Examples
+    --------
+    >>> tracer = QueryTracer(slow_query_ms=200)
+    >>> tracer.install(engine)
+    >>> for stats in tracer.snapshot()[:10]:
+    ...     print(stats.fingerprint, stats.latency_ms.p99)
+    """
+
+    def __init__(
+        self,
+        slow_query_ms: float = 200,
+        explain: bool = False,
+        explain_interval: float = 60,
+        max_fingerprints: int = 1000,
+    ) -> None:
+        self.slow_query_ms = slow_query_ms
+        self.explain = explain
+        self.explain_interval = explain_interval
+        self.max_fingerprints = max_fingerprints
+        self._stats: Dict[str, _QueryStats] = {}
+        self._lock = threading.Lock()
+
+    def install(self, engine: Any) -> None:
+        """Hook the tracer into an Engine or AsyncEngine."""
+        engine = getattr(engine, "sync_engine", engine)
+        event.listen(engine, "before_cursor_execute", self._before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", self._after_cursor_execute)
+        event.listen(engine, "handle_error", self._handle_error)
+
+    def uninstall(self, engine: Any) -> None:
+        engine = getattr(engine, "sync_engine", engine)
+        event.remove(engine, "before_cursor_execute", self._before_cursor_execute)
+        event.remove(engine, "after_cursor_execute", self._after_cursor_execute)
+        event.remove(engine, "handle_error", self._handle_error)
+
+    def reset(self) -> None:
+        with self._lock:
+            self._stats.clear()
+
+    def snapshot(self) -> List[QueryStatsSnapshot]:
+        """Stats of all fingerprints, the statements with the highest total latency first."""
+        with self._lock:
+            items = list(self._stats.items())
+        snapshots = [
+            QueryStatsSnapshot(
+                fingerprint=key,
+                count=stats.count,
+                errors=stats.errors,
+                rows=stats.rows,
+                slow=stats.slow,
+                latency_ms=stats.latency_ms.snapshot(),
+            )
+            for key, stats in items
+        ]
+        return sorted(snapshots, key=lambda s: s.latency_ms.sum, reverse=True)
+
+    def _get_stats(self, statement: str) -> _QueryStats:
+        key = fingerprint(statement)
+        stats = self._stats.get(key, None)
+        if stats is not None:
+            return stats
+        with self._lock:
+            if key not in self._stats and len(self._stats) >= self.max_fingerprints:
+                key = OTHER_FINGERPRINT
+            return self._stats.setdefault(key, _QueryStats())
+
+    def _before_cursor_execute(self, conn: Connection, cursor, statement, parameters, context, executemany) -> None:
+        conn.info.setdefault("melody.query_start", []).append(time.perf_counter())
+
+    def _after_cursor_execute(self, conn: Connection, cursor, statement, parameters, context, executemany) -> None:
+        started = conn.info["melody.query_start"].pop()
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        rowcount = getattr(cursor, "rowcount", -1)
+        stats = self._get_stats(statement)
+        stats.count += 1
+        stats.latency_ms.observe(elapsed_ms)
+        if rowcount is not None and rowcount > 0:
+            stats.rows += rowcount
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("%.2f ms, %s rows: %s", elapsed_ms, rowcount, statement)
+        if not self.slow_query_ms or elapsed_ms < self.slow_query_ms:
+            return
+        stats.slow += 1
+        slow_logger.warning("slow query %.1f ms, %s rows: %s", elapsed_ms, rowcount, statement)
+        if self.explain and self._should_explain(stats, statement, context, executemany):
+            self._explain(conn, statement, parameters)
+
+    def _handle_error(self, context: ExceptionContext) -> None:
+        conn = context.connection
+        starts = conn.info.get("melody.query_start", None) if conn is not None else None
+        if starts:
+            starts.pop()
+        if context.statement:
+            self._get_stats(context.statement).errors += 1
+
+    def _should_explain(self, stats: _QueryStats, statement: str, context, executemany: bool) -> bool:
+        if executemany or not statement.lstrip()[:6].upper() == "SELECT":
+            return False
+        if context is not None and context.execution_options.get("stream_results", False):
+            # the connection is busy with the open cursor
+            return False
+        now = time.monotonic()
+        if now - stats.explained_at < self.explain_interval:
+            return False
+        stats.explained_at = now
+        return True
+
+    def _explain(self, conn: Connection, statement: str, parameters) -> None:
+        dialect = conn.dialect.name
+        prefix = "EXPLAIN QUERY PLAN " if dialect == "sqlite" else "EXPLAIN "
+        # a failing statement aborts the whole transaction on postgresql, isolate it in a savepoint
+        savepoint = dialect == "postgresql"
+        cursor = conn.connection.cursor()
+        try:
+            if savepoint:
+                cursor.execute("SAVEPOINT melody_explain")
+            cursor.execute(prefix + statement, parameters)
+            plan = "\n".join(" ".join(str(c) for c in row) for row in cursor.fetchall())
+            if savepoint:
+                cursor.execute("RELEASE SAVEPOINT melody_explain")
+        except Exception as e:
+            if savepoint:
+                cursor.execute("ROLLBACK TO SAVEPOINT melody_explain")
+            slow_logger.info(f"failed to explain slow query: {e}")
+            return
+        finally:
+            cursor.close()
+        slow_logger.warning("plan of slow query %s:\n%s", fingerprint(statement), plan)
+
+
+def install_query_tracer(engine: Engine, settings: TracingSettings = tracing_settings) -> QueryTracer | None:
+    """Install a QueryTracer configured from TracingSettings on the engine, None if tracing is disabled."""
+    if not settings.query_tracing_enabled:
+        return None
+    tracer = QueryTracer(
+        slow_query_ms=settings.slow_query_ms,
+        explain=settings.slow_query_explain,
+        explain_interval=settings.slow_query_explain_interval,
+        max_fingerprints=settings.query_tracing_max_fingerprints,
+    )
+    tracer.install(engine)
+    return tracer
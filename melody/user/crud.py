@@ -1,41 +1,201 @@
 import logging
 import uuid
+from typing import Any, AsyncIterable, AsyncIterator, List, Mapping, Tuple
 
+from pydantic import ValidationError
+from sqlalchemy.exc import DBAPIError
 from sqlmodel import delete, insert, select, update
 from sqlmodel.ext.asyncio.session import AsyncSession
 
 from melody import utils
+from melody.cache import TTLCache, invalidate_after_commit, snapshot
+from melody.config import cache_settings
+from melody.export import exported_columns, stream_rows
+from melody.pagination import Page, make_page, paginate
+from melody.replicas import is_replica_session
+from melody.tenancy import is_visible, unscoped
 
-from .models import UserCreateRequest, UserPatchRequest, UserUpdateRequest
+from .models import (
+    UserBatchCreateResponse,
+    UserBatchError,
+    UserCreateRequest,
+    UserPatchRequest,
+    UserUpdateRequest,
+)
 from .tables import User
 
 logger = logging.getLogger("melody.user")
 
+# read-through cache of users by id, see retrieve_user()
+user_cache = TTLCache(max_size=cache_settings.cache_max_size, ttl=cache_settings.cache_ttl)
+
+
+def _invalidate_user(session: AsyncSession, id: uuid.UUID) -> None:
+    invalidate_after_commit(session, user_cache, id)
+
 
 async def retrieve_user(session: AsyncSession, *, id: uuid.UUID) -> User | None:
+    """Retrieve a user by id, through `user_cache` if caching is enabled.
+
+    Cached users are detached snapshots shared by all sessions, do not modify them, and do not
+    expect them to be attached to the session. Users read from a replica are not cached.
+    """
+
+    async def _load(sql) -> User | None:
+        user = (await session.exec(sql)).first()
+        logger.debug("retrieved user: %s", user)
+        return snapshot(user)
+
     sql = select(User).where(User.id == id)
-    logger.debug(f"retrieving user sql: {sql}")
-    user = await session.exec(sql).first()
-    logger.debug(f"retrieved user: {user}")
-    return user
+    logger.debug("retrieving user sql: %s", sql)
+    if not cache_settings.cache_enabled:
+        return await _load(sql)
+    # the cache is shared by all tenants, users are loaded across tenants: a miss of a scoped session must not
+    # hide the user from its tenant
+    user = await user_cache.get_or_load(id, lambda: _load(unscoped(sql)), store=not is_replica_session(session))
+    return user if is_visible(session, user) else None
+
+
+async def retrieve_users(session: AsyncSession, *, ids: List[uuid.UUID]) -> List[User]:
+    """Retrieve users by ids in one query, missing users are omitted and the order is not specified."""
+    if not ids:
+        return []
+    sql = select(User).where(User.id.in_(ids))
+    logger.debug("retrieving users sql: %s", sql)
+    users = (await session.exec(sql)).all()
+    logger.debug("retrieved %s users of %s ids", len(users), len(ids))
+    return list(users)
+
+
+async def list_users(
+    session: AsyncSession,
+    *,
+    tenant_id: str,
+    status: str | None = None,
+    deleted: bool = False,
+    cursor: str | None = None,
+    limit: int = 50,
+) -> Page[User]:
+    """List users of a tenant ordered by (created_at, id), with keyset pagination.
+
+    If deleted is True, only soft deleted users are listed, otherwise only users not deleted.
+    Raises ValueError if the cursor is malformed.
+    """
+    sql = select(User).where(User.tenant_id == tenant_id)
+    if status:
+        sql = sql.where(User.status == status)
+    sql = sql.where(User.deleted_at.is_not(None) if deleted else User.deleted_at.is_(None))
+    sql = paginate(sql, User, cursor=cursor, limit=limit)
+    logger.debug("listing users sql: %s", sql)
+    page = make_page((await session.exec(sql)).all(), limit)
+    logger.debug("listed %s users, next cursor: %s", len(page.items), page.next_cursor)
+    return page
+
+
+async def stream_users(
+    session: AsyncSession, *, tenant_id: str, batch_size: int = 1000
+) -> AsyncIterator[List[Mapping[str, Any]]]:
+    """Stream all users of a tenant as row mappings, in batches from a server-side cursor."""
+    sql = (
+        select(*exported_columns(User.__table__))
+        .where(User.tenant_id == tenant_id)
+        .order_by(User.created_at, User.id)
+    )
+    logger.debug("streaming users sql: %s", sql)
+    async for rows in stream_rows(session, sql, batch_size):
+        yield rows
 
 
 async def create_user(session: AsyncSession, *, request: UserCreateRequest) -> User:
-    user = User()
-    user.model_copy(update=request.model_dump())
-    sql = insert(User).values(user.model_dump())
-    logger.debug(f"creating user sql: {sql}")
-    user: User = await session.exec(sql).one()
-    logger.debug(f"created user: {user}")
+    (user,) = await create_users(session, requests=[request])
+    logger.debug("created user: %s", user)
     return user
 
 
+async def create_users(session: AsyncSession, *, requests: List[UserCreateRequest]) -> List[User]:
+    """Create users with a multi-row INSERT ... RETURNING, users are returned in the order of requests."""
+    if not requests:
+        return []
+    now = utils.utc_now()
+    rows = [{**request.model_dump(exclude_none=True), "created_at": now, "updated_at": now} for request in requests]
+    sql = insert(User).returning(User, sort_by_parameter_order=True)
+    logger.debug("creating users sql: %s, rows: %s", sql, len(rows))
+    users = (await session.exec(sql, params=rows)).scalars().all()
+    logger.debug("created %s users", len(users))
+    return list(users)
+
+
+async def create_users_in_chunks(
+    session: AsyncSession, *, rows: AsyncIterable[Any], chunk_size: int = 500, tenant_id: str | None = None
+) -> UserBatchCreateResponse:
+    """Validate and create users chunk by chunk, committing one transaction per chunk.
+
+    Rows that fail validation are reported and skipped, an Exception in rows is reported as the error of that row.
+    If tenant_id is given, rows of other tenants are reported and skipped.
+    If a chunk fails to insert, it is rolled back and retried row by row, so that only the offending rows fail.
+    """
+    response = UserBatchCreateResponse()
+
+    async def _insert(chunk: List[Tuple[int, UserCreateRequest]]) -> str | None:
+        try:
+            users = await create_users(session, requests=[request for _, request in chunk])
+            await session.commit()
+        except DBAPIError as e:
+            await session.rollback()
+            return str(e.orig)
+        response.users.extend(users)
+        # created users are kept in the response, not in the identity map
+        session.expunge_all()
+        return None
+
+    async def _flush(chunk: List[Tuple[int, UserCreateRequest]]) -> None:
+        if not chunk or await _insert(chunk) is None:
+            return
+        logger.info(f"failed to insert chunk of {len(chunk)} users, retrying row by row.")
+        for index, request in chunk:
+            error = await _insert([(index, request)])
+            if error is not None:
+                response.errors.append(UserBatchError(index=index, error=error))
+
+    # keep created users readable after commit, they are serialized after the session is done
+    expire_on_commit = session.sync_session.expire_on_commit
+    session.sync_session.expire_on_commit = False
+    try:
+        chunk: List[Tuple[int, UserCreateRequest]] = []
+        index = 0
+        async for row in rows:
+            if isinstance(row, Exception):
+                response.errors.append(UserBatchError(index=index, error=str(row)))
+            else:
+                try:
+                    request = UserCreateRequest.model_validate(row)
+                except ValidationError as e:
+                    message = "; ".join(f"{'.'.join(map(str, err['loc']))}: {err['msg']}" for err in e.errors())
+                    response.errors.append(UserBatchError(index=index, error=message))
+                else:
+                    if tenant_id is not None and request.tenant_id != tenant_id:
+                        error = f"tenant_id {request.tenant_id} is not the tenant {tenant_id} of the batch"
+                        response.errors.append(UserBatchError(index=index, error=error))
+                    else:
+                        chunk.append((index, request))
+            index += 1
+            if len(chunk) >= chunk_size:
+                await _flush(chunk)
+                chunk = []
+        await _flush(chunk)
+    finally:
+        session.sync_session.expire_on_commit = expire_on_commit
+    logger.info(f"batch created {len(response.users)} users, {len(response.errors)} errors.")
+    return response
+
+
 async def update_user(session: AsyncSession, *, id: uuid.UUID, request: UserUpdateRequest) -> User | None:
     values = request.model_dump()
     values["updated_at"] = utils.utc_now()
     sql = update(User).where(User.id == id).values(values).returning(User)
-    user = await session.exec(sql).first()
-    logger.debug(f"updated user: {user}")
+    user = (await session.exec(sql)).scalars().first()
+    _invalidate_user(session, id)
+    logger.debug("updated user: %s", user)
     return user
 
 
@@ -43,17 +203,20 @@ async def patch_user(session: AsyncSession, *, id: uuid.UUID, request: UserPatch
     values = request.model_dump(exclude_unset=True)
     values["updated_at"] = utils.utc_now()
     sql = update(User).where(User.id == id).values(values).returning(User)
-    logger.debug(f"patching user sql: {sql}")
-    user = await session.exec(sql).first()
+    logger.debug("patching user sql: %s", sql)
+    user = (await session.exec(sql)).scalars().first()
+    _invalidate_user(session, id)
     return user
 
 
 async def delete_user(session: AsyncSession, *, id: uuid.UUID, soft_delete: bool = False) -> User | None:
     if soft_delete:
-        sql = update(User).where(User.id == id).values(deleted_at=utils.utc_now(), status="DELETED").returning(User)
+        now = utils.utc_now()
+        sql = update(User).where(User.id == id).values(deleted_at=now, updated_at=now, status="DELETED").returning(User)
     else:
         sql = delete(User).where(User.id == id).returning(User)
-    logger.debug(f"deleting user sql: {sql}")
-    user = session.exec(sql).first()
-    logger.debug(f"deleted user: {user}")
+    logger.debug("deleting user sql: %s", sql)
+    user = (await session.exec(sql)).scalars().first()
+    _invalidate_user(session, id)
+    logger.debug("deleted user: %s", user)
     return user
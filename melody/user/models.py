@@ -1,9 +1,14 @@
+from typing import List
+
 from sqlmodel import SQLModel
 
+from .tables import User
+
 
 class UserCreateRequest(SQLModel):
     """Create user"""
 
+    tenant_id: str | None = ""
     username: str | None = ""
     nickname: str | None = ""
     email: str | None = ""
@@ -29,3 +34,17 @@ class UserPatchRequest(SQLModel):
     email: str | None = None
     phone: str | None = None
     props: dict | None = None
+
+
+class UserBatchError(SQLModel):
+    """A row of a batch that was not created."""
+
+    index: int
+    error: str
+
+
+class UserBatchCreateResponse(SQLModel):
+    """Result of a batch creation, created users in input order and the errors of failed rows."""
+
+    users: List[User] = []
+    errors: List[UserBatchError] = []
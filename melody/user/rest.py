@@ -1,21 +1,146 @@
+import json
 import uuid
+from typing import Any, AsyncIterator, List
 
-from fastapi import APIRouter
+from fastapi import APIRouter, HTTPException, Query, Request, status
+from fastapi.responses import StreamingResponse
+from sqlmodel.ext.asyncio.session import AsyncSession
 
 from melody import deps
+from melody.export import ExportFormat, encode
+from melody.pagination import Page
+from melody.tenancy import session_tenant
 
 from . import crud
-from .models import UserCreateRequest, UserPatchRequest, UserUpdateRequest
+from .models import UserBatchCreateResponse, UserCreateRequest, UserPatchRequest, UserUpdateRequest
 from .tables import User
 
 router = APIRouter()
 
+NDJSON_CONTENT_TYPES = ("application/x-ndjson", "application/ndjson", "application/jsonl")
+MAX_BATCH_IDS = 1000
+
+
+def _parse_ndjson_line(line: bytes) -> Any:
+    try:
+        return json.loads(line)
+    except ValueError as e:
+        return ValueError(f"invalid json: {e}")
+
+
+async def _read_rows(request: Request) -> AsyncIterator[Any]:
+    """Read rows from a JSON array body, or incrementally from a NDJSON body."""
+    if request.headers.get("content-type", "").startswith(NDJSON_CONTENT_TYPES):
+        buffer = b""
+        async for data in request.stream():
+            buffer += data
+            *lines, buffer = buffer.split(b"\n")
+            for line in lines:
+                if line.strip():
+                    yield _parse_ndjson_line(line)
+        if buffer.strip():
+            yield _parse_ndjson_line(buffer)
+        return
+
+    try:
+        rows = json.loads(await request.body())
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"invalid json: {e}")
+    if not isinstance(rows, list):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="body must be a json array of users")
+    for row in rows:
+        yield row
+
+
+def _parse_ids(ids: List[str]) -> List[uuid.UUID]:
+    """Parse ids given as repeated (?ids=a&ids=b) or comma separated (?ids=a,b) query params, keeping the order."""
+    parsed = {}
+    for value in ids:
+        for id in value.split(","):
+            if not id.strip():
+                continue
+            try:
+                parsed[uuid.UUID(id.strip())] = None
+            except ValueError:
+                raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=f"invalid user id: {id}")
+    if len(parsed) > MAX_BATCH_IDS:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=f"at most {MAX_BATCH_IDS} ids")
+    return list(parsed)
+
+
+@router.get("/users:export")
+async def export_users(
+    tenant_id: str,
+    format: ExportFormat = ExportFormat.NDJSON,
+    batch_size: int = Query(default=1000, ge=1, le=10000),
+) -> StreamingResponse:
+    """Export all users of a tenant as NDJSON or CSV, streamed with flat memory regardless of the tenant size."""
+
+    export_engine = await deps.read_engine(tenant_id)
+
+    async def _content():
+        # the request scoped session is closed before the body is streamed, so the export owns its session
+        async with AsyncSession(export_engine) as session:
+            async for chunk in encode(crud.stream_users(session, tenant_id=tenant_id, batch_size=batch_size), format):
+                yield chunk
+
+    filename = f"users-{tenant_id or 'default'}.{format.value}"
+    return StreamingResponse(
+        _content(),
+        media_type=format.media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+
+@router.get("/users")
+async def list_users(
+    session: deps.ReadOnlyDatabaseSession,
+    ids: List[str] = Query(default=[]),
+    tenant_id: str | None = None,
+    user_status: str | None = Query(default=None, alias="status"),
+    deleted: bool = False,
+    cursor: str | None = None,
+    limit: int = Query(default=50, ge=1, le=500),
+) -> Page[User]:
+    """List users of a tenant with cursor pagination, or fetch users by ids.
+
+    With ids, the users found are returned in the order of ids, in a single page. Otherwise tenant_id is required.
+    """
+    if ids:
+        user_ids = _parse_ids(ids)
+        users = {user.id: user for user in await crud.retrieve_users(session, ids=user_ids)}
+        return Page(items=[users[id] for id in user_ids if id in users])
+    if tenant_id is None:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail="tenant_id or ids is required")
+    try:
+        return await crud.list_users(
+            session, tenant_id=tenant_id, status=user_status, deleted=deleted, cursor=cursor, limit=limit
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=str(e))
+
 
 @router.post("/users")
 async def create_user(session: deps.DatabaseSession, request: UserCreateRequest) -> User:
+    deps.check_tenant(session, request.tenant_id)
     return await crud.create_user(session, request=request)
 
 
+@router.post("/users:batch")
+async def create_users_batch(
+    session: deps.DatabaseSession,
+    request: Request,
+    chunk_size: int = Query(default=500, ge=1, le=5000),
+) -> UserBatchCreateResponse:
+    """Create users in bulk, from a JSON array or a NDJSON body (Content-Type: application/x-ndjson).
+
+    Rows of another tenant than the tenant of the request are reported as errors.
+    """
+    return await crud.create_users_in_chunks(
+        session, rows=_read_rows(request), chunk_size=chunk_size, tenant_id=session_tenant(session)
+    )
+
+
 @router.post("/users/{id}")
 async def update_user(session: deps.DatabaseSession, id: uuid.UUID, request: UserUpdateRequest) -> User | None:
     return await crud.update_user(session, id=id, request=request)
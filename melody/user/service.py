@@ -1,11 +1,13 @@
 import abc
 import uuid
 from datetime import datetime
-from typing import Optional
+from typing import Dict, List, Optional
 
 from sqlalchemy import select, update
 from sqlalchemy.ext.asyncio import AsyncSession
 
+from melody.loader import DataLoader
+
 from .tables import User
 
 
@@ -21,6 +23,14 @@ class AbstractUserService(abc.ABC):
         """
         pass
 
+    async def fetch_many(self, user_ids: List[uuid.UUID]) -> List[Optional[User]]:
+        """Fetch users by ids
+
+        :param user_ids: The ids of the users
+        :return: The users in the order of user_ids, None for the users not found
+        """
+        return [await self.fetch(user_id) for user_id in user_ids]
+
     @abc.abstractmethod
     async def save(self, user: User) -> User:
         """Create or update a user
@@ -42,20 +52,32 @@ class AbstractUserService(abc.ABC):
 
 
 class DefaultUserService(AbstractUserService):
-    """Default user service implementation"""
+    """Default user service implementation
+
+    Concurrent `fetch` calls made within one event loop tick are merged into a single query.
+    """
 
     def __init__(self, session: AsyncSession):
         self.session = session
+        self._loader = DataLoader(self._load_users)
+
+    async def _load_users(self, user_ids: List[uuid.UUID]) -> Dict[uuid.UUID, User]:
+        query = select(User).where(User.id.in_(user_ids))
+        users = (await self.session.scalars(query)).all()
+        return {user.id: user for user in users}
 
     async def fetch(self, user_id: uuid.UUID) -> Optional[User]:
-        query = select(User).where(User.id == user_id)
-        return await self.session.scalar(query)
+        return await self._loader.load(user_id)
+
+    async def fetch_many(self, user_ids: List[uuid.UUID]) -> List[Optional[User]]:
+        return await self._loader.load_many(user_ids)
 
     async def save(self, user: User) -> User:
         if not user:
             raise ValueError("User cannot be None")
         if not user.id:
             raise ValueError("User id cannot be None")
+        self._loader.clear(user.id)
         exit = await self.session.scalar(select(User).where(User.id == user.id))
         if exit:
             # do update
@@ -75,6 +97,7 @@ class DefaultUserService(AbstractUserService):
         self.session.add(user)
 
     async def delete(self, user_id: uuid.UUID, soft_delete: bool = True, **kwargs) -> Optional[User]:
+        self._loader.clear(user_id)
         stat = select(User).where(User.id == user_id)
         user = await self.session.scalar(stat)
         if not user:
@@ -83,6 +106,6 @@ class DefaultUserService(AbstractUserService):
             self.session.delete(user)
             return user
 
-        user.deleted_at = datetime.utcnow()
+        user.deleted_at = user.updated_at = datetime.utcnow()
         self.session.add(user)
         return user
@@ -1,16 +1,21 @@
 import uuid
 from datetime import datetime
 
-from sqlmodel import Field
+from sqlmodel import Field, Index
 
 from melody.db import BaseModel
 
 
 class User(BaseModel, table=True):
     __tablename__ = "user"
+    __table_args__ = (
+        # keyset pagination of a tenant's users
+        Index("ix_user_tenant_created_at", "tenant_id", "created_at", "id"),
+        Index("ix_user_tenant_email", "tenant_id", "email"),
+    )
 
     id: uuid.UUID = Field(
-        default=uuid.uuid4(),
+        default_factory=uuid.uuid4,
         primary_key=True,
         title="id",
         description="The unique id of the user",
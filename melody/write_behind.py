@@ -0,0 +1,232 @@
+import asyncio
+import logging
+import time
+from typing import Any, Dict, Hashable, List, Tuple
+
+from pydantic import BaseModel
+from sqlalchemy import Table, bindparam, column, or_, update, values
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from melody import utils
+from melody.metrics import Histogram, HistogramSnapshot
+from melody.shard.router import ShardMap, TenantReadOnlyError
+
+logger = logging.getLogger("melody.write_behind")
+
+
+class WriteBehindSnapshot(BaseModel):
+    pending: int = 0
+    # records replacing a pending value of the same key, updates saved
+    coalesced: int = 0
+    written: int = 0
+    flushes: int = 0
+    failed_flushes: int = 0
+    # records dropped because the buffer was full and could not be flushed
+    dropped: int = 0
+    # records kept pending by a flush because their tenant is being moved
+    deferred: int = 0
+    flush_ms: HistogramSnapshot = HistogramSnapshot()
+
+
+class WriteBehindBuffer:
+    """Buffers "last seen" timestamps, such as last_signin_at, and writes them in batches in the background.
+
+    Only the latest value per key is kept. Pending values are flushed every `flush_interval` seconds, or once
+    `flush_size` keys are pending, `batch_size` rows per statement: an `UPDATE ... FROM (VALUES ...)` on
+    postgres, an executemany of a single UPDATE elsewhere. A row is never moved back to an older value.
+    At most `max_pending` keys are kept, a record of a new key flushes a full buffer first, and is dropped if
+    that fails. Values not flushed yet are lost if the process dies, `stop()` flushes them at shutdown.
+
+    With a ShardMap instead of an engine, every value is written to the shard of the tenant it was recorded
+    with, as of the flush: values of a tenant being moved stay pending until the move is over.
+
+    Examples
+    --------
+    >>> buffer = WriteBehindBuffer(engine)
+    >>> buffer.register("user.last_signin_at", User.__table__, key="id", column="last_signin_at", touch="updated_at")
+    >>> buffer.start()
+    >>> await buffer.record("user.last_signin_at", user.id, utils.utc_now(), tenant_id=user.tenant_id)
+    >>> ...
+    >>> await buffer.stop()
+    """
+
+    def __init__(
+        self,
+        engine: AsyncEngine | ShardMap,
+        *,
+        max_pending: int = 100000,
+        flush_size: int = 1000,
+        flush_interval: float = 1.0,
+        batch_size: int = 500,
+    ) -> None:
+        self._engine = engine
+        self._max_pending = max_pending
+        self._flush_size = flush_size
+        self._flush_interval = flush_interval
+        self._batch_size = batch_size
+        self._targets: Dict[str, Tuple[Table, str, str, str | None]] = {}
+        # (target, key) to (value, tenant_id)
+        self._pending: Dict[Tuple[str, Hashable], Tuple[Any, str | None]] = {}
+        self._lock = asyncio.Lock()
+        self._task: asyncio.Task | None = None
+        self._size_flush: asyncio.Task | None = None
+        self._coalesced = self._written = self._flushes = self._failed_flushes = self._dropped = self._deferred = 0
+        self._flush_ms = Histogram()
+
+    def register(self, name: str, table: Table, *, key: str, column: str, touch: str | None = None) -> None:
+        """Buffer the values of `column` of `table`, for rows identified by the unique column `key`.
+
+        If `touch` is given, that column, such as updated_at, is set to the time of the flush in the same update.
+        """
+        for name_ in (key, column, touch):
+            if name_ is not None and name_ not in table.c:
+                raise ValueError(f"table {table.name} has no {name_} column")
+        self._targets[name] = (table, key, column, touch)
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    async def record(self, name: str, key: Hashable, value: Any, tenant_id: str | None = None) -> None:
+        """Record a value of the row `key`, of tenant `tenant_id` which picks its shard with a ShardMap."""
+        if name not in self._targets:
+            raise KeyError(f"unknown write-behind target {name}")
+        item = (name, key)
+        current = self._pending.get(item, None)
+        if current is not None:
+            self._coalesced += 1
+            if value > current[0]:
+                self._pending[item] = (value, tenant_id)
+            return
+        if len(self._pending) >= self._max_pending:
+            await self.flush()
+            if len(self._pending) >= self._max_pending:
+                self._dropped += 1
+                return
+        self._pending[item] = (value, tenant_id)
+        if len(self._pending) >= self._flush_size and (self._size_flush is None or self._size_flush.done()):
+            self._size_flush = asyncio.get_running_loop().create_task(self._flush_quietly())
+
+    def _restore(self, pending: Dict[Tuple[str, Hashable], Tuple[Any, str | None]]) -> None:
+        # merged with the values recorded meanwhile
+        for item, entry in pending.items():
+            current = self._pending.get(item, None)
+            if current is None or entry[0] > current[0]:
+                self._pending[item] = entry
+
+    async def _engines(self, tenants: set) -> Dict[str | None, AsyncEngine | None]:
+        """The engine of each tenant, None for tenants being moved."""
+        if not isinstance(self._engine, ShardMap):
+            return {tenant_id: self._engine for tenant_id in tenants}
+        engines = {}
+        for tenant_id in tenants:
+            try:
+                engines[tenant_id] = await self._engine.engine_for(tenant_id, write=True)
+            except TenantReadOnlyError:
+                engines[tenant_id] = None
+        return engines
+
+    async def flush(self) -> int:
+        """Write the pending values, returns the number of rows written. Failed values are kept pending."""
+        async with self._lock:
+            if not self._pending:
+                return 0
+            pending, self._pending = self._pending, {}
+            started = time.perf_counter()
+            # a transaction per engine, items of an engine are kept pending until it commits
+            by_engine: Dict[AsyncEngine, List[Tuple[str, Hashable]]] = {}
+            try:
+                engines = await self._engines({tenant_id for _, tenant_id in pending.values()})
+                for item, (_, tenant_id) in list(pending.items()):
+                    engine = engines[tenant_id]
+                    if engine is None:
+                        self._deferred += 1
+                        self._restore({item: pending.pop(item)})
+                    else:
+                        by_engine.setdefault(engine, []).append(item)
+                written = 0
+                for engine, items in by_engine.items():
+                    by_target: Dict[str, List[Tuple[Hashable, Any]]] = {}
+                    for name, key in items:
+                        by_target.setdefault(name, []).append((key, pending[(name, key)][0]))
+                    async with engine.begin() as conn:
+                        for name, rows in by_target.items():
+                            written += await self._write(conn, name, rows)
+                    for item in items:
+                        del pending[item]
+            except BaseException:
+                # failed or cancelled, keep the values not written
+                self._failed_flushes += 1
+                self._restore(pending)
+                raise
+            finally:
+                self._flush_ms.observe((time.perf_counter() - started) * 1000)
+            self._flushes += 1
+            self._written += written
+            return written
+
+    async def _write(self, conn, name: str, rows: list) -> int:
+        table, key, column_name, touch = self._targets[name]
+        target = table.c[column_name]
+        touched = {touch: utils.utc_now()} if touch is not None else {}
+        written = 0
+        for i in range(0, len(rows), self._batch_size):
+            batch = rows[i : i + self._batch_size]
+            if conn.dialect.name == "postgresql":
+                data = values(
+                    column("key", table.c[key].type), column("value", target.type), name="v"
+                ).data(batch)
+                sql = (
+                    update(table)
+                    .where(table.c[key] == data.c.key, or_(target.is_(None), target < data.c.value))
+                    .values({column_name: data.c.value, **touched})
+                )
+                result = await conn.execute(sql)
+            else:
+                sql = (
+                    update(table)
+                    .where(table.c[key] == bindparam("_key"), or_(target.is_(None), target < bindparam("_value")))
+                    .values({column_name: bindparam("_value"), **touched})
+                )
+                result = await conn.execute(sql, [{"_key": k, "_value": v} for k, v in batch])
+            written += max(result.rowcount, 0)
+        return written
+
+    async def _flush_quietly(self) -> None:
+        try:
+            await self.flush()
+        except Exception as e:
+            logger.warning(f"flushing write-behind values failed: {e}")
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self._flush_interval)
+            await self._flush_quietly()
+
+    def start(self) -> None:
+        """Flush every `flush_interval` seconds in a background task of the running loop."""
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self) -> None:
+        """Stop the background flushes, and flush the pending values. Call it at shutdown."""
+        for task in (self._task, self._size_flush):
+            if task is not None and not task.done():
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self._task = self._size_flush = None
+        await self._flush_quietly()
+
+    def snapshot(self) -> WriteBehindSnapshot:
+        return WriteBehindSnapshot(
+            pending=len(self._pending),
+            coalesced=self._coalesced,
+            written=self._written,
+            flushes=self._flushes,
+            failed_flushes=self._failed_flushes,
+            dropped=self._dropped,
+            deferred=self._deferred,
+            flush_ms=self._flush_ms.snapshot(),
+        )
@@ -2,43 +2,58 @@ import uuid
 from datetime import datetime
 from typing import Optional
 
-from sqlmodel import JSON, TIMESTAMP, UUID, Column, Field, SQLModel
+from sqlmodel import JSON, TIMESTAMP, UUID, Field, SQLModel
 
 
 class BaseModel(SQLModel):
-    """Base model for all tables"""
+    """Base model for all tables
+
+    Columns are declared with sa_type rather than sa_column, so that every table gets its own columns. Their
+    defaults are also column defaults, for rows inserted with sqlalchemy core.
+    """
+
+    id: uuid.UUID = Field(
+        default_factory=uuid.uuid4,
+        primary_key=True,
+        sa_type=UUID,
+        sa_column_kwargs={"default": uuid.uuid4},
+        description="The id of the record",
+    )
 
     tenant_id: Optional[uuid.UUID] = Field(
-        default="",
+        default=None,
         index=True,
-        sa_column=Column(UUID, default=uuid.uuid4),
+        nullable=True,
+        sa_type=UUID,
         description="The tenant id of the record",
     )
 
     created_at: Optional[datetime] = Field(
         nullable=False,
         default_factory=datetime.utcnow,
-        sa_column=Column(TIMESTAMP),
+        sa_type=TIMESTAMP,
+        sa_column_kwargs={"default": datetime.utcnow},
         description="Timestamp of record creation",
     )
 
     updated_at: Optional[datetime] = Field(
         nullable=False,
         default_factory=datetime.utcnow,
-        sa_column=Column(TIMESTAMP),
+        sa_type=TIMESTAMP,
+        sa_column_kwargs={"default": datetime.utcnow},
         description="Timestamp of record update",
     )
 
     deleted_at: Optional[datetime] = Field(
-        default=0,
-        nullable=False,
-        sa_column=Column(TIMESTAMP),
-        description="Timestamp of record deletion",
+        default=None,
+        nullable=True,
+        sa_type=TIMESTAMP,
+        description="Timestamp of record deletion, None while the record is not deleted",
     )
 
-    props: dict = Field(
+    props: Optional[dict] = Field(
         default=None,
         nullable=True,
-        sa_column=Column(JSON, default=None),
+        sa_type=JSON,
         description="Additional properties of the record",
     )
@@ -0,0 +1,72 @@
+import logging
+from typing import Dict
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+
+def _h2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+class ProviderHTTPClients:
+    """Long-lived httpx clients, one per oauth2 provider, so logins reuse kept-alive connections.
+
+    A token exchange or userinfo call on a fresh client pays a TCP and a TLS handshake, a pooled client
+    pays them once per connection. Clients are created on first use, and closed by `aclose()` at shutdown.
+    HTTP/2 requires the h2 package, without it clients fall back to HTTP/1.1.
+
+    Examples
+    --------
+    >>> clients = ProviderHTTPClients(http2=True)
+    >>> response = await clients.client("github").get("https://api.github.com/user", headers=headers)
+    >>> await clients.aclose()
+    """
+
+    def __init__(
+        self,
+        *,
+        timeout: float = 10.0,
+        connect_timeout: float = 5.0,
+        max_connections: int = 100,
+        max_keepalive_connections: int = 20,
+        keepalive_expiry: float = 60.0,
+        http2: bool = True,
+        transport: httpx.AsyncBaseTransport | None = None,
+    ) -> None:
+        if http2 and not _h2_available():
+            logger.warning("HTTP/2 requires h2, install it with `pip install httpx[http2]`, using HTTP/1.1.")
+            http2 = False
+        self._timeout = httpx.Timeout(timeout, connect=connect_timeout)
+        self._limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self._http2 = http2
+        # tests pass an httpx.MockTransport
+        self._transport = transport
+        self._clients: Dict[str, httpx.AsyncClient] = {}
+
+    def client(self, provider: str) -> httpx.AsyncClient:
+        client = self._clients.get(provider, None)
+        if client is None or client.is_closed:
+            client = httpx.AsyncClient(
+                timeout=self._timeout,
+                limits=self._limits,
+                http2=self._http2,
+                transport=self._transport,
+                headers={"Accept": "application/json"},
+            )
+            self._clients[provider] = client
+        return client
+
+    async def aclose(self) -> None:
+        clients, self._clients = list(self._clients.values()), {}
+        for client in clients:
+            await client.aclose()
@@ -1,6 +1,8 @@
 from .service import (
     AbstractOAuth2ClientService,
     AbstractOAuth2ProviderService,
+    CachingOAuth2ClientService,
+    CachingOAuth2ProviderService,
     DatabaseOAuth2ClientService,
     DatabaseOAuth2ProviderService,
 )
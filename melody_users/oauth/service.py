@@ -1,13 +1,19 @@
 import abc
+import logging
 import uuid
-from typing import Union
+from typing import List, Union
 
 from sqlalchemy.ext.asyncio.engine import AsyncEngine
 from sqlmodel import select
 from sqlmodel.ext.asyncio.session import AsyncSession
 
+from melody.cache import TTLCache
+from melody.config import cache_settings
+
 from .tables import OAuth2Client, OAuth2Provider
 
+logger = logging.getLogger(__name__)
+
 
 class AbstractOAuth2ProviderService(abc.ABC):
     """Abstract OAuth provider service."""
@@ -16,6 +22,11 @@ class AbstractOAuth2ProviderService(abc.ABC):
     async def get_provider(self, provider: str) -> Union[OAuth2Provider, None]:
         raise NotImplementedError()
 
+    @abc.abstractmethod
+    async def list_providers(self) -> List[OAuth2Provider]:
+        """List all providers, used to preload caches."""
+        raise NotImplementedError()
+
 
 class AbstractOAuth2ClientService(abc.ABC):
     """Abstract OAuth client service."""
@@ -46,11 +57,15 @@ class DatabaseOAuth2ProviderService(AbstractOAuth2ProviderService):
         """
         async with AsyncSession(self._engine) as sess:
             statememt = select(OAuth2Provider).where(OAuth2Provider.name == provider)
-            results = sess.exec(statememt).one_or_none()
+            results = (await sess.exec(statememt)).one_or_none()
             if not results:
                 return None
             return results
 
+    async def list_providers(self) -> List[OAuth2Provider]:
+        async with AsyncSession(self._engine) as sess:
+            return list((await sess.exec(select(OAuth2Provider))).all())
+
 
 class DatabaseOAuth2ClientService(AbstractOAuth2ClientService):
     """OAuth client service."""
@@ -80,7 +95,81 @@ class DatabaseOAuth2ClientService(AbstractOAuth2ClientService):
                 OAuth2Client.client_id == client_id,
                 OAuth2Client.tenant_id == self._tenant_id,
             )
-            client = sess.exec(statement).one_or_none()
+            client = (await sess.exec(statement)).one_or_none()
             if not client:
                 return None
             return client
+
+
+class CachingOAuth2ProviderService(AbstractOAuth2ProviderService):
+    """Caches the providers of another provider service.
+
+    Unknown providers are cached too, for `negative_ttl` seconds, so that requests for a bogus provider
+    do not hit the database. Call `invalidate()` after changing a provider.
+
+    Examples
+    --------
+    >>> service = CachingOAuth2ProviderService(DatabaseOAuth2ProviderService(engine=engine))
+    >>> await service.preload()
+    >>> provider = await service.get_provider("github")  # no query
+    """
+
+    def __init__(
+        self,
+        delegate: AbstractOAuth2ProviderService,
+        ttl: float = cache_settings.oauth2_cache_ttl,
+        negative_ttl: float = cache_settings.oauth2_negative_cache_ttl,
+        max_size: int = 1000,
+    ) -> None:
+        self._delegate = delegate
+        self.cache = TTLCache(max_size=max_size, ttl=ttl, negative_ttl=negative_ttl)
+
+    async def get_provider(self, provider: str) -> Union[OAuth2Provider, None]:
+        return await self.cache.get_or_load(provider, lambda: self._delegate.get_provider(provider))
+
+    async def list_providers(self) -> List[OAuth2Provider]:
+        return await self._delegate.list_providers()
+
+    async def preload(self) -> int:
+        """Load all providers into the cache, e.g. at startup. Returns the number of providers loaded."""
+        providers = await self._delegate.list_providers()
+        for provider in providers:
+            self.cache.set(provider.name, provider)
+        logger.info(f"preloaded {len(providers)} oauth2 providers.")
+        return len(providers)
+
+    def invalidate(self, provider: str | None = None) -> None:
+        """Invalidate a provider, or all providers if provider is None."""
+        if provider is None:
+            self.cache.clear()
+        else:
+            self.cache.invalidate(provider)
+
+
+class CachingOAuth2ClientService(AbstractOAuth2ClientService):
+    """Caches the clients of another client service, keyed by (provider, client_id).
+
+    Unknown clients are cached too, for `negative_ttl` seconds. Call `invalidate()` after changing a client.
+    """
+
+    def __init__(
+        self,
+        delegate: AbstractOAuth2ClientService,
+        ttl: float = cache_settings.oauth2_cache_ttl,
+        negative_ttl: float = cache_settings.oauth2_negative_cache_ttl,
+        max_size: int = 1000,
+    ) -> None:
+        self._delegate = delegate
+        self.cache = TTLCache(max_size=max_size, ttl=ttl, negative_ttl=negative_ttl)
+
+    async def get_client(self, provider: str, client_id: str) -> Union[OAuth2Client, None]:
+        return await self.cache.get_or_load(
+            (provider, client_id), lambda: self._delegate.get_client(provider=provider, client_id=client_id)
+        )
+
+    def invalidate(self, provider: str | None = None, client_id: str | None = None) -> None:
+        """Invalidate a client, or all clients if provider or client_id is None."""
+        if provider is None or client_id is None:
+            self.cache.clear()
+        else:
+            self.cache.invalidate((provider, client_id))
@@ -5,7 +5,10 @@ from uuid import uuid4
 from furl import furl
 from pydantic import BaseModel
 
+from melody.config import state_store_settings
+
 from .oauth2_providers import provider_repository
+from .state_store import ExpiringDict
 
 logger = logging.getLogger(__name__)
 
@@ -157,10 +160,14 @@ class OAuth2State(BaseModel):
 
 
 class OAuth2StateRepository:
-    """OAuth2 state repository"""
+    """OAuth2 state repository, states expire after `ttl` seconds and at most `max_size` states are kept.
 
-    def __init__(self) -> None:
-        self._states = {}
+    It is the synchronous counterpart of melody_users.state_store.MemoryStateStore, for `authorize()`.
+    """
+
+    def __init__(self, max_size: int = 100000, ttl: float = 60.0) -> None:
+        self._states = ExpiringDict(max_size=max_size)
+        self._ttl = ttl
 
     def save(self, state: OAuth2State, **kwargs) -> None:
         """Save the state to repository.
@@ -191,10 +198,9 @@ class OAuth2StateRepository:
                 **kwargs")
         >>> oauth2_state_repo.save(state)
         """
-        print("state: ", state)
         if not state:
             raise ValueError(f"state is required.")
-        self._states[state.id] = state
+        self._states.set(state.id, state, ttl=self._ttl)
 
     def delete(self, id: str) -> Union[OAuth2State, None]:
         """Delete the state from repository.
@@ -207,7 +213,7 @@ class OAuth2StateRepository:
         Returns
         -------
         OAuth2State
-            The state deleted from repository. None if not found.
+            The state deleted from repository. None if not found or expired.
 
         Raises
         ------
@@ -225,7 +231,9 @@ class OAuth2StateRepository:
         return self._states.pop(id, None)
 
 
-states_repository = OAuth2StateRepository()
+states_repository = OAuth2StateRepository(
+    max_size=state_store_settings.state_store_max_size, ttl=state_store_settings.oauth2_state_ttl
+)
 
 
 def _normalize_scope(scope: Union[str, List[str]]) -> str:
@@ -0,0 +1,295 @@
+import asyncio
+import logging
+import random
+import time
+from typing import Awaitable, Callable, Dict, List
+
+import httpx
+from pydantic import BaseModel
+
+from melody.metrics import Histogram, HistogramSnapshot
+
+logger = logging.getLogger(__name__)
+
+# responses of an unhealthy provider, retried for idempotent requests
+RETRYABLE_STATUS = (429, 500, 502, 503, 504)
+# errors raised before the request was sent, retried for any request
+_NOT_SENT = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+
+class CircuitOpenError(Exception):
+    """Raised when calls to a provider are short-circuited, because it failed too often recently."""
+
+    def __init__(self, provider: str) -> None:
+        super().__init__(f"provider {provider} is unavailable, calls are short-circuited")
+        self.provider = provider
+
+
+class CircuitBreaker:
+    """Opens after `failure_threshold` consecutive failures, and fails calls fast while open.
+
+    After `recovery_timeout` seconds it is half open: a single probe call is let through, its success closes
+    the breaker, its failure opens it again.
+    """
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(
+        self, failure_threshold: int = 5, recovery_timeout: float = 30.0, clock: Callable[[], float] = time.monotonic
+    ) -> None:
+        self._failure_threshold = failure_threshold
+        self._recovery_timeout = recovery_timeout
+        self._clock = clock
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+
+    @property
+    def state(self) -> str:
+        if self._state == self.OPEN and self._clock() - self._opened_at >= self._recovery_timeout:
+            self._state = self.HALF_OPEN
+        return self._state
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == self.CLOSED:
+            return True
+        if state == self.HALF_OPEN and not self._probing:
+            self._probing = True
+            return True
+        return False
+
+    def release(self) -> None:
+        """Release the probe of a call that ended without outcome, e.g. cancelled, the next call probes again."""
+        self._probing = False
+
+    def record_success(self) -> None:
+        self._state, self._failures, self._probing = self.CLOSED, 0, False
+
+    def record_failure(self) -> None:
+        self._failures += 1
+        if self.state == self.HALF_OPEN or self._failures >= self._failure_threshold:
+            if self._state != self.OPEN:
+                logger.warning(f"circuit opened after {self._failures} failures")
+            self._state, self._opened_at, self._probing = self.OPEN, self._clock(), False
+
+
+class RetryBudget:
+    """Bounds retries and hedges to `ratio` of the calls, plus `min_per_second`, so they cannot multiply the load
+    of a struggling provider.
+
+    Every call deposits `ratio` tokens, every retry withdraws one. Tokens also refill at `min_per_second`, and at
+    most `max_tokens` are kept.
+    """
+
+    def __init__(
+        self,
+        ratio: float = 0.2,
+        min_per_second: float = 1.0,
+        max_tokens: float = 10.0,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self._ratio = ratio
+        self._min_per_second = min_per_second
+        self._max_tokens = max_tokens
+        self._clock = clock
+        self._tokens = max_tokens
+        self._refilled_at = clock()
+
+    def _refill(self, tokens: float) -> None:
+        self._tokens = min(self._max_tokens, self._tokens + tokens)
+
+    def deposit(self) -> None:
+        self._refill(self._ratio)
+
+    def withdraw(self) -> bool:
+        now = self._clock()
+        self._refill((now - self._refilled_at) * self._min_per_second)
+        self._refilled_at = now
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+
+class EndpointStats(BaseModel):
+    requests: int = 0
+    errors: int = 0
+    retries: int = 0
+    hedges: int = 0
+    short_circuited: int = 0
+    latency_ms: HistogramSnapshot = HistogramSnapshot()
+
+
+class ProviderStats(BaseModel):
+    provider: str
+    breaker: str
+    endpoints: Dict[str, EndpointStats] = {}
+
+
+class _EndpointMetrics:
+    def __init__(self) -> None:
+        self.requests = self.errors = self.retries = self.hedges = self.short_circuited = 0
+        self.latency = Histogram()
+
+    def snapshot(self) -> EndpointStats:
+        return EndpointStats(
+            requests=self.requests,
+            errors=self.errors,
+            retries=self.retries,
+            hedges=self.hedges,
+            short_circuited=self.short_circuited,
+            latency_ms=self.latency.snapshot(),
+        )
+
+
+class ProviderGuard:
+    """Deadlines, retries, a circuit breaker and hedged requests around the calls to one oauth2 provider.
+
+    A call takes at most `deadline` seconds and each attempt `attempt_timeout` seconds. Failed attempts are
+    retried up to `max_attempts` with full jitter backoff, while the retry budget allows it. Requests that are
+    not idempotent, such as the token exchange whose code is single use, are only retried if they were not sent.
+    Idempotent requests may be hedged: if the first attempt is slower than `hedge_delay` seconds, or than the
+    p95 latency of the endpoint once known, a second one is sent and the first response wins.
+
+    Examples
+    --------
+    >>> guard = ProviderGuard("github", hedge_delay=0.2)
+    >>> response = await guard.request("userinfo", lambda: client.get(url), idempotent=True, hedge=True)
+    """
+
+    def __init__(
+        self,
+        provider: str,
+        *,
+        deadline: float = 10.0,
+        attempt_timeout: float = 5.0,
+        max_attempts: int = 3,
+        backoff_base: float = 0.05,
+        backoff_max: float = 1.0,
+        hedge_delay: float = 0.0,
+        failure_threshold: int = 5,
+        recovery_timeout: float = 30.0,
+        retry_ratio: float = 0.2,
+        min_retries_per_second: float = 1.0,
+    ) -> None:
+        self.provider = provider
+        self._deadline = deadline
+        self._attempt_timeout = attempt_timeout
+        self._max_attempts = max_attempts
+        self._backoff_base = backoff_base
+        self._backoff_max = backoff_max
+        self._hedge_delay = hedge_delay
+        self.breaker = CircuitBreaker(failure_threshold=failure_threshold, recovery_timeout=recovery_timeout)
+        self.budget = RetryBudget(ratio=retry_ratio, min_per_second=min_retries_per_second)
+        self._metrics: Dict[str, _EndpointMetrics] = {}
+
+    def _endpoint(self, endpoint: str) -> _EndpointMetrics:
+        metrics = self._metrics.get(endpoint, None)
+        if metrics is None:
+            metrics = self._metrics[endpoint] = _EndpointMetrics()
+        return metrics
+
+    async def request(
+        self, endpoint: str, send: Callable[[], Awaitable[httpx.Response]], *, idempotent: bool, hedge: bool = False
+    ) -> httpx.Response:
+        """Send a request to the provider with `send`, returns the last response.
+
+        Raises CircuitOpenError if the provider is short-circuited, TimeoutError past the deadline, or the
+        httpx.TransportError of the last attempt.
+        """
+        metrics = self._endpoint(endpoint)
+        if not self.breaker.allow():
+            metrics.short_circuited += 1
+            raise CircuitOpenError(self.provider)
+        metrics.requests += 1
+        self.budget.deposit()
+        started = time.perf_counter()
+        try:
+            async with asyncio.timeout(self._deadline):
+                response = await self._attempts(send, idempotent, hedge and self._hedge_delay > 0, metrics)
+        except Exception:
+            metrics.errors += 1
+            self.breaker.record_failure()
+            raise
+        except BaseException:
+            self.breaker.release()
+            raise
+        finally:
+            metrics.latency.observe((time.perf_counter() - started) * 1000)
+        if response.status_code in RETRYABLE_STATUS:
+            metrics.errors += 1
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+        return response
+
+    async def _attempts(self, send, idempotent: bool, hedge: bool, metrics: _EndpointMetrics) -> httpx.Response:
+        attempt = 0
+        while True:
+            attempt += 1
+            response, error = None, None
+            try:
+                response = await self._attempt(send, hedge, metrics)
+                if not idempotent or response.status_code not in RETRYABLE_STATUS:
+                    return response
+            except (httpx.TransportError, TimeoutError) as e:
+                if not idempotent and not isinstance(e, _NOT_SENT):
+                    raise
+                error = e
+            if attempt >= self._max_attempts or not self.budget.withdraw():
+                if error is not None:
+                    raise error
+                return response
+            metrics.retries += 1
+            await asyncio.sleep(random.uniform(0, min(self._backoff_max, self._backoff_base * 2**attempt)))
+
+    async def _attempt(self, send, hedge: bool, metrics: _EndpointMetrics) -> httpx.Response:
+        async with asyncio.timeout(self._attempt_timeout):
+            if not hedge:
+                return await send()
+            delay = self._hedge_delay
+            if metrics.latency.count >= 20:
+                delay = max(delay, metrics.latency.percentile(0.95) / 1000)
+            tasks = [asyncio.ensure_future(send())]
+            try:
+                done, _ = await asyncio.wait(tasks, timeout=delay)
+                if not done and self.budget.withdraw():
+                    metrics.hedges += 1
+                    tasks.append(asyncio.ensure_future(send()))
+                pending, error = set(tasks), None
+                while pending:
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        if task.exception() is None:
+                            return task.result()
+                        error = task.exception()
+                raise error
+            finally:
+                for task in tasks:
+                    task.cancel()
+
+    def snapshot(self) -> ProviderStats:
+        return ProviderStats(
+            provider=self.provider,
+            breaker=self.breaker.state,
+            endpoints={endpoint: metrics.snapshot() for endpoint, metrics in self._metrics.items()},
+        )
+
+
+class ProviderGuards:
+    """A ProviderGuard per provider, created on first use with the same options."""
+
+    def __init__(self, **options) -> None:
+        self._options = options
+        self._guards: Dict[str, ProviderGuard] = {}
+
+    def guard(self, provider: str) -> ProviderGuard:
+        guard = self._guards.get(provider, None)
+        if guard is None:
+            guard = self._guards[provider] = ProviderGuard(provider, **self._options)
+        return guard
+
+    def snapshot(self) -> List[ProviderStats]:
+        return [guard.snapshot() for guard in self._guards.values()]
@@ -1,30 +1,201 @@
+import asyncio
 import logging
+import time
 import uuid
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 from authlib.common.security import generate_token
-from typing import Optional, Tuple, Union
+from typing import Dict, List, Optional, Tuple, Union
 import httpx
-from authlib.integrations.httpx_client import AsyncOAuth2Client
+from authlib.oauth2.client import OAuth2Client as AuthorizationURLBuilder
+from sqlalchemy import insert
 from sqlalchemy.ext.asyncio import AsyncEngine
-from sqlmodel import select
 from sqlmodel.ext.asyncio.session import AsyncSession
 
+from melody.config import (
+    provider_http_settings,
+    session_settings,
+    state_store_settings,
+    sweeper_settings,
+    write_behind_settings,
+)
+from melody.identity import crud as identity_crud
+from melody.identity.exception import IdentityException
+from melody.identity.models import EmailIdentityLoginRequest, OAuth2IdentityLoginRequest
+from melody.metrics import Histogram, HistogramSnapshot
+from melody.shard.router import ShardMap
+from melody.sweeper import ExpirySweeper
+from melody.write_behind import WriteBehindBuffer
+
+from .http_clients import ProviderHTTPClients
 from .oauth import AbstractOAuth2ClientService, AbstractOAuth2ProviderService, OAuth2Client, OAuth2Provider
-from .oauth.service import DatabaseOAuth2ClientService, DatabaseOAuth2ProviderService
+from .oauth.service import (
+    CachingOAuth2ClientService,
+    CachingOAuth2ProviderService,
+    DatabaseOAuth2ClientService,
+    DatabaseOAuth2ProviderService,
+)
+from .resilience import ProviderGuards, ProviderStats
+from .sessions import SessionValidator, ValidatedSession
+from .signed_sessions import RevocationList, RevocationSync, SignedSessionTokens, SigningKeyring
 from .settings import oauth2_settings
+from .state_store import StateStore, create_state_store
 from .tables import Identity, OAuth2State, OAuth2Token, Session, User
 
 logger = logging.getLogger(__name__)
 
+CALLBACK_STAGES = ("state", "lookup", "token", "userinfo", "persist", "total")
+# write-behind target of Session.refreshed_at
+SESSION_REFRESH = "sessions.refreshed_at"
+
 
 class UserService:
     """The User Service"""
 
-    def __init__(self, engine: AsyncEngine, tenant_id: uuid.UUID, **kwargs) -> None:
+    def __init__(
+        self,
+        engine: AsyncEngine,
+        tenant_id: uuid.UUID,
+        state_store: StateStore | None = None,
+        http_clients: ProviderHTTPClients | None = None,
+        shard_map: ShardMap | None = None,
+        **kwargs,
+    ) -> None:
         self._engine = engine
+        # identities are written to the shard of their tenant, rejected while the tenant is being moved
+        self._shard_map = shard_map
         self._tenant_id = tenant_id
-        self._oauth2_provider_service = DatabaseOAuth2ProviderService(engine=engine)
-        self._oauth2_client_service = DatabaseOAuth2ClientService(engine=engine, tenant_id=tenant_id)
+        # oauth2 states live until their callback, shared by all processes unless a per process backend is used
+        self._state_store = state_store or create_state_store(
+            state_store_settings.state_store_backend,
+            url=state_store_settings.state_store_url,
+            max_size=state_store_settings.state_store_max_size,
+            engine=engine,
+            table=OAuth2State.__table__,
+        )
+        # kept-alive connections to the oauth2 providers, shared by all logins
+        self._http_clients = http_clients or ProviderHTTPClients(
+            timeout=provider_http_settings.provider_http_timeout,
+            connect_timeout=provider_http_settings.provider_http_connect_timeout,
+            max_connections=provider_http_settings.provider_http_max_connections,
+            max_keepalive_connections=provider_http_settings.provider_http_max_keepalive_connections,
+            keepalive_expiry=provider_http_settings.provider_http_keepalive_expiry,
+            http2=provider_http_settings.provider_http2,
+        )
+        # validates session tokens on every api call, see melody_users.sessions.session_dependency()
+        self.sessions = SessionValidator(
+            engine,
+            Session.__table__,
+            cache_enabled=session_settings.session_cache_enabled,
+            max_size=session_settings.session_cache_max_size,
+            ttl=session_settings.session_cache_ttl,
+            negative_ttl=session_settings.session_negative_cache_ttl,
+        )
+        # signed session tokens verified without I/O, when session_mode is "signed"
+        self.signed_sessions: SignedSessionTokens | None = None
+        self.revocation_sync: RevocationSync | None = None
+        if session_settings.session_mode == "signed":
+            keyring = SigningKeyring(
+                {kid: secret.encode("utf-8") for kid, secret in session_settings.session_signing_keys.items()},
+                active=session_settings.session_signing_key_id,
+                grace=session_settings.session_key_grace,
+                retire_at=session_settings.session_retired_keys,
+            )
+            revocations = RevocationList(capacity=session_settings.session_revocation_capacity)
+            self.signed_sessions = SignedSessionTokens(keyring, revocations)
+            self.revocation_sync = RevocationSync(engine, Session.__table__, revocations)
+        # last_signin_at of identities and users, and refreshed_at of sessions, written in batches
+        self.last_seen: WriteBehindBuffer | None = None
+        self.refreshes: WriteBehindBuffer | None = None
+        if write_behind_settings.write_behind_enabled:
+            self.last_seen = identity_crud.register_signin_targets(self._write_behind(shard_map or engine))
+            # sessions are not sharded, their refreshes are written to the engine of the service
+            self.refreshes = self.last_seen if shard_map is None else self._write_behind(engine)
+            self.refreshes.register(SESSION_REFRESH, Session.__table__, key="sid", column="refreshed_at")
+        # latency of each stage of the oauth2 callbacks
+        self._callback_stages = {stage: Histogram() for stage in CALLBACK_STAGES}
+        # deadlines, retries, circuit breakers and hedging of the provider calls, and their metrics
+        self._provider_guards = ProviderGuards(
+            deadline=provider_http_settings.provider_http_deadline,
+            attempt_timeout=provider_http_settings.provider_http_attempt_timeout,
+            max_attempts=provider_http_settings.provider_http_max_attempts,
+            backoff_base=provider_http_settings.provider_http_backoff_base,
+            backoff_max=provider_http_settings.provider_http_backoff_max,
+            hedge_delay=provider_http_settings.provider_http_hedge_delay,
+            failure_threshold=provider_http_settings.provider_breaker_failure_threshold,
+            recovery_timeout=provider_http_settings.provider_breaker_recovery_timeout,
+            retry_ratio=provider_http_settings.provider_http_retry_ratio,
+            min_retries_per_second=provider_http_settings.provider_http_min_retries_per_second,
+        )
+        self._oauth2_provider_service = CachingOAuth2ProviderService(DatabaseOAuth2ProviderService(engine=engine))
+        self._oauth2_client_service = CachingOAuth2ClientService(
+            DatabaseOAuth2ClientService(engine=engine, tenant_id=tenant_id)
+        )
+        # expired oauth2 states, sessions and oauth2 tokens of all tenants, timestamps are naive utc
+        self.sweeper = ExpirySweeper(
+            engine,
+            [OAuth2State.__table__, Session.__table__, OAuth2Token.__table__],
+            retention=sweeper_settings.sweeper_retention,
+            retentions=sweeper_settings.sweeper_retentions,
+            batch_size=sweeper_settings.sweeper_batch_size,
+            batch_pause=sweeper_settings.sweeper_batch_pause,
+            max_batches=sweeper_settings.sweeper_max_batches,
+            clock=datetime.utcnow,
+        )
+
+    async def preload(self) -> None:
+        """Preload the oauth2 providers into the cache, call it at startup."""
+        await self._oauth2_provider_service.preload()
+
+    def start_sweeper(self) -> None:
+        """Start deleting expired rows in the background, if enabled in SweeperSettings. Call it at startup.
+
+        Run a single service per process with the sweeper started, its metrics are in `self.sweeper.snapshot()`.
+        """
+        if sweeper_settings.sweeper_enabled:
+            self.sweeper.start(interval=sweeper_settings.sweeper_interval)
+
+    async def start_revocation_sync(self) -> None:
+        """Load the revoked signed sessions and keep syncing them in the background. Call it at startup."""
+        if self.revocation_sync is not None:
+            await self.revocation_sync.sync()
+            self.revocation_sync.start(interval=session_settings.session_revocation_sync_interval)
+
+    def start_write_behind(self) -> None:
+        """Start flushing last_signin_at and refreshed_at in the background. Call it at startup."""
+        for buffer in self._write_behind_buffers():
+            buffer.start()
+
+    async def aclose(self) -> None:
+        """Stop the background tasks of the service, close its state store and http clients, call it at shutdown.
+
+        The pending last_signin_at and refreshed_at are flushed first.
+        """
+        for buffer in self._write_behind_buffers():
+            await buffer.stop()
+        await self.sweeper.stop()
+        if self.revocation_sync is not None:
+            await self.revocation_sync.stop()
+        await self._state_store.aclose()
+        await self._http_clients.aclose()
+
+    def provider_stats(self) -> List[ProviderStats]:
+        """Latency, errors, retries, hedges and circuit state of the calls to each oauth2 provider."""
+        return self._provider_guards.snapshot()
+
+    def callback_stats(self) -> Dict[str, HistogramSnapshot]:
+        """Latency of each stage of the oauth2 callbacks, in milliseconds."""
+        return {stage: histogram.snapshot() for stage, histogram in self._callback_stages.items()}
+
+    def invalidate_oauth2_cache(self, provider: str | None = None) -> None:
+        """Invalidate cached oauth2 providers and clients, after they were changed in the database.
+
+        Parameters:
+        -----------
+        provider: str, the provider to invalidate, or None to invalidate all providers
+        """
+        self._oauth2_provider_service.invalidate(provider)
+        self._oauth2_client_service.invalidate()
 
     async def login_with_oauth(self, provider: str, client_id: str, **kwargs) -> str:
         """Login with oauth.
@@ -68,100 +239,245 @@ class UserService:
         scope = self._resolve_oauth2_scope(oauth2_client)
         code_challenge_method = _resolve_code_challenge_method()
         code_verifier = generate_token(length=64)
-        oauth_client = AsyncOAuth2Client(
+        # builds the url without a http client, no connection is needed before the callback
+        url_builder = AuthorizationURLBuilder(
+            None,
             client_id=oauth2_client.client_id,
             client_secret=oauth2_client.client_secret,
             redirect_uri=oauth2_client.redirect_uri,
             scope=scope,
+            code_challenge_method=code_challenge_method,
         )
-        url, state = oauth_client.create_authorization_url(
+        url, state = url_builder.create_authorization_url(
             url=oauth2_provider.auth_url,
             response_type="code",
             code_verifier=code_verifier,
-            code_challenge_method=code_challenge_method,
         )
 
-        async with AsyncSession(self._engine) as session:
-            # save oauth2 state
-            oauth_state = OAuth2State(
-                state=state,
-                provider=provider,
-                client_id=oauth2_client.client_id,
-                code_verifier=code_verifier,
-                code_challenge_method=code_challenge_method,
-                expires_at=datetime.utcnow() + timedelta(days=0, seconds=60),
-                tenant_id=self._tenant_id,
-            )
-            session.add(oauth_state)
-            await session.commit()
-            await session.refresh(oauth_state)
-            logger.debug(f"saved oauth2 state: {oauth_state}")
+        # save oauth2 state
+        await self._state_store.put(
+            self._state_key(state),
+            {
+                "provider": provider,
+                "client_id": oauth2_client.client_id,
+                "code_verifier": code_verifier,
+                "code_challenge_method": code_challenge_method,
+            },
+            ttl=state_store_settings.oauth2_state_ttl,
+        )
+        logger.debug(f"saved oauth2 state: {state}")
         logger.debug(f"Login with oauth: {url}")
         return url
 
     async def login_with_oauth_callback(self, code: str, state: str, **kwargs) -> Union[str, None]:
-        """Login with oauth callback"""
-        async with AsyncSession(self._engine) as session:
-            oauth2_state = await self._resolve_oauth2_state(session=session, state=state, **kwargs)
-            session.delete(oauth2_state)
-
-            oauth2_client = await self._resolve_oauth2_client(oauth2_state=oauth2_state, **kwargs)
-            oauth2_provider = await self._resolve_oauth2_provider(oauth2_state=oauth2_state, **kwargs)
-            # fetch token response
-            token = await self._exchange_oauth2_token(
-                oauth2_client=oauth2_client,
-                oauth2_provider=oauth2_provider,
-                oauth2_state=oauth2_state,
-                code=code,
-            )
-            logger.debug(f"fetched token from provider: {token}")
-            # fetch user info
-            user = await self._fetch_user_info(url=oauth2_provider.user_url, access_token=token.get("access_tokeen"))
-            logger.debug(f"fetched user info: {user}")
-            # create user
-
-            # create identity
-
-            # save oauth2 tokens
-            oauth2_token = OAuth2Token(
-                provider=oauth2_client.provider,
-                client_id=oauth2_client.client_id,
-                access_token=token.get("access_token"),
-                refresh_token=token.get("refresh_token"),
-                expires_at=datetime.utcnow() + timedelta(days=0, seconds=token.get("expires_at", 0)),
-                scope=token.get("scope"),
-                tenant_id=self._tenant_id,
-            )
-            session.add(oauth2_token)
-            session.refresh()
-            # delete state
+        """Login with oauth callback, creating the user and its identity on first login.
+
+        The callback runs as a pipeline: the state is taken, the client and provider are looked up concurrently,
+        the code is exchanged for a token, the user info is fetched, and the user, identity and token are written
+        in a single transaction. Each stage is timed, see `callback_stats()`.
+
+        Parameters:
+        -----------
+        code: str, the authorization code returned by the provider
+        state: str, the state returned by the provider
+
+        Returns:
+        --------
+        user_id: str, the id of the user who logged in
+
+        Raises:
+        -------
+        ValueError: If the state is unknown or expired, or the client or provider is not found.
+        CircuitOpenError: If calls to the provider are short-circuited.
+        IdentityException: If the identity of the user is not active.
+        """
+        timings = {}
+        with self._timed("total", timings):
+            with self._timed("state", timings):
+                oauth2_state = await self._resolve_oauth2_state(state=state, **kwargs)
+            with self._timed("lookup", timings):
+                oauth2_client, oauth2_provider = await asyncio.gather(
+                    self._resolve_oauth2_client(oauth2_state=oauth2_state, **kwargs),
+                    self._resolve_oauth2_provider(oauth2_state=oauth2_state, **kwargs),
+                )
+            with self._timed("token", timings):
+                token = await self._exchange_oauth2_token(
+                    oauth2_client=oauth2_client,
+                    oauth2_provider=oauth2_provider,
+                    oauth2_state=oauth2_state,
+                    code=code,
+                )
+            with self._timed("userinfo", timings):
+                user_info = await self._fetch_user_info(
+                    provider=oauth2_provider.name, url=oauth2_provider.user_url, access_token=token.get("access_token")
+                )
+            logger.debug(f"fetched user info: {user_info}")
+            with self._timed("persist", timings):
+                # no session is held while waiting on the provider, the writes are short transactions
+                request = self._oauth2_login_request(provider=oauth2_provider.name, user_info=user_info)
+                async with self._identity_session(request.tenant_id) as session:
+                    async with session.begin():
+                        identity = await identity_crud.login_with_oauth2(session, request=request, last_seen=self.last_seen)
+                        user_id = str(identity.user_id)
+                        if self._shard_map is None:
+                            self._save_access_token(session, oauth2_client, token, user_id=identity.user_id)
+                if self._shard_map is not None:
+                    async with AsyncSession(self._engine) as session:
+                        async with session.begin():
+                            self._save_access_token(session, oauth2_client, token, user_id=identity.user_id)
+        logger.debug(f"login with oauth callback, stages ms: {timings}")
+        return user_id
 
     async def login_with_password(self, email: str, password: str, **kwargs) -> Union[str, None]:
-        """Login with password"""
-        raise NotImplementedError
-
-    async def _upsert_user(self, session: AsyncSession, user: dict, **kwargs) -> User:
-        user = User(**user)
-        session.add(user)
-        await session.commit()
-        await session.refresh(user)
-        return user
-
-    async def _fetch_user_info(self, url: str, access_token: str, **kwargs):
-        async with httpx.get(
-            url=url,
-            headers={"Authorization": f"Bearer {access_token}"},
-        ) as response:
-            if response.status_code == 200:
-                return response.json()
-            else:
-                raise Exception(f"Cannot fetch user info: {response.text}")
-
-    async def _save_access_token(self, session: AsyncSession, oauth_client, oauth2_token: dict, **kwargs) -> OAuth2Token:
-        statement = select(OAuth2Token).where(OAuth2Token.provider == oauth_client.provider)
-        now = datetime.now()
-        expires_at = now + timedelta(days=0, seconds=oauth2_token.get("expires_at", 0))
+        """Login with password.
+
+        Parameters:
+        -----------
+        email: str, the email of the EMAIL identity
+        password: str, the plain password
+
+        Returns:
+        --------
+        user_id: str, the id of the user who owns the identity, or None if email or password mismatch
+
+        Raises:
+        -------
+        LimiterSaturatedError: If too many logins are waiting for verification.
+        LimiterTimeoutError: If the login waited too long for verification.
+        """
+        request = EmailIdentityLoginRequest(tenant_id=str(self._tenant_id), email=email, password=password)
+        async with self._identity_session(request.tenant_id) as session:
+            try:
+                identity = await identity_crud.login_with_email(session, request=request, last_seen=self.last_seen)
+            except IdentityException as e:
+                logger.info(f"Login with password failed: {e}")
+                return None
+            user_id = str(identity.user_id)
+            await session.commit()
+        return user_id
+
+    async def create_session(
+        self, user_id: uuid.UUID, iden_id: uuid.UUID, user_agent: str = "", ip_address: str = "", **kwargs
+    ) -> str:
+        """Create a session of a signed in user, returns its token, signed if session_mode is "signed".
+
+        Parameters:
+        -----------
+        user_id: uuid.UUID, the user of the session
+        iden_id: uuid.UUID, the identity the user signed in with
+        """
+        auth_token = generate_token(48)
+        # public, in signed tokens and revocations: knowing it does not let anyone use the session
+        sid = generate_token(24)
+        expires_at = datetime.utcnow() + timedelta(seconds=session_settings.session_ttl)
+        sql = insert(Session.__table__).values(
+            tenant_id=self._tenant_id,
+            user_id=user_id,
+            iden_id=iden_id,
+            auth_token=auth_token,
+            sid=sid,
+            expires_at=expires_at,
+            user_agent=user_agent,
+            ip_address=ip_address,
+        )
+        async with self._engine.begin() as conn:
+            await conn.execute(sql)
+        if self.signed_sessions is None:
+            return auth_token
+        return self.signed_sessions.issue(
+            sid=sid, user_id=user_id, iden_id=iden_id, tenant_id=self._tenant_id, expires_at=expires_at
+        )
+
+    async def validate_session(self, auth_token: str) -> Optional[ValidatedSession]:
+        """The session of the token, None if it is not valid. Signed tokens are verified without I/O."""
+        if self.signed_sessions is not None:
+            return self.signed_sessions.verify(auth_token)
+        return await self.sessions.validate(auth_token)
+
+    async def refresh_session(self, auth_token: str, **kwargs) -> Optional[ValidatedSession]:
+        """Validate the token and record the use of its session in refreshed_at, written in the next batch."""
+        session = await self.validate_session(auth_token)
+        if session is not None and session.sid is not None and self.refreshes is not None:
+            await self.refreshes.record(SESSION_REFRESH, session.sid, datetime.utcnow())
+        return session
+
+    async def logout(self, auth_token: str, **kwargs) -> bool:
+        """Logout, revoking the session of the token at once.
+
+        Returns:
+        --------
+        revoked: bool, False if the token had no session
+        """
+        if self.signed_sessions is not None:
+            session = self.signed_sessions.verify(auth_token)
+            return session is not None and await self.revocation_sync.revoke(session.sid)
+        return await self.sessions.revoke(auth_token)
+
+    @staticmethod
+    def _write_behind(engine: AsyncEngine | ShardMap) -> WriteBehindBuffer:
+        return WriteBehindBuffer(
+            engine,
+            max_pending=write_behind_settings.write_behind_max_pending,
+            flush_size=write_behind_settings.write_behind_flush_size,
+            flush_interval=write_behind_settings.write_behind_flush_interval,
+            batch_size=write_behind_settings.write_behind_batch_size,
+        )
+
+    def _write_behind_buffers(self) -> List[WriteBehindBuffer]:
+        if self.last_seen is None:
+            return []
+        return [self.last_seen] if self.refreshes is self.last_seen else [self.last_seen, self.refreshes]
+
+    def _identity_session(self, tenant_id: str):
+        if self._shard_map is None:
+            return AsyncSession(self._engine)
+        return self._shard_map.session(tenant_id, write=True)
+
+    @contextmanager
+    def _timed(self, stage: str, timings: Dict[str, float]):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            timings[stage] = (time.perf_counter() - started) * 1000
+            self._callback_stages[stage].observe(timings[stage])
+
+    def _oauth2_login_request(self, provider: str, user_info: dict) -> OAuth2IdentityLoginRequest:
+        # github: id, login, name, email; openid connect: sub, preferred_username, name, email
+        provider_uid = str(user_info.get("id") or user_info.get("sub") or "")
+        if not provider_uid:
+            raise ValueError(f"Cannot find the user id in the user info of provider {provider}")
+        username = user_info.get("login") or user_info.get("preferred_username") or ""
+        return OAuth2IdentityLoginRequest(
+            tenant_id=str(self._tenant_id),
+            provider_id=provider,
+            provider_uid=provider_uid,
+            username=username,
+            nickname=user_info.get("name") or username,
+            email=user_info.get("email") or "",
+        )
+
+    async def _fetch_user_info(self, provider: str, url: str, access_token: str, **kwargs):
+        client = self._http_clients.client(provider)
+        response = await self._provider_guards.guard(provider).request(
+            "userinfo",
+            lambda: client.get(url=url, headers={"Authorization": f"Bearer {access_token}"}),
+            idempotent=True,
+            hedge=True,
+        )
+        if response.status_code == 200:
+            return response.json()
+        else:
+            raise Exception(f"Cannot fetch user info: {response.text}")
+
+    def _save_access_token(
+        self, session: AsyncSession, oauth_client, oauth2_token: dict, user_id: uuid.UUID, **kwargs
+    ) -> OAuth2Token:
+        expires_at = None
+        if oauth2_token.get("expires_in"):
+            expires_at = datetime.utcnow() + timedelta(seconds=int(oauth2_token["expires_in"]))
         token = OAuth2Token(
+            user_id=user_id,
             provider=oauth_client.provider,
             client_id=oauth_client.client_id,
             access_token=oauth2_token.get("access_token"),
@@ -171,37 +487,46 @@ class UserService:
             tenant_id=self._tenant_id,
         )
         session.add(token)
+        return token
 
     async def _exchange_oauth2_token(
         self, oauth2_client: OAuth2Client, oauth2_provider: OAuth2Provider, oauth2_state: OAuth2State, code: str
     ) -> dict:
-        client = AsyncOAuth2Client(
-            client_id=oauth2_client.client_id,
-            client_secret=oauth2_client.client_secret,
-            scope=self._resolve_oauth2_scope(oauth2_client),
-            redirect_uri=oauth2_client.redirect_uri,
-            code_challenge_method=oauth2_client.code_challenge_method,
-        )
-        token = await client.fetch_token(
-            url=oauth2_provider.token_url,
-            grant_type="authorization_code",
-            code=code,
-            code_verifier=oauth2_state.code_verifier,
+        data = {
+            "grant_type": "authorization_code",
+            "code": code,
+            "redirect_uri": oauth2_client.redirect_uri,
+        }
+        if oauth2_state.code_challenge_method:
+            data["code_verifier"] = oauth2_state.code_verifier
+        # client_secret_basic, the default token endpoint auth method of authlib
+        client = self._http_clients.client(oauth2_provider.name)
+        # the code is single use, the exchange is only retried if it was not sent
+        response = await self._provider_guards.guard(oauth2_provider.name).request(
+            "token",
+            lambda: client.post(
+                url=oauth2_provider.token_url,
+                data=data,
+                auth=httpx.BasicAuth(oauth2_client.client_id, oauth2_client.client_secret),
+            ),
+            idempotent=False,
         )
+        if response.status_code != 200:
+            raise Exception(f"Cannot exchange oauth2 token: {response.text}")
+        token = response.json()
+        if "error" in token:
+            raise Exception(f"Cannot exchange oauth2 token: {token['error']}")
         return token
 
-    async def _resolve_oauth2_state(self, session: AsyncSession, state: str, **kwargs) -> OAuth2State:
-        statment = select(OAuth2State).where(OAuth2State.state == state, OAuth2State.tenant_id == self._tenant_id)
-        oauth_state = await session.exec(statment).one_or_none()
-        if not oauth_state:
-            raise ValueError(f"Cannot find oauth2 state for state {state}")
-        expires_at = oauth_state.expires_at
-        if expires_at is not None and 0 < expires_at < datetime.utcnow():
-            session.delete(oauth_state)
-            session.commit()
-            logger.warning(f"OAuth2 state expired")
-            raise ValueError(f"OAuth2 state expired")
-        return oauth_state
+    def _state_key(self, state: str) -> str:
+        return f"{self._tenant_id}:{state}"
+
+    async def _resolve_oauth2_state(self, state: str, **kwargs) -> OAuth2State:
+        # taken once, a replayed callback cannot find it anymore
+        values = await self._state_store.take(self._state_key(state))
+        if not values:
+            raise ValueError(f"Cannot find oauth2 state for state {state}, or it expired")
+        return OAuth2State(state=state, tenant_id=self._tenant_id, **values)
 
     async def _resolve_oauth2_client(self, oauth2_state: OAuth2State, **kwargs):
         provider = oauth2_state.provider
@@ -214,12 +539,12 @@ class UserService:
         return oauth2_client
 
     async def _resolve_oauth2_provider(self, oauth2_state: OAuth2State, **kwargs) -> OAuth2Provider:
-        oauth2_provider = self._oauth2_provider_service.get_provider(provider=oauth2_state.provider)
+        oauth2_provider = await self._oauth2_provider_service.get_provider(provider=oauth2_state.provider)
         if not oauth2_provider:
             raise ValueError(f"Cannot find provider {oauth2_state.provider}")
         return oauth2_provider
 
-    async def _resolve_oauth2_scope(self, oauth2_client: OAuth2Client, **kwargs):
+    def _resolve_oauth2_scope(self, oauth2_client: OAuth2Client, **kwargs):
         if not oauth2_client.scope:
             return None
         scopes = str(oauth2_client.scope).split()
@@ -0,0 +1,141 @@
+import logging
+import uuid
+from datetime import datetime
+from typing import TYPE_CHECKING, Callable, Optional
+
+from fastapi import HTTPException, Request, status
+from pydantic import BaseModel
+from sqlalchemy import Table, bindparam, delete, select
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from melody.cache import TTLCache
+
+if TYPE_CHECKING:
+    from .signed_sessions import SignedSessionTokens
+
+logger = logging.getLogger(__name__)
+
+
+class ValidatedSession(BaseModel):
+    """The columns of a valid session needed per request, the token itself is not kept."""
+
+    user_id: uuid.UUID
+    iden_id: uuid.UUID
+    tenant_id: Optional[uuid.UUID] = None
+    expires_at: Optional[datetime] = None
+    # the public id of the session, in signed tokens and revocation lists, never its auth_token
+    sid: Optional[str] = None
+
+
+class SessionValidator:
+    """Validates session tokens against the sessions table, through a bounded cache of validated sessions.
+
+    A lookup selects only the columns of ValidatedSession by the unique `auth_token` index, sessions revoked
+    by a signed session logout (`deleted_at` set) are not valid. Valid sessions
+    are cached for `ttl` seconds but never served past their `expires_at`, unknown tokens for `negative_ttl`
+    seconds. Revoking a session evicts it at once from the cache of this process, other processes keep serving
+    it for at most `ttl` seconds.
+
+    Examples
+    --------
+    >>> validator = SessionValidator(engine, Session.__table__)
+    >>> session = await validator.validate(token)
+    >>> await validator.revoke(token)
+    """
+
+    def __init__(
+        self,
+        engine: AsyncEngine,
+        table: Table,
+        *,
+        cache_enabled: bool = True,
+        max_size: int = 100000,
+        ttl: float = 30.0,
+        negative_ttl: float = 5.0,
+        clock: Callable[[], datetime] = datetime.utcnow,
+    ) -> None:
+        self._engine = engine
+        self._table = table
+        self._cache_enabled = cache_enabled
+        self._clock = clock
+        self.cache = TTLCache(max_size=max_size, ttl=ttl, negative_ttl=negative_ttl)
+        # built once, lookups only bind the token
+        self._sql = select(table.c.sid, table.c.user_id, table.c.iden_id, table.c.tenant_id, table.c.expires_at).where(
+            table.c.auth_token == bindparam("token"), table.c.deleted_at.is_(None)
+        )
+
+    async def _load(self, token: str) -> ValidatedSession | None:
+        async with self._engine.connect() as conn:
+            row = (await conn.execute(self._sql, {"token": token})).mappings().first()
+        return ValidatedSession(**row) if row is not None else None
+
+    async def validate(self, token: str) -> ValidatedSession | None:
+        """The session of the token, None if the token is unknown, revoked or expired."""
+        if not token:
+            return None
+        if self._cache_enabled:
+            session = await self.cache.get_or_load(token, lambda: self._load(token))
+        else:
+            session = await self._load(token)
+        if session is not None and session.expires_at is not None and session.expires_at <= self._clock():
+            self.cache.invalidate(token)
+            return None
+        return session
+
+    async def revoke(self, token: str) -> bool:
+        """Delete the session of the token, on logout or revocation. Returns False if there was none."""
+        self.cache.invalidate(token)
+        async with self._engine.begin() as conn:
+            deleted = (await conn.execute(delete(self._table).where(self._table.c.auth_token == token))).rowcount
+        # a validation loading the session before the delete committed must not keep it cached
+        self.cache.invalidate(token)
+        return deleted > 0
+
+    async def revoke_user(self, user_id: uuid.UUID) -> int:
+        """Delete all sessions of a user, returns the number of sessions revoked."""
+        sql = delete(self._table).where(self._table.c.user_id == user_id).returning(self._table.c.auth_token)
+        async with self._engine.begin() as conn:
+            tokens = [row[0] for row in await conn.execute(sql)]
+        for token in tokens:
+            self.cache.invalidate(token)
+        return len(tokens)
+
+
+def _bearer_token(request: Request) -> str | None:
+    scheme, _, token = request.headers.get("Authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        return None
+    return token.strip()
+
+
+def session_dependency(validator: "SessionValidator | SignedSessionTokens", cookie: str | None = None):
+    """A FastAPI dependency returning the ValidatedSession of the request, from its bearer token or `cookie`.
+
+    `validator` is a SessionValidator, or the SignedSessionTokens of melody_users.signed_sessions. Raises 401 if the request has no token, or the token is not valid.
+
+    Examples
+    --------
+    >>> CurrentSession = Annotated[ValidatedSession, Depends(session_dependency(user_service.sessions))]
+    >>> @router.get("/me")
+    ... async def me(session: CurrentSession):
+    ...     return {"user_id": session.user_id}
+    """
+
+    async def _current_session(request: Request) -> ValidatedSession:
+        token = _bearer_token(request) or (request.cookies.get(cookie, None) if cookie else None)
+        if not token:
+            raise HTTPException(
+                status_code=status.HTTP_401_UNAUTHORIZED,
+                detail="Missing session token",
+                headers={"WWW-Authenticate": "Bearer"},
+            )
+        session = await validator.validate(token)
+        if session is None:
+            raise HTTPException(
+                status_code=status.HTTP_401_UNAUTHORIZED,
+                detail="Invalid or expired session token",
+                headers={"WWW-Authenticate": "Bearer"},
+            )
+        return session
+
+    return _current_session
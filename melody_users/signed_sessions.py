@@ -0,0 +1,313 @@
+import asyncio
+import base64
+import calendar
+import hashlib
+import hmac
+import json
+import logging
+import math
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import Callable, Dict, Mapping, Tuple
+
+from sqlalchemy import TIMESTAMP, Table, func, select, update
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from .sessions import ValidatedSession
+
+logger = logging.getLogger(__name__)
+
+_VERSION = "v1"
+
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+
+def _b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+def _timestamp(value: datetime) -> int:
+    # naive datetimes are utc, like the timestamps of melody_users tables
+    return calendar.timegm(value.utctimetuple())
+
+
+def _database_utcnow(dialect: str):
+    """The clock of the database, as a naive utc timestamp."""
+    if dialect == "postgresql":
+        return func.timezone("UTC", func.clock_timestamp(), type_=TIMESTAMP)
+    if dialect == "sqlite":
+        return func.strftime("%Y-%m-%d %H:%M:%f", "now", type_=TIMESTAMP)
+    return func.utc_timestamp(type_=TIMESTAMP)
+
+
+class SigningKeyring:
+    """HMAC keys of signed session tokens by key id, the active key signs and every key not retired verifies.
+
+    `rotate()` makes a new key active, and retires the previous one after `grace` seconds, so tokens it signed
+    keep verifying until they expire or the grace window ends. Keys retired in `retire_at` (key id to unix time)
+    stop verifying at that time.
+
+    Examples
+    --------
+    >>> keyring = SigningKeyring({"2024-01": b"secret"}, active="2024-01", grace=86400)
+    >>> keyring.rotate("2024-02", b"new secret")
+    """
+
+    def __init__(
+        self,
+        keys: Mapping[str, bytes],
+        active: str,
+        grace: float = 86400.0,
+        retire_at: Mapping[str, float] | None = None,
+        clock: Callable[[], float] = time.time,
+    ) -> None:
+        if active not in keys:
+            raise ValueError(f"active signing key {active} is not in the keys")
+        for kid in keys:
+            if "." in kid:
+                raise ValueError(f"signing key id {kid} must not contain '.'")
+        self._keys: Dict[str, bytes] = dict(keys)
+        self._retire_at: Dict[str, float] = dict(retire_at or {})
+        self._active = active
+        self._grace = grace
+        self._clock = clock
+
+    @property
+    def active(self) -> Tuple[str, bytes]:
+        return self._active, self._keys[self._active]
+
+    def rotate(self, kid: str, secret: bytes) -> None:
+        if "." in kid:
+            raise ValueError(f"signing key id {kid} must not contain '.'")
+        self._retire_at[self._active] = self._clock() + self._grace
+        self._keys[kid] = secret
+        self._retire_at.pop(kid, None)
+        self._active = kid
+        logger.info(f"rotated session signing key to {kid}")
+
+    def verifying_key(self, kid: str) -> bytes | None:
+        """The key of `kid`, None if it is unknown or retired."""
+        retire_at = self._retire_at.get(kid, None)
+        if retire_at is not None and retire_at <= self._clock():
+            return None
+        return self._keys.get(kid, None)
+
+
+class BloomFilter:
+    """A bloom filter of strings, sized for `capacity` items at a false positive rate of `error_rate`."""
+
+    def __init__(self, capacity: int = 100000, error_rate: float = 0.001) -> None:
+        self.capacity = max(1, capacity)
+        self._bits_count = max(8, int(-self.capacity * math.log(error_rate) / math.log(2) ** 2))
+        self._hashes = max(1, round(self._bits_count / self.capacity * math.log(2)))
+        self._bits = bytearray((self._bits_count + 7) // 8)
+
+    def _positions(self, item: str):
+        digest = hashlib.blake2b(item.encode("utf-8"), digest_size=16).digest()
+        h1, h2 = int.from_bytes(digest[:8], "little"), int.from_bytes(digest[8:], "little") | 1
+        # double hashing, k positions from two hashes
+        return ((h1 + i * h2) % self._bits_count for i in range(self._hashes))
+
+    def add(self, item: str) -> None:
+        for position in self._positions(item):
+            self._bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item: str) -> bool:
+        return all(self._bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+
+class RevocationList:
+    """Revoked sessions not expired yet: a bloom filter answers most lookups, an exact map confirms its hits.
+
+    Entries are dropped once the session expires, `prune()` rebuilds the filter from the remaining entries.
+    """
+
+    def __init__(self, capacity: int = 100000, error_rate: float = 0.001, clock: Callable[[], float] = time.time) -> None:
+        self._capacity = capacity
+        self._error_rate = error_rate
+        self._clock = clock
+        self._revoked: Dict[str, float] = {}
+        self._bloom = BloomFilter(capacity, error_rate)
+
+    def __len__(self) -> int:
+        return len(self._revoked)
+
+    def add(self, sid: str, expires_at: float) -> None:
+        if sid not in self._revoked:
+            self._bloom.add(sid)
+        self._revoked[sid] = expires_at
+        if len(self._revoked) > self._bloom.capacity:
+            self.prune()
+
+    def __contains__(self, sid: str) -> bool:
+        return sid in self._bloom and sid in self._revoked
+
+    def prune(self) -> None:
+        now = self._clock()
+        self._revoked = {sid: expires_at for sid, expires_at in self._revoked.items() if expires_at > now}
+        self._bloom = BloomFilter(max(self._capacity, 2 * len(self._revoked)), self._error_rate)
+        for sid in self._revoked:
+            self._bloom.add(sid)
+
+
+class SignedSessionTokens:
+    """Issues and verifies self-contained session tokens, signed with HMAC-SHA256, without any I/O.
+
+    A token is `v1.<key id>.<payload>.<signature>`, the payload holds the session id (the public `sid` column of
+    its row in the sessions table), user_id, iden_id, tenant_id and expiry. The payload is only signed, not
+    encrypted: the auth_token of the row is never put in it. A revoked session is rejected once
+    it is in `revocations`, at once in the process revoking it, and after a sync of RevocationSync elsewhere.
+
+    Examples
+    --------
+    >>> tokens = SignedSessionTokens(keyring, RevocationList())
+    >>> token = tokens.issue(sid=sid, user_id=user_id, iden_id=iden_id, tenant_id=tenant_id, expires_at=expires_at)
+    >>> session = tokens.verify(token)
+    """
+
+    def __init__(
+        self, keyring: SigningKeyring, revocations: RevocationList, clock: Callable[[], float] = time.time
+    ) -> None:
+        self.keyring = keyring
+        self.revocations = revocations
+        self._clock = clock
+
+    @staticmethod
+    def _sign(secret: bytes, message: str) -> str:
+        return _b64encode(hmac.new(secret, message.encode("ascii"), hashlib.sha256).digest())
+
+    def issue(
+        self, *, sid: str, user_id: uuid.UUID, iden_id: uuid.UUID, tenant_id: uuid.UUID | None, expires_at: datetime
+    ) -> str:
+        claims = {
+            "sid": sid,
+            "uid": str(user_id),
+            "iid": str(iden_id),
+            "tid": str(tenant_id) if tenant_id else None,
+            "exp": _timestamp(expires_at),
+        }
+        kid, secret = self.keyring.active
+        payload = _b64encode(json.dumps(claims, separators=(",", ":")).encode("utf-8"))
+        message = f"{_VERSION}.{kid}.{payload}"
+        return f"{message}.{self._sign(secret, message)}"
+
+    def verify(self, token: str) -> ValidatedSession | None:
+        """The session of the token, None if it is malformed, forged, signed by a retired key, expired or revoked."""
+        parts = token.split(".") if token else []
+        if len(parts) != 4 or parts[0] != _VERSION:
+            return None
+        secret = self.keyring.verifying_key(parts[1])
+        if secret is None:
+            return None
+        message = token[: -len(parts[3]) - 1]
+        if not hmac.compare_digest(self._sign(secret, message), parts[3]):
+            return None
+        try:
+            claims = json.loads(_b64decode(parts[2]))
+            if claims["exp"] <= self._clock() or claims["sid"] in self.revocations:
+                return None
+            return ValidatedSession(
+                sid=claims["sid"],
+                user_id=claims["uid"],
+                iden_id=claims["iid"],
+                tenant_id=claims["tid"],
+                expires_at=datetime.utcfromtimestamp(claims["exp"]),
+            )
+        except (ValueError, KeyError, TypeError):
+            return None
+
+    async def validate(self, token: str) -> ValidatedSession | None:
+        """verify() for session_dependency, no I/O."""
+        return self.verify(token)
+
+
+class RevocationSync:
+    """Keeps a RevocationList in sync with the sessions revoked in the sessions table, by any process.
+
+    Revoked sessions keep their row with `deleted_at` set until they expire, sessions are identified by their
+    public `sid`. Every `interval` seconds, the rows revoked since the previous sync are added, the first sync loads
+    all revoked sessions not expired yet. `deleted_at` and the cursor of the syncs are read from the clock of the
+    database, the clocks of the processes may disagree.
+
+    Examples
+    --------
+    >>> sync = RevocationSync(engine, Session.__table__, tokens.revocations)
+    >>> await sync.sync()
+    >>> sync.start(interval=5)
+    """
+
+    def __init__(
+        self,
+        engine: AsyncEngine,
+        table: Table,
+        revocations: RevocationList,
+        overlap: float = 5.0,
+        clock: Callable[[], datetime] = datetime.utcnow,
+    ) -> None:
+        self._engine = engine
+        self._table = table
+        self._revocations = revocations
+        self._overlap = timedelta(seconds=overlap)
+        self._clock = clock
+        self._cursor: datetime | None = None
+        self._task: asyncio.Task | None = None
+
+    async def revoke(self, sid: str) -> bool:
+        """Revoke a session, in the table for other processes and in the revocation list of this process."""
+        sql = (
+            update(self._table)
+            .where(self._table.c.sid == sid, self._table.c.deleted_at.is_(None))
+            .values(deleted_at=_database_utcnow(self._engine.dialect.name))
+            .returning(self._table.c.expires_at)
+        )
+        async with self._engine.begin() as conn:
+            row = (await conn.execute(sql)).first()
+        if row is None:
+            return False
+        expires_at = row[0]
+        self._revocations.add(sid, _timestamp(expires_at) if expires_at is not None else math.inf)
+        return True
+
+    async def sync(self) -> int:
+        """Add the sessions revoked since the previous sync, returns the number of revoked sessions read."""
+        table = self._table
+        sql = select(table.c.sid, table.c.expires_at).where(
+            table.c.deleted_at.is_not(None), table.c.expires_at > self._clock()
+        )
+        if self._cursor is not None:
+            # overlap, to read revocations committed late with an earlier deleted_at
+            sql = sql.where(table.c.deleted_at >= self._cursor - self._overlap)
+        async with self._engine.connect() as conn:
+            # read before the revocations, the next sync reads the rows revoked from then on
+            cursor = (await conn.execute(select(_database_utcnow(self._engine.dialect.name)))).scalar()
+            rows = (await conn.execute(sql)).all()
+        for sid, expires_at in rows:
+            self._revocations.add(sid, _timestamp(expires_at))
+        self._cursor = cursor
+        self._revocations.prune()
+        return len(rows)
+
+    async def _run(self, interval: float) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.sync()
+            except Exception as e:
+                logger.warning(f"syncing revoked sessions failed: {e}")
+
+    def start(self, interval: float = 5.0) -> None:
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run(interval))
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
@@ -0,0 +1,249 @@
+import abc
+import json
+import logging
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, Hashable, List, Mapping, Set, Tuple, Union
+
+from sqlalchemy import Table, delete, insert
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+logger = logging.getLogger(__name__)
+
+
+class ExpiringDict:
+    """A bounded dict whose entries expire, evicted by a hashed timing wheel.
+
+    Entries are hashed into `wheel_size` slots of `tick` seconds by their expiry. Every operation advances the
+    wheel to the current tick and evicts the expired entries of the slots it passed, so expired entries are
+    dropped without a background task and without scanning the whole dict. When the dict holds `max_size`
+    entries, the oldest entry is evicted to make room.
+
+    Not safe across threads, use one per event loop.
+
+    Examples
+    --------
+    >>> states = ExpiringDict(max_size=100000)
+    >>> states.set("state", {"provider": "github"}, ttl=60)
+    >>> states.pop("state")
+    {'provider': 'github'}
+    """
+
+    def __init__(
+        self, max_size: int = 100000, tick: float = 1.0, wheel_size: int = 512, clock: Callable[[], float] = time.monotonic
+    ) -> None:
+        if max_size <= 0:
+            raise ValueError("max_size must be positive")
+        self._max_size = max_size
+        self._tick = tick
+        self._clock = clock
+        self._entries: "OrderedDict[Hashable, Tuple[Any, float]]" = OrderedDict()
+        self._wheel: List[Set[Hashable]] = [set() for _ in range(wheel_size)]
+        self._current = int(clock() / tick)
+        # entries removed because they expired, or to make room
+        self.expired = 0
+        self.evicted = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _slot(self, expires_at: float) -> Set[Hashable]:
+        return self._wheel[int(expires_at / self._tick) % len(self._wheel)]
+
+    def _remove(self, key: Hashable) -> Any:
+        value, expires_at = self._entries.pop(key)
+        self._slot(expires_at).discard(key)
+        return value
+
+    def _advance(self, now: float) -> None:
+        target = int(now / self._tick)
+        # slots of completed ticks, each slot once even if the clock jumped more than a revolution
+        for tick in range(max(self._current, target - len(self._wheel)), target):
+            slot = self._wheel[tick % len(self._wheel)]
+            # slots also hold entries of later revolutions
+            for key in [key for key in slot if self._entries[key][1] <= now]:
+                self._remove(key)
+                self.expired += 1
+        self._current = max(self._current, target)
+
+    def set(self, key: Hashable, value: Any, ttl: float) -> None:
+        now = self._clock()
+        self._advance(now)
+        if key in self._entries:
+            self._remove(key)
+        while len(self._entries) >= self._max_size:
+            self._remove(next(iter(self._entries)))
+            self.evicted += 1
+        expires_at = now + ttl
+        self._entries[key] = (value, expires_at)
+        self._slot(expires_at).add(key)
+
+    def _live(self, key: Hashable, now: float) -> bool:
+        entry = self._entries.get(key, None)
+        if entry is None:
+            return False
+        if entry[1] <= now:
+            # expired within the current tick, not passed by the wheel yet
+            self._remove(key)
+            self.expired += 1
+            return False
+        return True
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        now = self._clock()
+        self._advance(now)
+        return self._entries[key][0] if self._live(key, now) else default
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        now = self._clock()
+        self._advance(now)
+        return self._remove(key) if self._live(key, now) else default
+
+
+class StateStore(abc.ABC):
+    """Stores short lived oauth2 states, from the authorization request until its callback.
+
+    A state is taken exactly once: `take` returns it and removes it, so a replayed callback finds nothing.
+    """
+
+    @abc.abstractmethod
+    async def put(self, key: str, value: Mapping[str, Any], ttl: float) -> None:
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    async def take(self, key: str) -> Union[Dict[str, Any], None]:
+        """Remove and return the state, None if it is unknown or expired."""
+        raise NotImplementedError()
+
+    async def aclose(self) -> None:
+        pass
+
+
+class MemoryStateStore(StateStore):
+    """States in the memory of the process, callbacks must reach the process that saved the state."""
+
+    def __init__(self, max_size: int = 100000, **kwargs) -> None:
+        self.states = ExpiringDict(max_size=max_size, **kwargs)
+
+    async def put(self, key: str, value: Mapping[str, Any], ttl: float) -> None:
+        self.states.set(key, dict(value), ttl)
+
+    async def take(self, key: str) -> Union[Dict[str, Any], None]:
+        return self.states.pop(key, None)
+
+
+class LocalSharedClient:
+    """A local stand-in for the subset of the redis asyncio client used by SharedStateStore, for tests and single
+    process deployments.
+    """
+
+    def __init__(self, max_size: int = 100000, **kwargs) -> None:
+        self._values = ExpiringDict(max_size=max_size, **kwargs)
+
+    async def set(self, name: str, value: str, px: int | None = None) -> bool:
+        # values without expiry are kept for a year, they are evicted by max_size before
+        self._values.set(name, value, ttl=px / 1000 if px is not None else 365 * 86400)
+        return True
+
+    async def getdel(self, name: str) -> Union[str, None]:
+        return self._values.pop(name, None)
+
+    async def aclose(self) -> None:
+        pass
+
+
+class SharedStateStore(StateStore):
+    """States in a store shared by all processes, such as redis, expired by the store itself.
+
+    `client` is a redis asyncio client, or any client with its `set(name, value, px=)` and `getdel(name)`,
+    such as LocalSharedClient.
+
+    Examples
+    --------
+    >>> import redis.asyncio as redis
+    >>> store = SharedStateStore(redis.Redis.from_url("redis://localhost:6379/0"))
+    """
+
+    def __init__(self, client, prefix: str = "melody:oauth2_state:") -> None:
+        self._client = client
+        self._prefix = prefix
+
+    async def put(self, key: str, value: Mapping[str, Any], ttl: float) -> None:
+        await self._client.set(self._prefix + key, json.dumps(dict(value)), px=max(1, int(ttl * 1000)))
+
+    async def take(self, key: str) -> Union[Dict[str, Any], None]:
+        value = await self._client.getdel(self._prefix + key)
+        if value is None:
+            return None
+        return json.loads(value)
+
+    async def aclose(self) -> None:
+        await self._client.aclose()
+
+
+class DatabaseStateStore(StateStore):
+    """States in rows of `table`, such as melody_users.tables.OAuth2State, shared by all processes of the database.
+
+    The key is stored in the `state` column and the value in `props`, its entries of the other columns of the table
+    are copied into them. Expired rows are never taken, they are deleted by the sweeper. Timestamps are naive utc.
+
+    Examples
+    --------
+    >>> from melody_users.tables import OAuth2State
+    >>> store = DatabaseStateStore(engine, OAuth2State.__table__)
+    """
+
+    def __init__(self, engine: AsyncEngine, table: Table, clock: Callable[[], datetime] = datetime.utcnow) -> None:
+        self._engine = engine
+        self._table = table
+        self._clock = clock
+
+    async def put(self, key: str, value: Mapping[str, Any], ttl: float) -> None:
+        columns = {name: v for name, v in value.items() if name in self._table.c and name not in ("state", "props")}
+        now = self._clock()
+        sql = insert(self._table).values(
+            **columns, state=key, props=dict(value), expires_at=now + timedelta(seconds=ttl), created_at=now, updated_at=now
+        )
+        async with self._engine.begin() as conn:
+            await conn.execute(sql)
+
+    async def take(self, key: str) -> Union[Dict[str, Any], None]:
+        # deleted and returned by one statement, a concurrent replay of the callback finds nothing
+        sql = (
+            delete(self._table)
+            .where(self._table.c.state == key, self._table.c.expires_at > self._clock())
+            .returning(self._table.c.props)
+        )
+        async with self._engine.begin() as conn:
+            row = (await conn.execute(sql)).first()
+        return None if row is None else dict(row[0] or {})
+
+
+def create_state_store(
+    backend: str = "database",
+    url: str = "",
+    max_size: int = 100000,
+    engine: AsyncEngine | None = None,
+    table: Table | None = None,
+) -> StateStore:
+    """Create the state store of `backend`: database (rows of `table` in `engine`), memory, local (a
+    LocalSharedClient) or redis (at `url`).
+
+    memory and local keep the states in the process: the callback must reach the process of the authorization.
+    """
+    if backend == "database":
+        if engine is None or table is None:
+            raise ValueError("database state store requires an engine and a table")
+        return DatabaseStateStore(engine, table)
+    if backend == "memory":
+        return MemoryStateStore(max_size=max_size)
+    if backend == "local":
+        return SharedStateStore(LocalSharedClient(max_size=max_size))
+    if backend == "redis":
+        try:
+            import redis.asyncio as redis
+        except ImportError as e:
+            raise ImportError("redis state store requires redis, install it with `pip install redis`") from e
+        return SharedStateStore(redis.Redis.from_url(url))
+    raise ValueError(f"unknown state store backend: {backend}")
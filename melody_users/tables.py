@@ -2,7 +2,7 @@ import uuid
 from datetime import datetime
 from typing import Optional
 
-from sqlmodel import TIMESTAMP, UUID, Column, Field, SQLModel, String
+from sqlmodel import TIMESTAMP, UUID, Column, Field, Index, SQLModel, String
 
 from .common import BaseModel
 
@@ -12,222 +12,223 @@ class User(BaseModel, table=True):
 
     username: Optional[str] = Field(
         default="",
-        nullable=False,
-        sa_column=Column(String(64), default=""),
+        sa_column=Column(String(64), default="", nullable=False),
         description="The username of the user",
     )
 
     nickname: Optional[str] = Field(
         default="",
-        nullable=False,
-        sa_column=Column(String(64), default=""),
+        sa_column=Column(String(64), default="", nullable=False),
         description="The nickname of the user",
     )
 
     email: Optional[str] = Field(
         default="",
-        nullable=False,
-        sa_column=Column(String(64), default=""),
+        sa_column=Column(String(64), default="", nullable=False),
         description="The email of the user",
     )
 
     phone: Optional[str] = Field(
         default="",
-        nullable=False,
-        sa_column=Column(String(64), default=""),
+        sa_column=Column(String(64), default="", nullable=False),
         description="The phone of the user",
     )
 
     status: Optional[str] = Field(
         default="",
-        nullable=False,
-        sa_column=Column(String(32), default=""),
+        sa_column=Column(String(32), default="", nullable=False),
         description="The status of the user, e.g. active, inactive, deleted",
     )
 
 
 class Identity(BaseModel, table=True):
-    __tablename__ = "identities"
+    # melody.identity.tables.Identity owns "identities"
+    __tablename__ = "user_identities"
 
     user_id: uuid.UUID = Field(
         default=uuid.uuid4,
-        nullable=False,
-        sa_column=Column(UUID, default=uuid.uuid4),
+        sa_column=Column(UUID, default=uuid.uuid4, nullable=False),
         description="The user id of the record",
     )
 
     auth_type: str = Field(
         default="",
-        nullable=False,
-        sa_column=Column(String(32), default=""),
+        sa_column=Column(String(32), default="", nullable=False),
         description="The auth type of the record",
     )
 
     auth_value: str = Field(
         default="",
-        nullable=False,
-        sa_column=Column(String(256), default=""),
+        sa_column=Column(String(256), default="", nullable=False),
         description="The auth value of the record",
     )
 
     status: Optional[str] = Field(
         default="",
-        nullable=False,
-        sa_column=Column(String(32), default=""),
+        sa_column=Column(String(32), default="", nullable=False),
         description="The status of the record, e.g. active, inactive, deleted",
     )
 
     last_signin_at: Optional[datetime] = Field(
         default=None,
-        nullable=True,
-        sa_column=Column(TIMESTAMP),
+        sa_column=Column(TIMESTAMP, nullable=True),
         description="Timestamp of last signin",
     )
 
 
 class Session(BaseModel, table=True):
     __tablename__ = "sessions"
+    __table_args__ = (
+        # expired rows are deleted by the sweeper
+        Index("ix_sessions_expires_at", "expires_at"),
+        # session validation, an index only scan on postgres
+        Index(
+            "ix_sessions_auth_token",
+            "auth_token",
+            unique=True,
+            postgresql_include=["sid", "user_id", "iden_id", "tenant_id", "expires_at", "deleted_at"],
+        ),
+        # the public id of the session, in signed tokens, revocations and refreshes
+        Index("ix_sessions_sid", "sid", unique=True),
+        Index("ix_sessions_user_id", "user_id"),
+        # revocations of signed session tokens, synced by melody_users.signed_sessions.RevocationSync
+        Index("ix_sessions_deleted_at", "deleted_at"),
+    )
 
     user_id: uuid.UUID = Field(
-        nullable=False,
-        sa_column=Column(UUID, default=uuid.uuid4),
+        sa_column=Column(UUID, default=uuid.uuid4, nullable=False),
         description="The user id of the session",
     )
 
     iden_id: uuid.UUID = Field(
-        nullable=False,
-        sa_column=Column(UUID, default=uuid.uuid4),
+        sa_column=Column(UUID, default=uuid.uuid4, nullable=False),
         description="The identity id of the session",
     )
 
     auth_token: Optional[str] = Field(
         default="",
-        nullable=False,
-        sa_column=Column(String(256), default=""),
+        sa_column=Column(String(256), default="", nullable=False),
         description="The auth token of the session",
     )
 
+    sid: Optional[str] = Field(
+        default=None,
+        sa_column=Column(String(64), nullable=True),
+        description="The public id of the session, never its auth token",
+    )
+
     expires_at: Optional[datetime] = Field(
         default=None,
-        nullable=True,
-        sa_column=Column(TIMESTAMP),
+        sa_column=Column(TIMESTAMP, nullable=True),
         description="Timestamp of session expiration",
     )
 
     refreshed_at: Optional[datetime] = Field(
         default=None,
-        nullable=True,
-        sa_column=Column(TIMESTAMP),
+        sa_column=Column(TIMESTAMP, nullable=True),
         description="Timestamp of session refresh",
     )
 
     user_agent: Optional[str] = Field(
         default="",
-        nullable=False,
-        sa_column=Column(String(256), default=""),
+        sa_column=Column(String(256), default="", nullable=False),
         description="The user agent of the session",
     )
 
     ip_address: Optional[str] = Field(
         default="",
-        nullable=False,
-        sa_column=Column(String(256), default=""),
+        sa_column=Column(String(256), default="", nullable=False),
         description="The ip address of the session",
     )
 
 
 class OAuth2State(BaseModel, table=True):
     __tablename__ = "oauth2_states"
+    # expired rows are deleted by the sweeper
+    __table_args__ = (
+        Index("ix_oauth2_states_expires_at", "expires_at"),
+        # taken by melody_users.state_store.DatabaseStateStore
+        Index("ix_oauth2_states_state", "state", unique=True),
+    )
 
     state: str = Field(
-        nullable=False,
-        sa_column=Column(String, default=""),
+        sa_column=Column(String, default="", nullable=False),
         description="The state of the oauth2 state",
     )
 
     provider: Optional[str] = Field(
         default="",
-        nullable=False,
-        sa_column=Column(String, default=""),
+        sa_column=Column(String, default="", nullable=False),
         description="The provider of the oauth2 state",
     )
 
     client_id: Optional[str] = Field(
         default="",
-        nullable=False,
-        sa_column=Column(String, default=""),
+        sa_column=Column(String, default="", nullable=False),
         description="The client id of the oauth2 state",
     )
 
     code_verifier: Optional[str] = Field(
         default="",
-        nullable=False,
-        sa_column=Column(String, default=""),
+        sa_column=Column(String, default="", nullable=False),
         description="The code verifier of the oauth2 state",
     )
 
     code_challenge_method: Optional[str] = Field(
         default="",
-        nullable=False,
-        sa_column=Column(String, default=""),
+        sa_column=Column(String, default="", nullable=False),
         description="The code challenge method of the oauth2 state",
     )
 
     expires_at: Optional[datetime] = Field(
         default=None,
-        nullable=True,
-        sa_column=Column(TIMESTAMP),
+        sa_column=Column(TIMESTAMP, nullable=True),
         description="Timestamp of oauth2 state expiration",
     )
 
 
 class OAuth2Token(BaseModel, table=True):
     __tablename__ = "oauth2_tokens"
+    # expired rows are deleted by the sweeper
+    __table_args__ = (Index("ix_oauth2_tokens_expires_at", "expires_at"),)
 
     user_id: uuid.UUID = Field(
-        nullable=False,
-        sa_column=Column(UUID, default=uuid.uuid4),
+        sa_column=Column(UUID, default=uuid.uuid4, nullable=False),
         description="The user id of the oauth2 token belongs to",
     )
 
     provider: Optional[str] = Field(
         default="",
-        nullable=False,
-        sa_column=Column(String, default=""),
+        sa_column=Column(String, default="", nullable=False),
         description="The provider of the oauth2 token",
     )
 
     client_id: Optional[str] = Field(
         default="",
-        nullable=False,
-        sa_column=Column(String, default=""),
+        sa_column=Column(String, default="", nullable=False),
         description="The client id of the oauth2 token",
     )
 
     access_token: Optional[str] = Field(
         default="",
-        nullable=False,
-        sa_column=Column(String, default=""),
+        sa_column=Column(String, default="", nullable=False),
         description="The access token of the oauth2 token",
     )
 
     refresh_token: Optional[str] = Field(
         default="",
-        nullable=False,
-        sa_column=Column(String, default=""),
+        sa_column=Column(String, default="", nullable=False),
         description="The refresh token of the oauth2 token",
     )
 
     expires_at: Optional[datetime] = Field(
         default=None,
-        nullable=True,
-        sa_column=Column(TIMESTAMP),
+        sa_column=Column(TIMESTAMP, nullable=True),
         description="Timestamp of oauth2 token expiration",
     )
 
     scope: Optional[str] = Field(
         default="",
-        nullable=False,
-        sa_column=Column(String, default=""),
+        sa_column=Column(String, default="", nullable=False),
         description="The scope of the oauth2 token",
     )
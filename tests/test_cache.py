@@ -0,0 +1,174 @@
+import asyncio
+import uuid
+
+import pytest
+from sqlalchemy import update
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlmodel import SQLModel
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from melody.cache import MISSING, TTLCache
+from melody.identity import crud
+from melody.identity.exception import IdentityException
+from melody.identity.hashing import hash_password
+from melody.identity.models import EmailIdentityCreateRequest, EmailIdentityLoginRequest
+from melody.identity.tables import Identity
+from melody.tenancy import scope_session
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_lru_eviction_and_ttl_expiry():
+    clock = FakeClock()
+    cache = TTLCache(max_size=2, ttl=10, clock=clock)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    # "b" is the least recently used
+    cache.set("c", 3)
+    assert cache.get("b") is MISSING
+    assert cache.stats.evictions == 1
+
+    clock.now = 10
+    assert cache.get("a") is MISSING
+    assert cache.stats.expirations == 1
+    cache.set("d", None, ttl=20)
+    clock.now = 25
+    assert cache.get("d") is None
+
+
+def test_concurrent_misses_share_one_load():
+    loads = []
+
+    async def _load():
+        loads.append(1)
+        await asyncio.sleep(0.01)
+        return "user"
+
+    async def _run():
+        cache = TTLCache(max_size=10, ttl=60)
+        values = await asyncio.gather(*[cache.get_or_load("k", _load) for _ in range(5)])
+        assert values == ["user"] * 5
+        assert await cache.get_or_load("k", _load) == "user"
+        assert len(loads) == 1
+        assert cache.stats.coalesced == 4
+
+    asyncio.run(_run())
+
+
+def test_invalidate_during_load_does_not_store_stale_value():
+    async def _run():
+        cache = TTLCache(max_size=10, ttl=60)
+        started = asyncio.Event()
+
+        async def _load():
+            started.set()
+            await asyncio.sleep(0.01)
+            return "old"
+
+        task = asyncio.create_task(cache.get_or_load("k", _load))
+        await started.wait()
+        cache.invalidate("k")
+        assert await task == "old"
+        assert cache.get("k") is MISSING
+
+    asyncio.run(_run())
+
+
+def test_load_errors_are_not_cached():
+    calls = []
+
+    async def _load():
+        calls.append(1)
+        if len(calls) == 1:
+            raise RuntimeError("database is down")
+        return 1
+
+    async def _run():
+        cache = TTLCache(max_size=10, ttl=60)
+        try:
+            await cache.get_or_load("k", _load)
+        except RuntimeError:
+            pass
+        assert await cache.get_or_load("k", _load) == 1
+
+    asyncio.run(_run())
+
+
+def test_negative_ttl():
+    clock = FakeClock()
+    cache = TTLCache(max_size=10, ttl=300, negative_ttl=30, clock=clock)
+    cache.set("unknown", None)
+    cache.set("known", "github")
+    clock.now = 30
+    assert cache.get("unknown") is MISSING
+    assert cache.get("known") == "github"
+
+
+def test_login_reads_credentials_past_the_cache(tmp_path):
+    async def _run():
+        engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path}/login.db")
+        async with engine.begin() as conn:
+            await conn.run_sync(SQLModel.metadata.create_all)
+        request = EmailIdentityCreateRequest(tenant_id="acme", user_id=uuid.uuid4(), email="m@example.com", password="old", props={})
+        async with AsyncSession(engine) as session:
+            await crud.create_email_identity(session, request=request)
+            await session.commit()
+            assert await crud.retrieve_email_identity(session, tenant_id="acme", email="m@example.com") is not None
+
+        def login(password: str):
+            return crud.login_with_email(
+                session, request=EmailIdentityLoginRequest(tenant_id="acme", email="m@example.com", password=password)
+            )
+
+        # written by another process, the cached identity is not invalidated here
+        credential = await hash_password("new")
+        async with engine.begin() as conn:
+            await conn.execute(update(Identity).values(credential=credential))
+        async with AsyncSession(engine) as session:
+            with pytest.raises(IdentityException):
+                await login("old")
+            assert (await login("new")).iden_value == "m@example.com"
+        async with engine.begin() as conn:
+            await conn.execute(update(Identity).values(status="INACTIVE"))
+        async with AsyncSession(engine) as session:
+            with pytest.raises(IdentityException):
+                await login("new")
+        await engine.dispose()
+
+    try:
+        asyncio.run(_run())
+    finally:
+        crud.identity_cache.clear()
+
+
+def test_misses_of_other_tenants_do_not_hide_records(tmp_path):
+    async def _run():
+        engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path}/tenants.db")
+        async with engine.begin() as conn:
+            await conn.run_sync(SQLModel.metadata.create_all)
+        request = EmailIdentityCreateRequest(tenant_id="acme", user_id=uuid.uuid4(), email="m@example.com", password="p", props={})
+        async with AsyncSession(engine) as session:
+            iden_id = (await crud.create_email_identity(session, request=request)).id
+            await session.commit()
+
+        async with AsyncSession(engine) as session:
+            scope_session(session, "other")
+            assert await crud.retrieve_identity(session, id=iden_id) is None
+            assert await crud.retrieve_email_identity(session, tenant_id="acme", email="m@example.com") is None
+        async with AsyncSession(engine) as session:
+            scope_session(session, "acme")
+            assert (await crud.retrieve_identity(session, id=iden_id)).id == iden_id
+            assert (await crud.retrieve_email_identity(session, tenant_id="acme", email="m@example.com")).id == iden_id
+        await engine.dispose()
+
+    try:
+        asyncio.run(_run())
+    finally:
+        crud.identity_cache.clear()
@@ -0,0 +1,32 @@
+import asyncio
+import json
+import uuid
+from datetime import datetime
+
+from melody.export import ExportFormat, encode
+
+
+async def _batches():
+    id = uuid.UUID("00000000-0000-0000-0000-000000000001")
+    yield [{"id": id, "created_at": datetime(2024, 1, 1), "props": {"a": 1}, "deleted_at": None}]
+    yield []
+    yield [{"id": id, "created_at": datetime(2024, 1, 2), "props": {}, "deleted_at": None}]
+
+
+async def _collect(format):
+    return [chunk async for chunk in encode(_batches(), format)]
+
+
+def test_encode_ndjson_one_chunk_per_batch():
+    chunks = asyncio.run(_collect(ExportFormat.NDJSON))
+    assert len(chunks) == 2
+    first = json.loads(chunks[0])
+    assert first == {"id": "00000000-0000-0000-0000-000000000001", "created_at": "2024-01-01T00:00:00", "props": {"a": 1}, "deleted_at": None}
+
+
+def test_encode_csv_writes_header_once():
+    text = "".join(asyncio.run(_collect(ExportFormat.CSV)))
+    lines = text.splitlines()
+    assert lines[0] == "id,created_at,props,deleted_at"
+    assert lines[1] == '00000000-0000-0000-0000-000000000001,2024-01-01T00:00:00,"{""a"": 1}",'
+    assert len(lines) == 3
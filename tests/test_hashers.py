@@ -0,0 +1,43 @@
+from melody.identity.hashers import BCryptHasher, PasswordHasherRegistry, ScryptHasher, calibrate
+
+
+def test_bcrypt_needs_rehash_on_cost_change():
+    old = BCryptHasher(cost=4)
+    hashed = old.hash("secret")
+    assert old.verify("secret", hashed)
+    assert not old.needs_rehash(hashed)
+    assert BCryptHasher(cost=5).needs_rehash(hashed)
+    # a higher cost is kept, processes calibrated to other costs do not rehash back and forth
+    assert not old.needs_rehash(BCryptHasher(cost=5).hash("secret"))
+    # verification does not depend on the configured cost
+    assert BCryptHasher(cost=5).verify("secret", hashed)
+
+
+def test_scrypt_hash_and_verify():
+    hasher = ScryptHasher(cost=10)
+    hashed = hasher.hash("secret")
+    assert hashed.startswith("$scrypt$ln=10,r=8,p=1$")
+    assert hasher.verify("secret", hashed)
+    assert not hasher.verify("wrong", hashed)
+    assert not hasher.verify("secret", "$scrypt$garbage")
+    assert ScryptHasher(cost=11).needs_rehash(hashed)
+    assert not ScryptHasher(cost=10).needs_rehash(ScryptHasher(cost=11).hash("secret"))
+
+
+def test_registry_identifies_and_upgrades_old_algorithm():
+    registry = PasswordHasherRegistry()
+    registry.register(BCryptHasher(cost=4))
+    registry.register(ScryptHasher(cost=10), default=True)
+
+    bcrypt_hash = BCryptHasher(cost=4).hash("secret")
+    assert registry.identify(bcrypt_hash).algorithm == "bcrypt"
+    assert registry.needs_rehash(bcrypt_hash)
+
+    scrypt_hash = registry.default.hash("secret")
+    assert registry.identify(scrypt_hash).algorithm == "scrypt"
+    assert not registry.needs_rehash(scrypt_hash)
+    assert registry.identify("plain-text") is None
+
+
+def test_calibrate_never_goes_below_min_cost():
+    assert calibrate(BCryptHasher(), target_seconds=0.0, samples=1).cost == BCryptHasher.min_cost
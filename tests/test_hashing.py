@@ -0,0 +1,23 @@
+import asyncio
+
+from melody.identity.hashing import HashingExecutor
+
+
+def test_hash_and_verify_password():
+    executor = HashingExecutor(max_workers=2, use_processes=False)
+
+    async def _run():
+        hashed = await executor.hash_password("secret")
+        assert hashed.startswith("$2")
+        assert await executor.verify_password("secret", hashed)
+        assert not await executor.verify_password("wrong", hashed)
+        assert not await executor.verify_password("secret", "not-a-bcrypt-hash")
+        # unknown identities pay for a verification too
+        assert not await executor.verify_dummy_password("secret")
+        assert not await executor.verify_dummy_password("other")
+        assert len(executor._dummy_hashes) == 1
+
+    try:
+        asyncio.run(_run())
+    finally:
+        executor.shutdown()
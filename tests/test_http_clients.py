@@ -0,0 +1,22 @@
+import asyncio
+
+import httpx
+
+from melody_users.http_clients import ProviderHTTPClients
+
+
+def test_provider_clients_are_reused_until_closed():
+    async def _run():
+        transport = httpx.MockTransport(lambda request: httpx.Response(200, json={"login": "melody"}))
+        clients = ProviderHTTPClients(http2=False, transport=transport)
+        github = clients.client("github")
+        assert clients.client("github") is github
+        assert clients.client("google") is not github
+        response = await github.get("https://api.github.com/user")
+        assert response.json() == {"login": "melody"}
+        await clients.aclose()
+        assert github.is_closed
+        assert clients.client("github") is not github
+        await clients.aclose()
+
+    asyncio.run(_run())
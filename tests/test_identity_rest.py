@@ -0,0 +1,68 @@
+import asyncio
+import uuid
+
+import httpx
+from fastapi import FastAPI
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlmodel import SQLModel
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from melody import deps
+from melody.identity import crud
+from melody.identity.models import EmailIdentityCreateRequest
+from melody.identity.rest import router
+from melody.identity.tables import Identity
+from melody.write_behind import WriteBehindBuffer
+
+
+def test_login_persists_last_signin_at(tmp_path, monkeypatch):
+    async def _run():
+        engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path}/login.db")
+        async with engine.begin() as conn:
+            await conn.run_sync(SQLModel.metadata.create_all)
+        async with AsyncSession(engine) as session:
+            for email in ("a@example.com", "b@example.com"):
+                request = EmailIdentityCreateRequest(tenant_id="acme", user_id=uuid.uuid4(), email=email, password="secret", props={})
+                await crud.create_email_identity(session, request=request)
+            await session.commit()
+
+        app = FastAPI(lifespan=deps.lifespan)
+        app.include_router(router)
+
+        async def _session():
+            async with AsyncSession(engine) as session:
+                yield session
+
+        app.dependency_overrides[deps.database_session] = _session
+
+        async def _login(email: str) -> None:
+            async with httpx.AsyncClient(
+                transport=httpx.ASGITransport(app=app), base_url="http://test", headers={deps.TENANT_HEADER: "acme"}
+            ) as client:
+                body = {"tenant_id": "acme", "email": email, "password": "secret"}
+                assert (await client.post("/identities/email/login", json=body)).status_code == 200
+
+        async def _last_signin_at(email: str):
+            async with AsyncSession(engine) as session:
+                sql = select(Identity.last_signin_at).where(Identity.iden_value == email)
+                return (await session.exec(sql)).scalar()
+
+        # write-behind disabled by default, written by the login itself
+        assert deps.signin_buffer is None
+        await _login("a@example.com")
+        assert await _last_signin_at("a@example.com") is not None
+
+        # enabled, flushed in the background and at shutdown
+        buffer = crud.register_signin_targets(WriteBehindBuffer(engine, flush_interval=3600))
+        monkeypatch.setattr(deps, "signin_buffer", buffer)
+        async with deps.lifespan(app):
+            await _login("b@example.com")
+            assert await _last_signin_at("b@example.com") is None and len(buffer) == 2
+        assert await _last_signin_at("b@example.com") is not None and len(buffer) == 0
+        await engine.dispose()
+
+    try:
+        asyncio.run(_run())
+    finally:
+        crud.identity_cache.clear()
@@ -0,0 +1,44 @@
+import asyncio
+import uuid
+
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlmodel import SQLModel
+
+from melody.identity.hashers import BCryptHasher, PasswordHasherRegistry
+from melody.identity.hashing import HashingExecutor
+from melody.identity.importer import EmailIdentityImporter, ImportProgress
+
+
+def test_import_resumes_from_checkpoint(tmp_path):
+    registry = PasswordHasherRegistry()
+    registry.register(BCryptHasher(cost=4))
+    executor = HashingExecutor(max_workers=2, use_processes=False, registry=registry)
+    rows = [{"user_id": str(uuid.uuid4()), "email": f"user{i}@example.com", "password": f"pw{i}"} for i in range(10)]
+    rows.append({"user_id": str(uuid.uuid4()), "email": "legacy@example.com", "password_hash": registry.default.hash("pw")})
+    checkpoint = tmp_path / "import.ckpt"
+
+    async def _run():
+        engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'melody.db'}")
+        async with engine.begin() as conn:
+            await conn.run_sync(SQLModel.metadata.create_all)
+
+        # pretend a previous run committed the first 4 rows, then crashed
+        first = EmailIdentityImporter(engine, chunk_size=4, executor=executor)
+        await first.run(rows[:4])
+        checkpoint.write_text(ImportProgress(offset=4, created=4, hashed=4).model_dump_json())
+
+        importer = EmailIdentityImporter(engine, chunk_size=4, checkpoint_path=checkpoint, executor=executor)
+        progress = await importer.run(rows)
+        await engine.dispose()
+        return progress
+
+    try:
+        progress = asyncio.run(_run())
+    finally:
+        executor.shutdown()
+    assert progress.offset == 11
+    assert progress.created == 11
+    assert progress.skipped == 0
+    assert progress.hashed == 10
+    assert progress.prehashed == 1
+    assert ImportProgress.model_validate_json(checkpoint.read_text()) == progress
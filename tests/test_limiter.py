@@ -0,0 +1,45 @@
+import asyncio
+
+import pytest
+
+from melody.limiter import ConcurrencyLimiter, LimiterSaturatedError, LimiterTimeoutError
+
+
+def test_limiter_rejects_when_queue_is_full():
+    async def _run():
+        limiter = ConcurrencyLimiter(max_concurrency=1, max_queue=1, timeout=1.0)
+        release = asyncio.Event()
+
+        async def _hold():
+            async with limiter.acquire():
+                await release.wait()
+
+        holder = asyncio.create_task(_hold())
+        await asyncio.sleep(0)
+        waiter = asyncio.create_task(_hold())
+        await asyncio.sleep(0)
+        assert limiter.running == 1 and limiter.waiting == 1
+
+        with pytest.raises(LimiterSaturatedError):
+            async with limiter.acquire():
+                pass
+
+        release.set()
+        await asyncio.gather(holder, waiter)
+        assert limiter.running == 0 and limiter.waiting == 0
+
+    asyncio.run(_run())
+
+
+def test_limiter_times_out_waiting_for_slot():
+    async def _run():
+        limiter = ConcurrencyLimiter(max_concurrency=1, max_queue=4, timeout=0.01)
+        async with limiter.acquire():
+            with pytest.raises(LimiterTimeoutError):
+                async with limiter.acquire():
+                    pass
+        assert limiter.waiting == 0
+        async with limiter.acquire():
+            assert limiter.running == 1
+
+    asyncio.run(_run())
@@ -0,0 +1,99 @@
+import asyncio
+
+from melody.loader import DataLoader
+
+
+def test_loads_in_one_tick_are_batched():
+    batches = []
+
+    async def _batch(keys):
+        batches.append(list(keys))
+        return {key: key * 10 for key in keys if key != 3}
+
+    async def _run():
+        loader = DataLoader(_batch, max_batch_size=2)
+        values = await asyncio.gather(loader.load(1), loader.load(2), loader.load(1), loader.load(3))
+        assert values == [10, 20, 10, None]
+        assert batches == [[1, 2], [3]]
+        # memoized until cleared
+        assert await loader.load(2) == 20
+        assert len(batches) == 2
+        loader.clear(2)
+        assert await loader.load_many([2, 1]) == [20, 10]
+        assert batches[-1] == [2]
+
+    asyncio.run(_run())
+
+
+def test_batch_errors_are_propagated_and_not_memoized():
+    calls = []
+
+    async def _batch(keys):
+        calls.append(keys)
+        if len(calls) == 1:
+            raise RuntimeError("database is down")
+        return {key: key for key in keys}
+
+    async def _run():
+        loader = DataLoader(_batch)
+        results = await asyncio.gather(loader.load(1), loader.load(2), return_exceptions=True)
+        assert all(isinstance(r, RuntimeError) for r in results)
+        assert await loader.load(1) == 1
+
+    asyncio.run(_run())
+
+
+class _Abort(BaseException):
+    pass
+
+
+def test_cancelled_callers_and_loads():
+    started = []
+
+    async def _batch(keys):
+        started.append(list(keys))
+        await asyncio.sleep(0.01)
+        if len(started) == 2:
+            raise _Abort()
+        return {key: key for key in keys}
+
+    async def _run():
+        loader = DataLoader(_batch)
+        first, second = asyncio.ensure_future(loader.load(1)), asyncio.ensure_future(loader.load(1))
+        await asyncio.sleep(0)
+        first.cancel()
+        # the other caller of the key still gets its value, and it stays memoized
+        assert await second == 1
+        assert first.cancelled() and await loader.load(1) == 1 and len(started) == 1
+
+        # a BaseException of batch_fn leaves no future pending, the next load retries
+        results = await asyncio.gather(loader.load(2), loader.load(3), return_exceptions=True)
+        assert all(isinstance(r, asyncio.CancelledError) for r in results)
+        assert await loader.load(2) == 2 and started[-1] == [2]
+
+    asyncio.run(_run())
+
+
+def test_clear_forgets_loads_in_flight():
+    started = []
+
+    async def _batch(keys):
+        started.append(list(keys))
+        await asyncio.sleep(0.01)
+        return {key: len(started) for key in keys}
+
+    async def _run():
+        loader = DataLoader(_batch)
+        first = asyncio.ensure_future(loader.load(1))
+        await asyncio.sleep(0)
+        loader.clear(1)
+        # a new batch, the callers of the cleared load still get its result
+        assert await loader.load(1) == 2 and await first == 1
+        assert started == [[1], [1]]
+
+        queued = loader.load(2)
+        loader.clear_all()
+        assert await asyncio.gather(queued, loader.load(2)) == [3, 3] and started[-1] == [2]
+        assert await loader.load(2) == 3
+
+    asyncio.run(_run())
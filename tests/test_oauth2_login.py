@@ -0,0 +1,83 @@
+import asyncio
+
+import pytest
+from sqlalchemy import func, select, update
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlmodel import SQLModel
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from melody.identity import crud
+from melody.identity.exception import IdentityException
+from melody.identity.models import OAuth2IdentityLoginRequest
+from melody.identity.tables import Identity
+from melody.user.tables import User
+
+
+def test_login_with_oauth2_creates_user_once(tmp_path):
+    async def _run():
+        engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path}/login.db")
+        async with engine.begin() as conn:
+            await conn.run_sync(SQLModel.metadata.create_all)
+        request = OAuth2IdentityLoginRequest(
+            tenant_id="acme", provider_id="github", provider_uid="42", username="melody", email="melody@example.com"
+        )
+        logins = []
+        for _ in range(2):
+            async with AsyncSession(engine) as session:
+                async with session.begin():
+                    identity = await crud.login_with_oauth2(session, request=request)
+                    logins.append((identity.id, identity.user_id, identity.iden_type))
+        assert logins[0] == logins[1]
+        assert logins[0][2] == "OAUTH_GITHUB"
+        async with AsyncSession(engine) as session:
+            assert (await session.exec(select(func.count()).select_from(User))).scalar() == 1
+            user = (await session.exec(select(User))).scalars().one()
+            assert user.username == "melody" and user.last_signin_at is not None
+        await engine.dispose()
+
+    asyncio.run(_run())
+
+
+def test_concurrent_first_logins_and_stale_cache(tmp_path, monkeypatch):
+    async def _run():
+        engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path}/login.db")
+        async with engine.begin() as conn:
+            await conn.run_sync(SQLModel.metadata.create_all)
+        request = OAuth2IdentityLoginRequest(tenant_id="acme", provider_id="github", provider_uid="43", username="m")
+        async with AsyncSession(engine) as session:
+            async with session.begin():
+                first_id = (await crud.login_with_oauth2(session, request=request)).id
+            # cached, as by the rest api
+            cached = await crud.retrieve_oauth2_identity(session, tenant_id="acme", provider_id="github", provider_uid="43")
+            assert cached.id == first_id
+
+        # the lookup ran before the first login committed, the insert loses the race on ix_identities_tenant_iden
+        retrieve, lookups = crud.retrieve_oauth2_identity, []
+
+        async def _racing(session, **kwargs):
+            lookups.append(kwargs)
+            return None if len(lookups) == 1 else await retrieve(session, **kwargs)
+
+        monkeypatch.setattr(crud, "retrieve_oauth2_identity", _racing)
+        async with AsyncSession(engine) as session:
+            async with session.begin():
+                identity_id = (await crud.login_with_oauth2(session, request=request)).id
+        assert identity_id == first_id and len(lookups) == 2 and not lookups[0]["cached"]
+        monkeypatch.setattr(crud, "retrieve_oauth2_identity", retrieve)
+        async with AsyncSession(engine) as session:
+            # the user of the losing login was rolled back with its savepoint
+            assert (await session.exec(select(func.count()).select_from(User))).scalar() == 1
+
+        # deactivated by another process, the cached identity is still active
+        async with engine.begin() as conn:
+            await conn.execute(update(Identity).values(status="INACTIVE"))
+        async with AsyncSession(engine) as session:
+            with pytest.raises(IdentityException):
+                async with session.begin():
+                    await crud.login_with_oauth2(session, request=request)
+        await engine.dispose()
+
+    try:
+        asyncio.run(_run())
+    finally:
+        crud.identity_cache.clear()
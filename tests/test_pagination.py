@@ -0,0 +1,85 @@
+import asyncio
+import uuid
+from datetime import datetime, timezone
+
+import pytest
+from sqlalchemy import insert, update
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlmodel import SQLModel
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from melody.identity import crud as identity_crud
+from melody.identity.tables import Identity
+from melody.pagination import decode_cursor, encode_cursor
+from melody.user import crud as user_crud
+from melody.user.models import UserCreateRequest
+from melody.user.tables import User
+
+
+def test_cursor_roundtrip():
+    created_at, id = datetime(2024, 3, 1, 12, 30, 15, 123456, tzinfo=timezone.utc), uuid.uuid4()
+    assert decode_cursor(encode_cursor(created_at, id)) == (created_at, id)
+
+
+@pytest.mark.parametrize("cursor", ["", "not-base64!", "W10", "WyJ4IiwgInkiXQ"])
+def test_malformed_cursor(cursor):
+    with pytest.raises(ValueError):
+        decode_cursor(cursor)
+
+
+async def _pages(list_fn, **kwargs) -> list:
+    pages, cursor = [], None
+    while True:
+        page = await list_fn(cursor=cursor, limit=3, **kwargs)
+        pages.append(page.items)
+        cursor = page.next_cursor
+        if cursor is None:
+            return pages
+
+
+def test_list_pages_with_ties_and_filters(tmp_path):
+    async def _run():
+        engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path}/pages.db")
+        async with engine.begin() as conn:
+            await conn.run_sync(SQLModel.metadata.create_all)
+        async with AsyncSession(engine) as session:
+            # one multi-row insert, all users of a tenant share created_at
+            users = await user_crud.create_users(
+                session, requests=[UserCreateRequest(tenant_id="acme", username=f"u{i}") for i in range(8)]
+            )
+            ids = {u.username: u.id for u in users}
+            await user_crud.create_users(session, requests=[UserCreateRequest(tenant_id="other", username="x")])
+            await session.exec(update(User).where(User.username == "u3").values(status="INACTIVE"))
+            await user_crud.delete_user(session, id=ids["u5"], soft_delete=True)
+            now = datetime(2024, 1, 1)
+            await session.exec(
+                insert(Identity),
+                params=[
+                    dict(tenant_id="acme", user_id=id, iden_type=t, iden_value=name, created_at=now, updated_at=now, props={})
+                    for name, id in ids.items()
+                    for t in ("EMAIL", "OAUTH_GITHUB")
+                ],
+            )
+            await session.commit()
+
+            pages = await _pages(user_crud.list_users, session=session, tenant_id="acme")
+            assert [len(page) for page in pages] == [3, 3, 1]
+            listed = [user.id for page in pages for user in page]
+            # every user once, ordered by (created_at, id)
+            assert listed == sorted(id for name, id in ids.items() if name != "u5")
+            pages = await _pages(user_crud.list_users, session=session, tenant_id="acme", status="INACTIVE")
+            assert [[u.username for u in page] for page in pages] == [["u3"]]
+            pages = await _pages(user_crud.list_users, session=session, tenant_id="acme", deleted=True)
+            assert [[u.username for u in page] for page in pages] == [["u5"]]
+
+            pages = await _pages(identity_crud.list_identities, session=session, tenant_id="acme")
+            assert [len(page) for page in pages] == [3, 3, 3, 3, 3, 1]
+            assert len({i.id for page in pages for i in page}) == 16
+            pages = await _pages(identity_crud.list_identities, session=session, tenant_id="acme", iden_type="EMAIL")
+            assert sorted(i.iden_value for page in pages for i in page) == [f"u{i}" for i in range(8)]
+            assert await _pages(identity_crud.list_identities, session=session, tenant_id="other") == [[]]
+            with pytest.raises(ValueError):
+                await user_crud.list_users(session, tenant_id="acme", cursor="garbage")
+        await engine.dispose()
+
+    asyncio.run(_run())
@@ -0,0 +1,45 @@
+import asyncio
+
+import pytest
+from sqlalchemy import exc
+
+from melody.config import DatabaseSettings
+from melody.db import Database
+from melody.pool import create_engine, pool_options, pool_stats
+
+
+def test_pool_options_from_settings():
+    settings = DatabaseSettings(database_uri="postgresql+asyncpg://db/melody", conn_pool_min_size=5, conn_pool_max_size=20)
+    options = pool_options(settings)
+    assert options["pool_size"] == 5
+    assert options["max_overflow"] == 15
+    assert pool_options(DatabaseSettings(database_uri="sqlite+aiosqlite://")) == {}
+
+
+def test_pool_metrics_and_raw_queries(tmp_path):
+    settings = DatabaseSettings(
+        database_uri=f"sqlite+aiosqlite:///{tmp_path}/pool.db",
+        conn_pool_min_size=1,
+        conn_pool_max_size=2,
+        conn_pool_timeout=0.1,
+    )
+
+    async def _run():
+        engine = create_engine(settings)
+        database = Database(engine)
+        assert await database.fetch_val("SELECT 1") == 1
+        conns = [await engine.connect() for _ in range(2)]
+        stats = pool_stats(engine)
+        assert stats.checked_out == 2
+        with pytest.raises(exc.TimeoutError):
+            await engine.connect()
+        for conn in conns:
+            await conn.close()
+        stats = pool_stats(engine)
+        assert stats.checked_out == 0
+        assert stats.timeouts == 1
+        assert stats.acquires == 4
+        assert stats.waiting == 0
+        await database.disconnect()
+
+    asyncio.run(_run())
@@ -0,0 +1,130 @@
+import asyncio
+import random
+import sqlite3
+import uuid
+from datetime import timedelta
+
+from sqlalchemy import create_engine, event, insert, select
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlmodel import SQLModel
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from melody import utils
+from melody.config import cache_settings
+from melody.identity import crud as identity_crud
+from melody.identity.tables import Identity
+from melody.tenancy import scope_session
+from melody.user import crud as user_crud
+from melody.user.tables import User
+
+TENANTS = 50
+USERS = 6000
+
+
+def _populate(path) -> None:
+    engine = create_engine(f"sqlite:///{path}")
+    SQLModel.metadata.create_all(engine)
+    rand = random.Random(7)
+    now = utils.utc_now()
+    users, identities = [], []
+    for i in range(USERS):
+        # skewed tenants, the first tenants hold most users
+        tenant_id = f"t{int(TENANTS * rand.random() ** 2)}"
+        created_at = now - timedelta(seconds=i)
+        user_id = uuid.uuid4()
+        users.append(dict(id=user_id, tenant_id=tenant_id, email=f"u{i}@example.com", created_at=created_at, updated_at=now))
+        identities.append(
+            dict(
+                id=uuid.uuid4(),
+                tenant_id=tenant_id,
+                user_id=user_id,
+                iden_type="EMAIL",
+                iden_value=f"u{i}@example.com",
+                created_at=created_at,
+                updated_at=now,
+            )
+        )
+    with engine.begin() as conn:
+        conn.execute(insert(User), users)
+        conn.execute(insert(Identity), identities)
+        conn.exec_driver_sql("ANALYZE")
+    engine.dispose()
+
+
+def _plan(path, statement, parameters):
+    with sqlite3.connect(path) as conn:
+        return [row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {statement}", parameters)]
+
+
+def _assert_indexed(plan, index):
+    assert any(f"USING INDEX {index}" in step or f"USING COVERING INDEX {index}" in step for step in plan), plan
+    assert not any(step.startswith("SCAN") for step in plan), plan
+    assert not any("TEMP B-TREE" in step for step in plan), plan
+
+
+def test_hot_lookups_use_tenant_indexes(tmp_path, monkeypatch):
+    path = tmp_path / "plans.db"
+    _populate(path)
+    monkeypatch.setattr(cache_settings, "cache_enabled", False)
+
+    async def _capture():
+        engine = create_async_engine(f"sqlite+aiosqlite:///{path}")
+        statements = []
+
+        @event.listens_for(engine.sync_engine, "before_cursor_execute")
+        def _record(conn, cursor, statement, parameters, context, executemany):
+            statements.append((statement, parameters))
+
+        async with AsyncSession(engine) as session:
+            user = (await session.exec(select(User).where(User.tenant_id == "t3"))).scalars().first()
+            scope_session(session, "t3")
+            captured = {}
+
+            async def _run(name, coro):
+                del statements[:]
+                await coro
+                captured[name] = statements[-1]
+
+            await _run("email_identity", identity_crud.retrieve_email_identity(session, tenant_id="t3", email=user.email))
+            await _run("identities_of_user", identity_crud.retrieve_identities_by_user_id(session, user_id=user.id))
+            await _run("list_identities", identity_crud.list_identities(session, tenant_id="t3", limit=20))
+            await _run("list_users", user_crud.list_users(session, tenant_id="t3", limit=20))
+            page = await user_crud.list_users(session, tenant_id="t3", limit=20)
+            await _run("list_users_next", user_crud.list_users(session, tenant_id="t3", cursor=page.next_cursor, limit=20))
+            await _run("user_by_email", session.exec(select(User).where(User.email == user.email)))
+            # lookups outside of a tenant scope, e.g. by the user service
+            scope_session(session, None)
+            await _run("identities_of_any_tenant", identity_crud.retrieve_identities_by_user_id(session, user_id=user.id))
+            await _run("user_by_email_of_any_tenant", session.exec(select(User).where(User.email == user.email)))
+        await engine.dispose()
+        return captured
+
+    captured = asyncio.run(_capture())
+    _assert_indexed(_plan(path, *captured["email_identity"]), "ix_identities_tenant_iden")
+    _assert_indexed(_plan(path, *captured["identities_of_user"]), "ix_identities_tenant_user_id")
+    _assert_indexed(_plan(path, *captured["list_identities"]), "ix_identities_tenant_created_at")
+    _assert_indexed(_plan(path, *captured["list_users"]), "ix_user_tenant_created_at")
+    _assert_indexed(_plan(path, *captured["list_users_next"]), "ix_user_tenant_created_at")
+    _assert_indexed(_plan(path, *captured["user_by_email"]), "ix_user_tenant_email")
+    _assert_indexed(_plan(path, *captured["identities_of_any_tenant"]), "ix_identities_user_id")
+    _assert_indexed(_plan(path, *captured["user_by_email_of_any_tenant"]), "ix_user_email")
+
+
+def test_scoped_session_hides_other_tenants(tmp_path):
+    async def _run():
+        engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path}/scoped.db")
+        async with engine.begin() as conn:
+            await conn.run_sync(SQLModel.metadata.create_all)
+        async with AsyncSession(engine) as session:
+            session.add(User(tenant_id="acme", username="a"))
+            session.add(User(tenant_id="other", username="b"))
+            await session.commit()
+        async with AsyncSession(engine) as session:
+            scope_session(session, "acme")
+            users = (await session.exec(select(User))).scalars().all()
+            assert [user.username for user in users] == ["a"]
+            scope_session(session, None)
+            assert len((await session.exec(select(User))).scalars().all()) == 2
+        await engine.dispose()
+
+    asyncio.run(_run())
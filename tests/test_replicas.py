@@ -0,0 +1,50 @@
+import asyncio
+
+import pytest
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from melody.replicas import ReadOnlySessionError, ReplicaRouter, mark_read_only, primary_until
+
+
+def test_reads_are_balanced_over_healthy_replicas(tmp_path):
+    async def _run():
+        primary = create_async_engine(f"sqlite+aiosqlite:///{tmp_path}/primary.db")
+        a = create_async_engine(f"sqlite+aiosqlite:///{tmp_path}/a.db")
+        b = create_async_engine(f"sqlite+aiosqlite:///{tmp_path}/missing/b.db")
+        router = ReplicaRouter(primary, [a, b], health_check_interval=60)
+        assert [router.engine_for_read() for _ in range(4)] == [a, b, a, b]
+        assert router.engine_for_read(primary=True) is primary
+
+        health = await router.check_health()
+        assert list(health.values()) == [True, False]
+        assert [router.engine_for_read() for _ in range(3)] == [a, a, a]
+
+        router._healthy[a] = False
+        assert router.engine_for_read() is primary
+        await router.dispose()
+        await primary.dispose()
+
+    asyncio.run(_run())
+
+
+def test_read_only_session_rejects_writes(tmp_path):
+    async def _run():
+        engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path}/db.db")
+        async with engine.begin() as conn:
+            await conn.execute(text("CREATE TABLE t (id INTEGER PRIMARY KEY)"))
+        async with AsyncSession(engine) as session:
+            mark_read_only(session, replica=True)
+            assert (await session.exec(text("SELECT count(*) FROM t"))).scalar() == 0
+            with pytest.raises(ReadOnlySessionError):
+                await session.exec(text("INSERT INTO t (id) VALUES (1)"))
+        await engine.dispose()
+
+    asyncio.run(_run())
+
+
+def test_primary_until_cookie():
+    assert primary_until({"melody_primary_until": "1700000000.5"}) == 1700000000.5
+    assert primary_until({"melody_primary_until": "bogus"}) == 0
+    assert primary_until({}) == 0
@@ -0,0 +1,100 @@
+import asyncio
+
+import httpx
+import pytest
+
+from melody_users.resilience import CircuitBreaker, CircuitOpenError, ProviderGuard
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_circuit_breaker_opens_and_probes():
+    clock = FakeClock()
+    breaker = CircuitBreaker(failure_threshold=2, recovery_timeout=10, clock=clock)
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == "open" and not breaker.allow()
+    clock.now += 10
+    # a single probe while half open
+    assert breaker.allow() and not breaker.allow()
+    breaker.record_success()
+    assert breaker.state == "closed" and breaker.allow()
+
+
+def test_guard_retries_idempotent_requests_and_short_circuits():
+    async def _run():
+        calls = []
+
+        def handler(request: httpx.Request) -> httpx.Response:
+            calls.append(request.method)
+            return httpx.Response(503 if len(calls) < 3 else 200)
+
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+            guard = ProviderGuard("github", backoff_base=0.001, failure_threshold=2)
+            response = await guard.request("userinfo", lambda: client.get("https://github/user"), idempotent=True)
+            assert response.status_code == 200 and len(calls) == 3
+            # a token exchange answered is not retried
+            calls.clear()
+            response = await guard.request("token", lambda: client.post("https://github/token"), idempotent=False)
+            assert response.status_code == 503 and len(calls) == 1
+            await guard.request("token", lambda: client.post("https://github/token"), idempotent=False)
+            with pytest.raises(CircuitOpenError):
+                await guard.request("token", lambda: client.post("https://github/token"), idempotent=False)
+            stats = guard.snapshot()
+            assert stats.breaker == "open"
+            assert stats.endpoints["userinfo"].retries == 2
+            assert stats.endpoints["token"].short_circuited == 1
+
+    asyncio.run(_run())
+
+
+def test_guard_hedges_slow_requests():
+    async def _run():
+        calls = []
+
+        async def handler(request: httpx.Request) -> httpx.Response:
+            calls.append(request.method)
+            if len(calls) == 1:
+                await asyncio.sleep(1)
+            return httpx.Response(200, json={"attempt": len(calls)})
+
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+            guard = ProviderGuard("github", hedge_delay=0.01)
+            response = await guard.request(
+                "userinfo", lambda: client.get("https://github/user"), idempotent=True, hedge=True
+            )
+            assert response.json() == {"attempt": 2}
+            assert guard.snapshot().endpoints["userinfo"].hedges == 1
+            assert guard.snapshot().endpoints["userinfo"].latency_ms.max < 500
+
+    asyncio.run(_run())
+
+
+def test_cancelled_probe_releases_the_breaker():
+    async def _run():
+        started = asyncio.Event()
+
+        async def handler(request: httpx.Request) -> httpx.Response:
+            started.set()
+            await asyncio.sleep(10)
+            return httpx.Response(200)
+
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+            guard = ProviderGuard("github", failure_threshold=1, recovery_timeout=0)
+            guard.breaker.record_failure()
+            # half open, the probe is cancelled, e.g. by a client disconnect
+            probe = asyncio.create_task(guard.request("userinfo", lambda: client.get("https://github/user"), idempotent=True))
+            await started.wait()
+            probe.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await probe
+            assert guard.breaker.state == "half_open" and guard.breaker.allow()
+
+    asyncio.run(_run())
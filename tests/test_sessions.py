@@ -0,0 +1,69 @@
+import asyncio
+import uuid
+from datetime import datetime, timedelta
+from typing import Annotated
+
+import httpx
+from fastapi import Depends, FastAPI
+from sqlalchemy import insert
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from melody_users.sessions import SessionValidator, ValidatedSession, session_dependency
+from melody_users.tables import Session
+
+sessions = Session.__table__
+
+
+def test_validate_and_revoke_sessions(tmp_path):
+    async def _run():
+        engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path}/sessions.db")
+        now = datetime.utcnow()
+        user_id = uuid.uuid4()
+        async with engine.begin() as conn:
+            await conn.run_sync(sessions.create)
+            await conn.execute(
+                insert(sessions),
+                [
+                    {"user_id": user_id, "iden_id": uuid.uuid4(), "auth_token": "live", "expires_at": now + timedelta(hours=1)},
+                    {"user_id": user_id, "iden_id": uuid.uuid4(), "auth_token": "other", "expires_at": now + timedelta(hours=1)},
+                    {"user_id": user_id, "iden_id": uuid.uuid4(), "auth_token": "short", "expires_at": now + timedelta(seconds=10)},
+                ],
+            )
+        clock = lambda: now  # noqa: E731
+        validator = SessionValidator(engine, sessions, clock=lambda: clock())
+
+        assert (await validator.validate("live")).user_id == user_id
+        assert await validator.validate("unknown") is None
+        assert (await validator.validate("short")) is not None
+        # cached, but not served past expires_at
+        clock = lambda: now + timedelta(seconds=11)  # noqa: E731
+        assert await validator.validate("short") is None
+        assert validator.cache.stats.loads == 3
+
+        assert await validator.revoke("live")
+        assert await validator.validate("live") is None
+        assert await validator.revoke_user(user_id) == 2
+        assert await validator.validate("other") is None
+
+        # revoked by a signed session logout, the row is kept until it expires
+        async with engine.begin() as conn:
+            row = dict(user_id=user_id, iden_id=uuid.uuid4(), auth_token="revoked", sid="s", deleted_at=now)
+            await conn.execute(insert(sessions).values(**row, expires_at=now + timedelta(hours=1)))
+        assert await validator.validate("revoked") is None
+
+        app = FastAPI()
+
+        @app.get("/me")
+        async def me(session: Annotated[ValidatedSession, Depends(session_dependency(validator))]):
+            return {"user_id": str(session.user_id)}
+
+        async with engine.begin() as conn:
+            await conn.execute(insert(sessions).values(user_id=user_id, iden_id=uuid.uuid4(), auth_token="new"))
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+            response = await client.get("/me", headers={"Authorization": "Bearer new"})
+            assert response.status_code == 200 and response.json() == {"user_id": str(user_id)}
+            assert (await client.get("/me", headers={"Authorization": "Bearer live"})).status_code == 401
+            assert (await client.get("/me")).status_code == 401
+        await engine.dispose()
+
+    asyncio.run(_run())
@@ -0,0 +1,70 @@
+import asyncio
+
+import pytest
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlmodel import SQLModel
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from melody.identity.tables import Identity
+from melody.shard.mover import TenantMover
+from melody.shard.router import ConfigShardLookup, DirectoryShardLookup, ShardMap, TenantReadOnlyError
+from melody.user.tables import User
+
+
+async def _count(engine, model, tenant_id):
+    async with AsyncSession(engine) as session:
+        return (await session.exec(select(func.count()).select_from(model).where(model.tenant_id == tenant_id))).scalar()
+
+
+def test_shard_map_routes_by_tenant():
+    async def _run():
+        default, eu = object(), object()
+        shard_map = ShardMap({"default": default, "eu-1": eu}, lookup=ConfigShardLookup({"acme": "eu-1"}))
+        assert await shard_map.engine_for("acme") is eu
+        assert await shard_map.engine_for("other") is default
+        assert await shard_map.engine_for(None) is default
+
+    asyncio.run(_run())
+
+
+def test_move_tenant_online(tmp_path):
+    async def _run():
+        source = create_async_engine(f"sqlite+aiosqlite:///{tmp_path}/source.db")
+        target = create_async_engine(f"sqlite+aiosqlite:///{tmp_path}/target.db")
+        for engine in (source, target):
+            async with engine.begin() as conn:
+                await conn.run_sync(SQLModel.metadata.create_all)
+        directory = DirectoryShardLookup(source, ttl=0)
+        shard_map = ShardMap({"default": source, "eu-1": target}, lookup=directory)
+
+        async with AsyncSession(source) as session:
+            for i in range(25):
+                user = User(tenant_id="acme", username=f"u{i}")
+                session.add(user)
+                session.add(Identity(tenant_id="acme", user_id=user.id, iden_type="EMAIL", iden_value=f"u{i}@acme"))
+            session.add(User(tenant_id="other", username="stays"))
+            await session.commit()
+        async with AsyncSession(target) as session:
+            # a record deleted from the source after it was copied
+            session.add(User(tenant_id="acme", username="deleted"))
+            await session.commit()
+
+        await directory.assign("acme", "default", status="READ_ONLY")
+        with pytest.raises(TenantReadOnlyError):
+            await shard_map.engine_for("acme", write=True)
+        await directory.assign("acme", "default")
+
+        progress = await TenantMover(shard_map, directory, batch_size=10, overlap=0).move("acme", target="eu-1")
+        assert progress.phase == "done"
+        assert progress.deleted["user"] == 1
+        assert await shard_map.engine_for("acme", write=True) is target
+        assert await _count(target, User, "acme") == 25
+        assert await _count(target, Identity, "acme") == 25
+        assert await _count(source, User, "acme") == 0
+        assert await _count(source, Identity, "acme") == 0
+        assert await _count(source, User, "other") == 1
+        await source.dispose()
+        await target.dispose()
+
+    asyncio.run(_run())
@@ -0,0 +1,102 @@
+import asyncio
+import uuid
+from datetime import datetime, timedelta
+
+from sqlalchemy import insert
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from melody_users.signed_sessions import (
+    BloomFilter,
+    RevocationList,
+    RevocationSync,
+    SignedSessionTokens,
+    SigningKeyring,
+)
+from melody_users.tables import Session
+
+sessions = Session.__table__
+
+
+def _issue(tokens: SignedSessionTokens, sid: str, expires_at: datetime) -> str:
+    return tokens.issue(sid=sid, user_id=uuid.uuid4(), iden_id=uuid.uuid4(), tenant_id=None, expires_at=expires_at)
+
+
+def test_verify_and_rotate_keys():
+    now = [1_700_000_000.0]
+    keyring = SigningKeyring({"k1": b"one"}, active="k1", grace=60, clock=lambda: now[0])
+    tokens = SignedSessionTokens(keyring, RevocationList(), clock=lambda: now[0])
+    expires_at = datetime.utcfromtimestamp(now[0] + 3600)
+
+    token = _issue(tokens, "s1", expires_at)
+    session = tokens.verify(token)
+    assert session.sid == "s1" and session.expires_at == expires_at and session.tenant_id is None
+    assert tokens.verify(token[:-2] + ("AA" if token[-2:] != "AA" else "BB")) is None
+    assert tokens.verify("v1.k1.e30.x") is None and tokens.verify("") is None
+
+    keyring.rotate("k2", b"two")
+    assert tokens.verify(_issue(tokens, "s2", expires_at)).sid == "s2"
+    # signed by the previous key, verified during the grace window only
+    assert tokens.verify(token) is not None
+    now[0] += 61
+    assert tokens.verify(token) is None
+
+    now[0] += 3600
+    assert tokens.verify(_issue(tokens, "s3", expires_at)) is None
+
+
+def test_revocations():
+    bloom = BloomFilter(capacity=1000, error_rate=0.01)
+    for i in range(1000):
+        bloom.add(f"s{i}")
+    assert all(f"s{i}" in bloom for i in range(1000))
+    assert sum(f"other{i}" in bloom for i in range(10000)) < 300
+
+    now = [100.0]
+    revocations = RevocationList(capacity=2, clock=lambda: now[0])
+    for i in range(5):
+        revocations.add(f"s{i}", expires_at=110.0 + i)
+    assert all(f"s{i}" in revocations for i in range(5)) and "s9" not in revocations
+    now[0] = 112.5
+    revocations.prune()
+    assert len(revocations) == 2 and "s0" not in revocations and "s4" in revocations
+
+
+def test_revocation_sync(tmp_path):
+    async def _run():
+        engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path}/sessions.db")
+        now = datetime.utcnow()
+        expires_at = now + timedelta(hours=1)
+        keyring = SigningKeyring({"k1": b"one"}, active="k1")
+        # two processes, each with its own revocation list
+        tokens, remote = SignedSessionTokens(keyring, RevocationList()), SignedSessionTokens(keyring, RevocationList())
+        sync = RevocationSync(engine, sessions, tokens.revocations)
+        # the clock of the remote process runs ahead, its cursor is read from the database
+        remote_sync = RevocationSync(engine, sessions, remote.revocations, clock=lambda: datetime.utcnow() + timedelta(minutes=10))
+        async with engine.begin() as conn:
+            await conn.run_sync(sessions.create)
+        assert await remote_sync.sync() == 0
+        async with engine.begin() as conn:
+            await conn.execute(
+                insert(sessions),
+                [
+                    {"auth_token": f"secret-{sid}", "sid": sid, "expires_at": expires_at, "deleted_at": deleted_at}
+                    for sid, deleted_at in [("revoked", now - timedelta(minutes=1)), ("live", None), ("other", None)]
+                ],
+            )
+
+        assert await sync.sync() == 1
+        assert tokens.verify(_issue(tokens, "revoked", expires_at)) is None
+
+        live = _issue(tokens, "live", expires_at)
+        assert tokens.verify(live) is not None
+        # revoked by its public id, its auth_token does not revoke it
+        assert not await sync.revoke("secret-live")
+        assert await sync.revoke("live") and not await sync.revoke("live")
+        assert tokens.verify(live) is None
+        # other processes reject it after their next sync
+        assert remote.verify(live) is not None
+        await remote_sync.sync()
+        assert remote.verify(live) is None and remote.verify(_issue(tokens, "other", expires_at)) is not None
+        await engine.dispose()
+
+    asyncio.run(_run())
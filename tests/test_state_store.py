@@ -0,0 +1,84 @@
+import asyncio
+from datetime import datetime, timedelta
+
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from melody_users import tables
+from melody_users.oauth2_client import OAuth2State, OAuth2StateRepository
+from melody_users.state_store import (
+    DatabaseStateStore,
+    ExpiringDict,
+    LocalSharedClient,
+    MemoryStateStore,
+    SharedStateStore,
+    create_state_store,
+)
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_expiring_dict_evicts_expired_and_oldest():
+    clock = FakeClock()
+    states = ExpiringDict(max_size=3, tick=1.0, wheel_size=8, clock=clock)
+    states.set("a", 1, ttl=2)
+    states.set("b", 2, ttl=10)
+    clock.now += 3.5
+    # a is evicted by the wheel, b hashes to the same slot one revolution later
+    states.set("c", 3, ttl=60)
+    assert len(states) == 2 and states.expired == 1
+    assert states.get("b") == 2
+    states.set("d", 4, ttl=60)
+    states.set("e", 5, ttl=60)
+    assert states.evicted == 1 and states.get("b") is None
+    clock.now += 1000
+    assert states.pop("c") is None
+    assert len(states) == 0
+
+
+def test_state_stores_take_once():
+    async def _run():
+        clock = FakeClock()
+        for store in (MemoryStateStore(clock=clock), SharedStateStore(LocalSharedClient(clock=clock))):
+            await store.put("t:s1", {"provider": "github", "code_verifier": "v"}, ttl=60)
+            await store.put("t:s2", {"provider": "github"}, ttl=60)
+            assert await store.take("t:s1") == {"provider": "github", "code_verifier": "v"}
+            assert await store.take("t:s1") is None
+            clock.now += 61
+            assert await store.take("t:s2") is None
+            await store.aclose()
+
+    asyncio.run(_run())
+
+
+def test_state_repository_expires_states():
+    repository = OAuth2StateRepository(max_size=10, ttl=0)
+    repository.save(OAuth2State(id="s", client_id="c", provider="github"))
+    assert repository.delete("s") is None
+
+
+def test_database_state_store_is_the_default(tmp_path):
+    async def _run():
+        engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path}/states.db")
+        table = tables.OAuth2State.__table__
+        async with engine.begin() as conn:
+            await conn.run_sync(table.create)
+        now = [datetime(2024, 1, 1)]
+        store = create_state_store(engine=engine, table=table)
+        assert isinstance(store, DatabaseStateStore)
+        # two processes on the same database
+        store, other = (DatabaseStateStore(engine, table, clock=lambda: now[0]) for _ in range(2))
+        await store.put("t:s1", {"provider": "github", "code_verifier": "v", "nonce": "n"}, ttl=60)
+        await store.put("t:s2", {"provider": "github"}, ttl=60)
+        assert await other.take("t:s1") == {"provider": "github", "code_verifier": "v", "nonce": "n"}
+        assert await store.take("t:s1") is None
+        now[0] += timedelta(seconds=61)
+        assert await store.take("t:s2") is None
+        await engine.dispose()
+
+    asyncio.run(_run())
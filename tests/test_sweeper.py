@@ -0,0 +1,45 @@
+import asyncio
+from datetime import datetime, timedelta
+
+from sqlalchemy import TIMESTAMP, Column, Integer, MetaData, String, Table, func, insert, select
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from melody.sweeper import ExpirySweeper
+
+metadata = MetaData()
+# a table without primary key, swept by its row locator
+states = Table("states", metadata, Column("state", String), Column("expires_at", TIMESTAMP, index=True))
+tokens = Table(
+    "tokens", metadata, Column("id", Integer, primary_key=True), Column("expires_at", TIMESTAMP, index=True)
+)
+
+
+def test_sweeper_purges_expired_rows_in_batches(tmp_path):
+    async def _run():
+        engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path}/sweep.db")
+        now = datetime(2024, 1, 1, 12)
+        async with engine.begin() as conn:
+            await conn.run_sync(metadata.create_all)
+            await conn.execute(insert(states), [{"state": str(i), "expires_at": now - timedelta(minutes=i)} for i in range(25)])
+            await conn.execute(
+                insert(tokens), [{"expires_at": now - timedelta(hours=i)} for i in range(5)] + [{"expires_at": None}]
+            )
+
+        limited = ExpirySweeper(engine, [states], batch_size=10, max_batches=2, batch_pause=0, clock=lambda: now)
+        stats = await limited.run_once()
+        assert stats.purged == {"states": 20} and stats.truncated
+
+        sweeper = ExpirySweeper(
+            engine, [states, tokens], retentions={"tokens": 7200}, batch_size=10, batch_pause=0, clock=lambda: now
+        )
+        stats = await sweeper.run_once()
+        # the state expiring now is not purged yet, tokens are kept two hours after they expired
+        assert stats.purged == {"states": 4, "tokens": 2}
+        assert not stats.truncated
+        async with engine.connect() as conn:
+            assert (await conn.execute(select(func.count()).select_from(states))).scalar() == 1
+            assert (await conn.execute(select(func.count()).select_from(tokens))).scalar() == 4
+        assert sweeper.snapshot().runs == 1
+        await engine.dispose()
+
+    asyncio.run(_run())
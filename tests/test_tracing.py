@@ -0,0 +1,48 @@
+import logging
+
+from sqlalchemy import create_engine, text
+
+from melody.metrics import Histogram
+from melody.tracing import QueryTracer, fingerprint
+
+
+def test_fingerprint_collapses_parameters():
+    assert fingerprint("SELECT * FROM users WHERE id IN ($1::UUID, $2::UUID) LIMIT 10") == (
+        "SELECT * FROM users WHERE id IN (?) LIMIT ?"
+    )
+    assert fingerprint("INSERT INTO users (a, b) VALUES (?, ?), (?, ?),\n (?, ?)") == fingerprint(
+        "INSERT INTO users (a, b) VALUES (?, ?)"
+    )
+    assert fingerprint("SELECT * FROM t WHERE x = :x_1 AND y = 'a''b'") == "SELECT * FROM t WHERE x = ? AND y = ?"
+
+
+def test_histogram_percentiles():
+    histogram = Histogram(buckets=(1, 10, 100))
+    for value in [0.5] * 90 + [5] * 9 + [500]:
+        histogram.observe(value)
+    assert histogram.percentile(0.5) == 1
+    assert histogram.percentile(0.95) == 10
+    assert histogram.percentile(1.0) == 500
+    assert histogram.snapshot().buckets == {"le_1": 90, "le_10": 9, "le_100": 0, "le_inf": 1}
+
+
+def test_tracer_records_stats_and_explains_slow_queries(caplog):
+    engine = create_engine("sqlite://")
+    tracer = QueryTracer(slow_query_ms=1e-6, explain=True)
+    tracer.install(engine)
+    with caplog.at_level(logging.WARNING, logger="melody.sql.slow"):
+        with engine.begin() as conn:
+            conn.execute(text("CREATE TABLE t (id INTEGER PRIMARY KEY)"))
+            conn.execute(text("INSERT INTO t (id) VALUES (:id)"), [{"id": 1}, {"id": 2}])
+            for i in range(3):
+                conn.execute(text("SELECT * FROM t WHERE id = :id"), {"id": i})
+    stats = {s.fingerprint: s for s in tracer.snapshot()}
+    select = stats["SELECT * FROM t WHERE id = ?"]
+    assert select.count == 3
+    assert select.latency_ms.count == 3
+    assert stats["INSERT INTO t (id) VALUES (?)"].rows == 2
+    # explained once per fingerprint within the interval
+    plans = [r for r in caplog.records if r.getMessage().startswith("plan of slow query")]
+    assert len(plans) == 1
+    assert "SEARCH" in plans[0].getMessage() or "PRIMARY KEY" in plans[0].getMessage()
+    tracer.uninstall(engine)
@@ -0,0 +1,64 @@
+import asyncio
+import uuid
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlmodel import SQLModel
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from melody.config import write_behind_settings
+from melody.identity import crud
+from melody.identity.models import EmailIdentityCreateRequest
+from melody_users.service import UserService
+from melody_users.tables import Identity, OAuth2State, Session, User
+
+
+def test_tables_have_primary_keys_and_own_columns():
+    for model in (User, Identity, Session, OAuth2State):
+        assert [column.name for column in model.__table__.primary_key] == ["id"]
+        # columns of the base model are not shared by the tables
+        assert model.__table__.c.tenant_id.table is model.__table__
+    assert Identity.__tablename__ != crud.Identity.__tablename__
+    assert User(username="m").deleted_at is None
+
+
+def test_password_login_and_sessions(tmp_path, monkeypatch):
+    monkeypatch.setattr(write_behind_settings, "write_behind_enabled", True)
+
+    async def _run():
+        engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path}/users.db")
+        async with engine.begin() as conn:
+            await conn.run_sync(SQLModel.metadata.create_all)
+        user_id, tenant_id = uuid.uuid4(), uuid.uuid4()
+        async with AsyncSession(engine) as session:
+            request = EmailIdentityCreateRequest(
+                tenant_id=str(tenant_id), user_id=user_id, email="m@example.com", password="secret", props={}
+            )
+            identity = await crud.create_email_identity(session, request=request)
+            iden_id = identity.id
+            await session.commit()
+
+        service = UserService(engine, tenant_id=tenant_id)
+        service.start_write_behind()
+        try:
+            assert await service.login_with_password("m@example.com", "wrong") is None
+            assert await service.login_with_password("m@example.com", "secret") == str(user_id)
+
+            token = await service.create_session(user_id=user_id, iden_id=iden_id)
+            session = await service.validate_session(token)
+            assert session.user_id == user_id and session.iden_id == iden_id
+            assert await service.refresh_session(token) is not None
+            # the last_signin_at of the identity, and the refreshed_at of the session
+            assert await service.refreshes.flush() == 2
+            async with AsyncSession(engine) as session:
+                row = (await session.exec(select(Session))).scalars().one()
+                assert row.refreshed_at is not None and row.created_at is not None and row.deleted_at is None
+            assert await service.logout(token) and await service.validate_session(token) is None
+        finally:
+            await service.aclose()
+        await engine.dispose()
+
+    try:
+        asyncio.run(_run())
+    finally:
+        crud.identity_cache.clear()
@@ -0,0 +1,142 @@
+import asyncio
+import json
+
+import httpx
+from fastapi import FastAPI
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlmodel import SQLModel
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from melody import deps
+from melody.replicas import ReplicaRouter
+from melody.tenancy import scope_session
+from melody.user.rest import router
+from melody.user.tables import User
+
+
+def _client(engine, tenant_id: str | None = None) -> httpx.AsyncClient:
+    app = FastAPI()
+    app.include_router(router)
+
+    async def _session():
+        async with AsyncSession(engine) as session:
+            scope_session(session, tenant_id)
+            yield session
+
+    app.dependency_overrides[deps.database_session] = _session
+    return httpx.AsyncClient(
+        transport=httpx.ASGITransport(app=app), base_url="http://test", headers={deps.TENANT_HEADER: "acme"}
+    )
+
+
+async def _usernames(engine) -> list:
+    async with AsyncSession(engine) as session:
+        return list((await session.exec(select(User.username).order_by(User.username))).scalars())
+
+
+def test_batch_json_array_across_chunks(tmp_path):
+    async def _run():
+        engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path}/batch.db")
+        async with engine.begin() as conn:
+            await conn.run_sync(SQLModel.metadata.create_all)
+        rows = [{"tenant_id": "acme", "username": f"u{i}"} for i in range(5)]
+        # invalid rows are reported by index and skipped, the others are created
+        rows.insert(2, {"tenant_id": "acme", "username": ["not", "a", "string"]})
+        rows.append({"tenant_id": "acme", "props": "not a dict"})
+        async with _client(engine) as client:
+            response = await client.post("/users:batch", params={"chunk_size": 2}, json=rows)
+            assert response.status_code == 200
+            body = response.json()
+            assert [user["username"] for user in body["users"]] == ["u0", "u1", "u2", "u3", "u4"]
+            assert [error["index"] for error in body["errors"]] == [2, 6]
+            assert "username" in body["errors"][0]["error"] and "props" in body["errors"][1]["error"]
+
+            assert (await client.post("/users:batch", json={"username": "u"})).status_code == 400
+            assert (await client.post("/users:batch", content=b"[{")).status_code == 400
+        # one transaction per chunk, committed
+        assert await _usernames(engine) == ["u0", "u1", "u2", "u3", "u4"]
+        await engine.dispose()
+
+    asyncio.run(_run())
+
+
+def test_batch_ndjson(tmp_path):
+    async def _run():
+        engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path}/batch.db")
+        async with engine.begin() as conn:
+            await conn.run_sync(SQLModel.metadata.create_all)
+        lines = [json.dumps({"tenant_id": "acme", "username": f"u{i}"}) for i in range(3)]
+        lines.insert(1, "{not json")
+        # streamed in pieces that split lines, blank lines are skipped
+        body = ("\n".join(lines) + "\n\n").encode()
+
+        async def _stream():
+            for i in range(0, len(body), 7):
+                yield body[i : i + 7]
+
+        async with _client(engine) as client:
+            response = await client.post(
+                "/users:batch",
+                params={"chunk_size": 2},
+                content=_stream(),
+                headers={"Content-Type": "application/x-ndjson"},
+            )
+            assert response.status_code == 200
+            result = response.json()
+            assert [user["username"] for user in result["users"]] == ["u0", "u1", "u2"]
+            assert len(result["errors"]) == 1 and result["errors"][0]["index"] == 1
+            assert result["errors"][0]["error"].startswith("invalid json")
+        async with AsyncSession(engine) as session:
+            assert (await session.exec(select(func.count()).select_from(User))).scalar() == 3
+        await engine.dispose()
+
+    asyncio.run(_run())
+
+
+def test_rows_of_another_tenant(tmp_path):
+    async def _run():
+        engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path}/batch.db")
+        async with engine.begin() as conn:
+            await conn.run_sync(SQLModel.metadata.create_all)
+        rows = [{"tenant_id": "acme", "username": "u0"}, {"tenant_id": "globex", "username": "u1"}]
+        async with _client(engine, tenant_id="acme") as client:
+            body = (await client.post("/users:batch", json=rows)).json()
+            assert [user["username"] for user in body["users"]] == ["u0"]
+            assert [error["index"] for error in body["errors"]] == [1] and "globex" in body["errors"][0]["error"]
+            # written in the shard of the request, not of the body
+            response = await client.post("/users", json={"tenant_id": "globex", "username": "u2"})
+            assert response.status_code == 422
+        assert await _usernames(engine) == ["u0"]
+        await engine.dispose()
+
+    asyncio.run(_run())
+
+
+def test_requests_of_the_default_tenant(tmp_path, monkeypatch):
+    async def _run():
+        engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path}/default.db")
+        async with engine.begin() as conn:
+            await conn.run_sync(SQLModel.metadata.create_all)
+        monkeypatch.setattr(deps, "engine", engine)
+        monkeypatch.setattr(deps, "replica_router", ReplicaRouter(engine, []))
+        async with AsyncSession(engine) as session:
+            users = [User(tenant_id="", username="a"), User(tenant_id="acme", username="b")]
+            default_id, acme_id = (str(user.id) for user in users)
+            session.add_all(users)
+            await session.commit()
+        app = FastAPI()
+        app.include_router(router)
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+            # without tenant, requests are of the default tenant ""
+            ids = {"ids": [default_id, acme_id]}
+            assert [user["id"] for user in (await client.get("/users", params=ids)).json()["items"]] == [default_id]
+            response = await client.get("/users", params=ids, headers={deps.TENANT_HEADER: "acme"})
+            assert [user["id"] for user in response.json()["items"]] == [acme_id]
+            response = await client.post("/users", json={"username": "c"})
+            assert response.status_code == 200 and response.json()["tenant_id"] == ""
+            response = await client.post("/users", headers={deps.TENANT_HEADER: "acme"}, json={"tenant_id": "globex"})
+            assert response.status_code == 422
+        await engine.dispose()
+
+    asyncio.run(_run())
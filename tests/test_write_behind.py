@@ -0,0 +1,115 @@
+import asyncio
+from datetime import datetime, timedelta
+
+from sqlalchemy import TIMESTAMP, Column, MetaData, String, Table, insert, select
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlmodel import SQLModel
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from melody.identity import crud
+from melody.identity.models import OAuth2IdentityLoginRequest
+from melody.shard.router import ShardLookup, ShardMap, TenantRoute
+from melody.user.tables import User
+from melody.write_behind import WriteBehindBuffer
+
+metadata = MetaData()
+sessions = Table(
+    "sessions",
+    metadata,
+    Column("auth_token", String(256), unique=True),
+    Column("refreshed_at", TIMESTAMP),
+)
+
+
+def test_coalesce_and_flush(tmp_path):
+    async def _run():
+        engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path}/write_behind.db")
+        now = datetime.utcnow()
+        async with engine.begin() as conn:
+            await conn.run_sync(metadata.create_all)
+            await conn.execute(
+                insert(sessions),
+                [{"auth_token": f"t{i}", "refreshed_at": now if i == 0 else None} for i in range(5)],
+            )
+        buffer = WriteBehindBuffer(engine, max_pending=3, flush_size=100, batch_size=2)
+        buffer.register("refresh", sessions, key="auth_token", column="refreshed_at")
+
+        for second in range(10):
+            await buffer.record("refresh", "t1", now + timedelta(seconds=second))
+        # never moves a row back to an older value
+        await buffer.record("refresh", "t0", now - timedelta(hours=1))
+        await buffer.record("refresh", "t2", now)
+        assert len(buffer) == 3 and buffer.snapshot().coalesced == 9
+        # full, the next new key flushes first
+        await buffer.record("refresh", "t3", now)
+        assert len(buffer) == 1 and buffer.snapshot().written == 2
+
+        await buffer.record("refresh", "t4", now)
+        await buffer.stop()
+        async with engine.connect() as conn:
+            rows = dict((await conn.execute(select(sessions.c.auth_token, sessions.c.refreshed_at))).all())
+        assert rows == {"t0": now, "t1": now + timedelta(seconds=9), "t2": now, "t3": now, "t4": now}
+        assert buffer.snapshot().pending == 0 and buffer.snapshot().flushes == 2
+        await engine.dispose()
+
+    asyncio.run(_run())
+
+
+def test_login_records_last_signin(tmp_path):
+    async def _run():
+        engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path}/login.db")
+        async with engine.begin() as conn:
+            await conn.run_sync(SQLModel.metadata.create_all)
+        buffer = crud.register_signin_targets(WriteBehindBuffer(engine))
+        request = OAuth2IdentityLoginRequest(tenant_id="acme", provider_id="github", provider_uid="7", username="m")
+        for _ in range(3):
+            async with AsyncSession(engine) as session:
+                async with session.begin():
+                    identity = await crud.login_with_oauth2(session, request=request, last_seen=buffer)
+        assert identity.last_signin_at is not None
+        async with AsyncSession(engine) as session:
+            assert (await session.exec(select(User))).scalars().one().last_signin_at is None
+        # three logins, one write per row
+        assert await buffer.flush() == 2 and buffer.snapshot().coalesced == 4
+        async with AsyncSession(engine) as session:
+            assert (await session.exec(select(User))).scalars().one().last_signin_at is not None
+        await engine.dispose()
+
+    asyncio.run(_run())
+
+
+class _Routes(ShardLookup):
+    def __init__(self, routes: dict) -> None:
+        self.routes = routes
+
+    async def route(self, tenant_id: str) -> TenantRoute | None:
+        return self.routes.get(tenant_id)
+
+
+def test_flush_defers_tenants_being_moved(tmp_path):
+    async def _run():
+        default = create_async_engine(f"sqlite+aiosqlite:///{tmp_path}/default.db")
+        eu = create_async_engine(f"sqlite+aiosqlite:///{tmp_path}/eu.db")
+        for engine in (default, eu):
+            async with engine.begin() as conn:
+                await conn.run_sync(SQLModel.metadata.create_all)
+        routes = _Routes({"acme": TenantRoute(shard="eu-1", read_only=True)})
+        buffer = crud.register_signin_targets(WriteBehindBuffer(ShardMap({"default": default, "eu-1": eu}, lookup=routes)))
+        request = OAuth2IdentityLoginRequest(tenant_id="acme", provider_id="github", provider_uid="8", username="m")
+        async with AsyncSession(eu) as session:
+            async with session.begin():
+                await crud.login_with_oauth2(session, request=request, last_seen=buffer)
+                created_at = (await session.exec(select(User))).scalars().one().updated_at
+
+        # kept pending while the tenant is read only, written to its shard after the move
+        assert await buffer.flush() == 0 and len(buffer) == 2 and buffer.snapshot().deferred == 2
+        routes.routes["acme"] = TenantRoute(shard="eu-1")
+        assert await buffer.flush() == 2 and len(buffer) == 0
+        async with AsyncSession(eu) as session:
+            user = (await session.exec(select(User))).scalars().one()
+            # picked up by the catch-up of a later move
+            assert user.last_signin_at is not None and user.updated_at > created_at
+        await default.dispose()
+        await eu.dispose()
+
+    asyncio.run(_run())